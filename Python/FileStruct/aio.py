@@ -0,0 +1,309 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+asyncio interface to a FileStruct database.
+
+AsyncClient mirrors Client, AsyncTempDir mirrors TempDir and AsyncHashFile
+mirrors HashFile.  Uploads are read with `await stream.read(n)` (aiohttp
+StreamReader, starlette UploadFile, ...) and hashed as the chunks arrive;
+every blocking filesystem step runs on a dedicated thread pool, with at
+most Concurrency of them in flight.
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import inspect
+
+from .core import Client, TempDir, CHUNK_SIZE_MAX, _writeall
+
+
+# Default number of blocking filesystem operations allowed at once
+CONCURRENCY = 4
+
+
+async def _read(stream, n):
+  # Accepts both async readers and plain file-like objects
+  data = stream.read(n)
+  if inspect.isawaitable(data):
+    data = await data
+  return data
+
+
+class AsyncClient():
+  def __init__(self, Path, InternalLocation='/FileStruct/Data', Concurrency=CONCURRENCY, Executor=None, **Options):
+    '''
+    Options are passed on to FileStruct.Client.  Executor may be an existing
+    concurrent.futures executor; otherwise a thread pool of Concurrency
+    threads is created and shut down by close().
+    '''
+    self.Client = Client(Path, InternalLocation, **Options)
+    self.Concurrency = int(Concurrency)
+    self.Executor = Executor or ThreadPoolExecutor(self.Concurrency, thread_name_prefix='FileStruct')
+    self._ownexecutor = Executor is None
+    self._semaphore = None
+    self._loop = None
+
+  def close(self):
+    if self._ownexecutor:
+      self.Executor.shutdown(wait=True)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  async def _run(self, func, *args, **kwargs):
+    # The semaphore belongs to one event loop; a new loop gets a new one
+    loop = asyncio.get_running_loop()
+    if self._loop is not loop:
+      self._semaphore, self._loop = asyncio.Semaphore(self.Concurrency), loop
+    async with self._semaphore:
+      return await loop.run_in_executor(self.Executor, functools.partial(func, *args, **kwargs))
+
+  @property
+  def Path(self):
+    return self.Client.Path
+
+  def HashToPath(self, hash):
+    return self.Client.HashToPath(hash)
+
+  def HashToInternalURI(self, hash):
+    return self.Client.HashToInternalURI(hash)
+
+  async def Contains(self, hash):
+    '''
+    Awaitable version of `hash in client`.
+    '''
+    return await self._run(self.Client.__contains__, hash)
+
+  async def Get(self, hash):
+    '''
+    Awaitable version of `client[hash]`, returns an AsyncHashFile.
+    '''
+    self.Client.RequireValidHash(hash)
+    return AsyncHashFile(self, await self._run(self.Client.__getitem__, hash))
+
+  def TempDir(self):
+    return AsyncTempDir(self)
+
+  async def PutData(self, data):
+    return await self._run(self.Client.PutData, data)
+
+  async def PutFile(self, path, Mode='stream'):
+    return await self._run(self.Client.PutFile, path, Mode)
+
+  async def PutStream(self, stream):
+    '''
+    Reads stream to the end with `await stream.read(n)` and stores it.
+    Like Client.PutStream(), streams up to Client.SpoolSize are kept in
+    memory and cost no disk writes at all if the content already exists.
+    '''
+    self.Client._checkopen()
+    hasher = self.Client.NewHash()
+    spool = bytearray()
+    tempfile = None
+    output = None
+    error = None
+    try:
+      while True:
+        chunk = await _read(stream, CHUNK_SIZE_MAX)
+        if not chunk:
+          break
+        hasher.update(chunk)
+        if output is None:
+          spool += chunk
+          if len(spool) <= self.Client.SpoolSize:
+            continue
+          # One file in Temp/, renamed into Data/, as Client.PutStream() does
+          tempfile = self.Client._tempfile()
+          path, output = await self._run(tempfile.__enter__)
+          chunk, spool = spool, None
+        await self._run(_writeall, output, memoryview(chunk))
+
+      hash = hasher.hexdigest()
+      if output is None:
+        if not await self._run(self.Client._dedup, hash):
+          await self._run(self.Client._putdata, spool, hash)
+        return hash
+
+      await self._run(self.Client._ingestfile, path, hash, output.fileno())
+      return hash
+
+    except BaseException as e:
+      # Not sys.exc_info(): that could be an exception the caller is
+      # handling while it awaits this
+      error = e
+      raise
+    finally:
+      # Closes the file, and removes it if anything went wrong
+      if tempfile is not None:
+        if error is not None:
+          await self._run(tempfile.__exit__, type(error), error, error.__traceback__)
+        else:
+          await self._run(tempfile.__exit__, None, None, None)
+
+  async def GetStream(self, hash):
+    return await (await self.Get(hash)).GetStream()
+
+  async def GetData(self, hash):
+    return await (await self.Get(hash)).GetData()
+
+
+class AsyncStream():
+  '''
+  Read-only file whose blocking calls run on the AsyncClient executor.
+  Supports `async with` and `await stream.read(n)`.
+  '''
+  def __init__(self, AsyncClient, File):
+    self.AsyncClient = AsyncClient
+    self.File = File
+
+  @property
+  def name(self):
+    return self.File.name
+
+  @property
+  def closed(self):
+    return self.File.closed
+
+  async def read(self, n=-1):
+    return await self.AsyncClient._run(self.File.read, n)
+
+  async def seek(self, offset, whence=0):
+    return await self.AsyncClient._run(self.File.seek, offset, whence)
+
+  def tell(self):
+    return self.File.tell()
+
+  async def close(self):
+    await self.AsyncClient._run(self.File.close)
+
+  async def __aenter__(self):
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.close()
+
+
+class _AsyncFile():
+  def __init__(self, AsyncClient, File):
+    self.AsyncClient = AsyncClient
+    self.File = File
+
+  @property
+  def Path(self):
+    return self.File.Path
+
+  async def GetStream(self):
+    return AsyncStream(self.AsyncClient, await self.AsyncClient._run(self.File.GetStream))
+
+  async def GetData(self):
+    return await self.AsyncClient._run(self.File.GetData)
+
+  async def GetRange(self, Offset, Length):
+    return await self.AsyncClient._run(self.File.GetRange, Offset, Length)
+
+
+class AsyncHashFile(_AsyncFile):
+  @property
+  def Hash(self):
+    return self.File.Hash
+
+  @property
+  def InternalURI(self):
+    return self.File.InternalURI
+
+  async def GetView(self):
+    return await self.AsyncClient._run(self.File.GetView)
+
+
+class AsyncTempFile(_AsyncFile):
+  async def Ingest(self):
+    return await self.AsyncClient._run(self.File.Ingest)
+
+  async def PutStream(self, stream):
+    output = await self.AsyncClient._run(open, self.File.Path, 'wb', buffering=0)
+    try:
+      while True:
+        chunk = await _read(stream, CHUNK_SIZE_MAX)
+        if not chunk:
+          break
+        await self.AsyncClient._run(_writeall, output, memoryview(chunk))
+    finally:
+      await self.AsyncClient._run(output.close)
+
+  async def PutData(self, data):
+    return await self.AsyncClient._run(self.File.PutData, data)
+
+  async def PutFile(self, path):
+    return await self.AsyncClient._run(self.File.PutFile, path)
+
+  async def Link(self, hash):
+    return await self.AsyncClient._run(self.File.Link, hash)
+
+  async def Delete(self):
+    return await self.AsyncClient._run(self.File.Delete)
+
+
+class AsyncTempDir():
+  '''
+  `async with client.TempDir() as TD:` -- same lifecycle as TempDir.
+  '''
+  def __init__(self, AsyncClient):
+    self.AsyncClient = AsyncClient
+    self.TempDir = TempDir(AsyncClient.Client)
+
+  @property
+  def Path(self):
+    return self.TempDir.Path
+
+  @property
+  def Retain(self):
+    return self.TempDir.Retain
+
+  @Retain.setter
+  def Retain(self, value):
+    self.TempDir.Retain = value
+
+  async def __aenter__(self):
+    await self.AsyncClient._run(self.TempDir.__enter__)
+    return self
+
+  async def __aexit__(self, exc_type, exc_value, traceback):
+    await self.AsyncClient._run(self.TempDir.__exit__, exc_type, exc_value, traceback)
+
+  def __getitem__(self, FileName):
+    return AsyncTempFile(self.AsyncClient, self.TempDir[FileName])
+
+  async def convert_resize(self, SourceFileName, DestFileName, SizeSpec):
+    return await self.AsyncClient._run(self.TempDir.convert_resize, SourceFileName, DestFileName, SizeSpec)
+
+  async def convert_normalize(self, SourceFileName, DestFileName, Width, Height):
+    return await self.AsyncClient._run(self.TempDir.convert_normalize, SourceFileName, DestFileName, Width, Height)
+
+  async def convert_multi(self, SourceFileName, Outputs):
+    return await self.AsyncClient._run(self.TempDir.convert_multi, SourceFileName, Outputs)
+
+
+__all__ = (
+  'AsyncClient',
+  'AsyncTempDir',
+  'AsyncHashFile',
+  )
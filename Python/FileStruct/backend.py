@@ -0,0 +1,216 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Storage backends behind the local database.
+
+With Client(Backend=...), the local Data/ directory acts as a read-through
+cache: an object that is not found locally is fetched from the backend,
+checked against its hash, and ingested like any other put.  A backend
+only has to be able to tell whether it has an object and to open one for
+reading; Put() is used by replication.
+
+DirectoryBackend (a directory tree, e.g. a mounted bucket or NFS share),
+MemoryBackend (for tests) and ClientBackend (another FileStruct database,
+e.g. a replica) are included.  An S3 backend is a subclass that maps
+these methods to HEAD, GET and PUT requests.
+'''
+
+from os.path import join, exists
+import io
+import os
+import threading
+
+from .core import Error, RandomName32, StreamCopy
+
+
+class Backend():
+  '''
+  Interface for backends.  Hashes are the database's hex hashes.
+  '''
+  def Contains(self, hash):
+    '''
+    True if the backend has the object.
+    '''
+    raise NotImplementedError()
+
+  def GetStream(self, hash):
+    '''
+    Returns a readable binary stream of the object.  Raises KeyError if the
+    backend does not have it.
+    '''
+    raise NotImplementedError()
+
+  def Put(self, hash, stream):
+    '''
+    Stores the contents of the readable binary stream as hash.  Must be
+    atomic: readers never see a partial object.
+    '''
+    raise NotImplementedError()
+
+  def Delete(self, hash):
+    '''
+    Removes the object.  Not an error if it does not exist.
+    '''
+    raise NotImplementedError()
+
+
+class DirectoryBackend(Backend):
+  '''
+  Objects in Path/xx/yy/<hash>, the same layout as Data/.
+  '''
+  def __init__(self, Path):
+    self.Path = Path
+
+  def HashToPath(self, hash):
+    return join(self.Path, hash[0:2], hash[2:4], hash)
+
+  def Contains(self, hash):
+    return exists(self.HashToPath(hash))
+
+  def GetStream(self, hash):
+    try:
+      return open(self.HashToPath(hash), 'rb', buffering=0)
+    except FileNotFoundError:
+      raise KeyError("Hash '{0}' does not exist in backend.".format(hash))
+
+  def Put(self, hash, stream):
+    path = self.HashToPath(hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmppath = '{0}.{1}.tmp'.format(path, RandomName32())
+    try:
+      with open(tmppath, 'wb', buffering=0) as output:
+        StreamCopy(stream, output)
+      os.rename(tmppath, path)
+    except BaseException:
+      try:
+        os.unlink(tmppath)
+      except FileNotFoundError:
+        pass
+      raise
+
+  def Delete(self, hash):
+    try:
+      os.unlink(self.HashToPath(hash))
+    except FileNotFoundError:
+      pass
+
+
+class MemoryBackend(Backend):
+  '''
+  Objects in a dict, for tests.  Gets counts the GetStream() calls.
+  '''
+  def __init__(self, Objects=None):
+    self.Objects = dict(Objects or {})
+    self.Gets = 0
+    self._lock = threading.Lock()
+
+  def Contains(self, hash):
+    return hash in self.Objects
+
+  def GetStream(self, hash):
+    with self._lock:
+      self.Gets += 1
+    try:
+      return io.BytesIO(self.Objects[hash])
+    except KeyError:
+      raise KeyError("Hash '{0}' does not exist in backend.".format(hash))
+
+  def Put(self, hash, stream):
+    data = stream.read()
+    with self._lock:
+      self.Objects[hash] = data
+
+  def Delete(self, hash):
+    with self._lock:
+      self.Objects.pop(hash, None)
+
+
+class ClientBackend(Backend):
+  '''
+  Another FileStruct database, given as its Client.  It must use the same
+  hash algorithm.
+  '''
+  def __init__(self, Client):
+    self.Client = Client
+
+  def Contains(self, hash):
+    return hash in self.Client
+
+  def GetStream(self, hash):
+    return self.Client[hash].GetStream()
+
+  def Put(self, hash, stream):
+    stored = self.Client.PutStream(stream)
+    if stored != hash:
+      raise Error("Object '{0}' was stored in '{1}' as {2}".format(hash, self.Client.Path, stored))
+
+  def Delete(self, hash):
+    raise Error('Objects are only removed from a FileStruct database by garbage collection.')
+
+
+class _Flight():
+  __slots__ = ('Event', 'Result', 'Error')
+
+  def __init__(self):
+    self.Event = threading.Event()
+    self.Result = None
+    self.Error = None
+
+
+class SingleFlight():
+  '''
+  Collapses concurrent calls for the same key into one: the first caller
+  runs the function, the others wait for it and get its result (or its
+  exception).
+  '''
+  def __init__(self):
+    self._flights = {}
+    self._lock = threading.Lock()
+
+  def Do(self, key, func, *args):
+    with self._lock:
+      flight = self._flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self._flights[key] = _Flight()
+
+    if not leader:
+      flight.Event.wait()
+      if flight.Error is not None:
+        raise flight.Error
+      return flight.Result
+
+    try:
+      flight.Result = func(*args)
+      return flight.Result
+    except BaseException as e:
+      flight.Error = e
+      raise
+    finally:
+      with self._lock:
+        del self._flights[key]
+      flight.Event.set()
+
+
+__all__ = (
+  'Backend',
+  'DirectoryBackend',
+  'MemoryBackend',
+  'ClientBackend',
+  'SingleFlight',
+  )
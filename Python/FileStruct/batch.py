@@ -0,0 +1,106 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Batch ingest on a bounded thread pool.
+
+hashlib releases the GIL for large buffers and file I/O releases it too,
+so a handful of threads keep several disks busy.  Items are taken from the
+input iterable only as fast as the pool works through them.
+'''
+
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+
+
+# Default number of ingest threads
+WORKERS = 8
+
+
+PutResult = namedtuple('PutResult', ('Index', 'Item', 'Hash', 'Error'))
+PutResult.__doc__ = '''
+Outcome of one item of Client.PutMany(): Index is its position in the
+input, and exactly one of Hash and Error is None.
+'''
+
+
+def _put(Client, Item, Mode):
+  if isinstance(Item, (bytes, bytearray, memoryview)):
+    return Client.PutData(Item)
+  if isinstance(Item, (str, os.PathLike)):
+    return Client.PutFile(Item, Mode)
+  if hasattr(Item, 'read'):
+    return Client.PutStream(Item)
+  raise TypeError('Cannot ingest {0} object, expected bytes, a path or a stream.'.format(type(Item).__name__))
+
+
+def _run(Put, Index, Item):
+  try:
+    return PutResult(Index, Item, Put(Item), None)
+  except Exception as e:
+    return PutResult(Index, Item, None, e)
+
+
+def PutMany(Client, Items, Workers=WORKERS, Ordered=True, MaxPending=None, Mode='stream', Put=None):
+  '''
+  Ingests every item of Items (bytes, paths or readable streams) and yields
+  a PutResult for each, in input order or, with Ordered=False, as soon as
+  each one completes.  At most MaxPending items (default 2 * Workers) are
+  queued or running at a time.  Errors are reported per item and do not
+  stop the batch.
+
+  Put, if given, is called with each item instead of picking PutData,
+  PutFile or PutStream by its type.
+  '''
+  if Put is None:
+    Put = lambda Item: _put(Client, Item, Mode)
+  Workers = max(1, int(Workers or WORKERS))
+  MaxPending = max(Workers, int(MaxPending or 2 * Workers))
+
+  with ThreadPoolExecutor(max_workers=Workers) as pool:
+    pending = deque() if Ordered else set()
+    items = enumerate(Items)
+    try:
+      while True:
+        for index, item in items:
+          future = pool.submit(_run, Put, index, item)
+          if Ordered:
+            pending.append(future)
+          else:
+            pending.add(future)
+          if len(pending) >= MaxPending:
+            break
+
+        if not pending:
+          break
+
+        if Ordered:
+          yield pending.popleft().result()
+        else:
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            yield future.result()
+    finally:
+      for future in pending:
+        future.cancel()
+
+
+__all__ = (
+  'PutMany',
+  'PutResult',
+  )
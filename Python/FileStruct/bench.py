@@ -0,0 +1,232 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Micro benchmarks for FileStruct.  Run from the Python/ directory:
+
+  python -m FileStruct.bench stream [--max-size 4G] [--dir /path/on/target/fs]
+  python -m FileStruct.bench startup [--repeat 20] [--dir /path/on/target/fs]
+  python -m FileStruct.bench durability [--repeat 20] [--dir /path/on/target/fs]
+
+Every benchmark creates a throw-away database in a temporary directory
+(or under --dir, which should live on the filesystem you care about).
+'''
+
+from os.path import join
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import core
+
+
+SIZE_UNITS = {'K': 2**10, 'M': 2**20, 'G': 2**30}
+
+def ParseSize(text):
+  text = text.strip().upper().rstrip('B')
+  if text and text[-1] in SIZE_UNITS:
+    return int(float(text[:-1]) * SIZE_UNITS[text[-1]])
+  return int(text)
+
+def FormatSize(size):
+  for unit in ('G', 'M', 'K'):
+    if size >= SIZE_UNITS[unit]:
+      return '{0:g}{1}'.format(size / SIZE_UNITS[unit], unit)
+  return str(size)
+
+
+class BenchDatabase():
+  def __init__(self, Dir=None, Config='{"Version":1}'):
+    self.Path = tempfile.mkdtemp(suffix='_FileStruct_Bench', dir=Dir)
+    with open(join(self.Path, 'FileStruct.json'), 'w', encoding='utf-8') as f:
+      f.write(Config)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    shutil.rmtree(self.Path, ignore_errors=True)
+
+
+def _fill(path, size):
+  chunk = os.urandom(2**20)
+  with open(path, 'wb') as f:
+    while size > 0:
+      f.write(chunk[:size])
+      size -= len(chunk)
+
+
+def _put_4096(client, stream):
+  # The pre-StreamCopy implementation, kept for comparison
+  sha1 = hashlib.sha1()
+  with client.TempDir() as TD:
+    with open(TD['StreamFile'].Path, 'wb', buffering=0) as output:
+      while True:
+        buf = stream.read(4096)
+        if not buf:
+          break
+        sha1.update(buf)
+        output.write(buf)
+    hash = sha1.hexdigest()
+    client._ingestfile(TD['StreamFile'].Path, hash)
+    return hash
+
+
+def BenchStream(MaxSize=4 * 2**30, Dir=None, out=sys.stdout):
+  '''
+  Times Client.PutStream() on files from 1K up to MaxSize (x16 steps)
+  against the old read(4096) loop.  Each stored object is removed again
+  so that every run really writes its data.
+  '''
+  results = []
+  with BenchDatabase(Dir) as db:
+    client = core.Client(db.Path)
+    source = join(db.Path, 'source')
+    size = 2**10
+    out.write('{0:>8} {1:>12} {2:>12} {3:>8}\n'.format('size', 'read(4096)', 'StreamCopy', 'speedup'))
+    while size <= MaxSize:
+      _fill(source, size)
+      # Small inputs are repeated so that timings are not pure noise
+      repeat = max(1, min(1000, 2**24 // size))
+      timings = []
+      for put in (_put_4096, core.Client.PutStream):
+        start = time.perf_counter()
+        for i in range(repeat):
+          with open(source, 'rb', buffering=0) as stream:
+            hash = put(client, stream)
+          os.unlink(client.HashToPath(hash))
+        timings.append((time.perf_counter() - start) / repeat)
+      rates = [size / t / 2**20 for t in timings]
+      results.append({'size': size, 'old_mib_s': rates[0], 'new_mib_s': rates[1]})
+      out.write('{0:>8} {1:>9.1f}M/s {2:>9.1f}M/s {3:>7.2f}x\n'.format(FormatSize(size), rates[0], rates[1], timings[0] / timings[1]))
+      out.flush()
+      size *= 16 if size < 2**30 else 4
+    os.unlink(source)
+  return results
+
+
+# Modules FileStruct deliberately does not import at startup
+LAZY_MODULES = ('subprocess', 'shutil', 'traceback', 'datetime')
+
+_IMPORT_SCRIPT = '''
+import sys, time
+start = time.perf_counter()
+import FileStruct
+print(time.perf_counter() - start)
+print(' '.join(m for m in {0!r} if m in sys.modules))
+'''.format(LAZY_MODULES)
+
+
+def BenchStartup(Repeat=20, Dir=None, out=sys.stdout):
+  '''
+  Times `import FileStruct` in fresh interpreters, and Client() against
+  Client.Open() on a throw-away database.
+  '''
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (os.path.dirname(os.path.dirname(os.path.abspath(__file__))), os.environ.get('PYTHONPATH')))))
+  timings = []
+  for i in range(Repeat):
+    output = subprocess.check_output((sys.executable, '-c', _IMPORT_SCRIPT), env=env).decode('ascii').split('\n')
+    timings.append(float(output[0]))
+  eager = output[1].split()
+  results = {'import_ms': statistics.median(timings) * 1000, 'eager_modules': eager}
+  out.write('import FileStruct: {0:.2f}ms (median of {1}), loaded: {2}\n'.format(results['import_ms'], Repeat, ' '.join(eager) or 'none of ' + ' '.join(LAZY_MODULES)))
+
+  with BenchDatabase(Dir) as db:
+    n = Repeat * 50
+    for name, construct in (('client_us', core.Client), ('open_us', core.Client.Open)):
+      construct(db.Path)
+      start = time.perf_counter()
+      for i in range(n):
+        construct(db.Path)
+      results[name] = (time.perf_counter() - start) / n * 1e6
+    core._clients.clear()
+  out.write('Client():      {0:>8.1f}us\n'.format(results['client_us']))
+  out.write('Client.Open(): {0:>8.1f}us\n'.format(results['open_us']))
+  return results
+
+
+def BenchDurability(Repeat=20, Dir=None, out=sys.stdout, Threads=(1, 8, 32)):
+  '''
+  Puts of 4K objects per second at every Durability level, from 1 to many
+  threads.  Repeat * 50 objects are stored per run.
+  '''
+  import threading
+  results = []
+  out.write('{0:>10} {1:>8} {2:>12} {3:>10}\n'.format('level', 'threads', 'puts/s', 'commits'))
+  with BenchDatabase(Dir) as db:
+    n = Repeat * 50
+    for level in core.DURABILITY_LEVELS:
+      for threads in Threads:
+        client = core.Client(db.Path, Durability=level)
+        try:
+          datas = iter([os.urandom(4096) for i in range(n)])
+          lock = threading.Lock()
+          def work():
+            while True:
+              with lock:
+                data = next(datas, None)
+              if data is None:
+                return
+              client.PutData(data)
+          workers = [threading.Thread(target=work) for i in range(threads)]
+          start = time.perf_counter()
+          for w in workers:
+            w.start()
+          for w in workers:
+            w.join()
+          rate = n / (time.perf_counter() - start)
+          commits = client.GroupCommit.Commits if client.GroupCommit else None
+        finally:
+          # Stops the group commit thread of this level
+          client.close()
+        results.append({'level': level, 'threads': threads, 'puts_s': rate, 'commits': commits})
+        out.write('{0:>10} {1:>8} {2:>12.0f} {3:>10}\n'.format(level, threads, rate, '-' if commits is None else commits))
+        out.flush()
+  return results
+
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.bench')
+  parser.add_argument('bench', choices=('stream', 'startup', 'durability'))
+  parser.add_argument('--max-size', default='4G', type=ParseSize)
+  parser.add_argument('--repeat', default=20, type=int, help='Repetitions for startup')
+  parser.add_argument('--dir', default=None, help='Directory to create the scratch database in')
+  parser.add_argument('--json', action='store_true', help='Print results as JSON')
+  args = parser.parse_args(argv)
+
+  out = io.StringIO() if args.json else sys.stdout
+  if args.bench == 'stream':
+    results = BenchStream(args.max_size, args.dir, out)
+  elif args.bench == 'startup':
+    results = BenchStartup(args.repeat, args.dir, out)
+  elif args.bench == 'durability':
+    results = BenchDurability(args.repeat, args.dir, out)
+
+  if args.json:
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,165 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+In-process caches used by FileStruct.Client.
+
+Data is content-addressed and append-only, so a cached positive answer can
+only go stale when objects are removed (garbage collection, eviction, or
+someone deleting files by hand).  Those paths call Client.InvalidateCache().
+'''
+
+from collections import OrderedDict
+import threading
+
+
+class ExistsCache():
+  '''
+  Bounded LRU set of hashes known to be present in Data/.
+
+  Only positive answers are cached; a hash that is not found is always
+  checked on disk again, because another process may have added it.
+  '''
+  def __init__(self, MaxSize):
+    self.MaxSize = int(MaxSize)
+    if self.MaxSize <= 0:
+      raise ValueError('MaxSize must be positive: {0}'.format(MaxSize))
+    self.Hits = 0
+    self.Misses = 0
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, hash):
+    with self._lock:
+      if hash in self._items:
+        self._items.move_to_end(hash)
+        self.Hits += 1
+        return True
+      self.Misses += 1
+      return False
+
+  def __len__(self):
+    return len(self._items)
+
+  def Add(self, hash):
+    with self._lock:
+      self._items[hash] = None
+      self._items.move_to_end(hash)
+      while len(self._items) > self.MaxSize:
+        self._items.popitem(last=False)
+
+  def Discard(self, hash):
+    with self._lock:
+      self._items.pop(hash, None)
+
+  def Clear(self):
+    with self._lock:
+      self._items.clear()
+
+  def Stats(self):
+    lookups = self.Hits + self.Misses
+    return {
+      'Size': len(self._items),
+      'MaxSize': self.MaxSize,
+      'Hits': self.Hits,
+      'Misses': self.Misses,
+      'HitRate': self.Hits / lookups if lookups else 0.0,
+      }
+
+
+class ObjectCache():
+  '''
+  LRU cache of object contents, bounded by MaxBytes in total.  Objects
+  larger than MaxObjectSize are never cached.  Contents are immutable bytes,
+  so they are handed out without copying.
+  '''
+  def __init__(self, MaxBytes, MaxObjectSize):
+    self.MaxBytes = int(MaxBytes)
+    self.MaxObjectSize = int(MaxObjectSize)
+    if self.MaxBytes <= 0 or self.MaxObjectSize <= 0:
+      raise ValueError('MaxBytes and MaxObjectSize must be positive: {0}, {1}'.format(MaxBytes, MaxObjectSize))
+    self.Bytes = 0
+    self.Hits = 0
+    self.Misses = 0
+    self.BytesSaved = 0
+    self._items = OrderedDict()
+    self._lock = threading.Lock()
+
+  def __contains__(self, hash):
+    # Does not count as a lookup, and does not make hash more recent
+    return hash in self._items
+
+  def __len__(self):
+    return len(self._items)
+
+  def Get(self, hash):
+    '''
+    Returns the cached contents of hash, or None.
+    '''
+    with self._lock:
+      data = self._items.get(hash)
+      if data is None:
+        self.Misses += 1
+        return None
+      self._items.move_to_end(hash)
+      self.Hits += 1
+      self.BytesSaved += len(data)
+      return data
+
+  def Add(self, hash, data):
+    if len(data) > self.MaxObjectSize or len(data) > self.MaxBytes:
+      return
+    data = bytes(data)
+    with self._lock:
+      old = self._items.pop(hash, None)
+      if old is not None:
+        self.Bytes -= len(old)
+      self._items[hash] = data
+      self.Bytes += len(data)
+      while self.Bytes > self.MaxBytes:
+        hash, old = self._items.popitem(last=False)
+        self.Bytes -= len(old)
+
+  def Discard(self, hash):
+    with self._lock:
+      old = self._items.pop(hash, None)
+      if old is not None:
+        self.Bytes -= len(old)
+
+  def Clear(self):
+    with self._lock:
+      self._items.clear()
+      self.Bytes = 0
+
+  def Stats(self):
+    lookups = self.Hits + self.Misses
+    return {
+      'Size': len(self._items),
+      'Bytes': self.Bytes,
+      'MaxBytes': self.MaxBytes,
+      'MaxObjectSize': self.MaxObjectSize,
+      'Hits': self.Hits,
+      'Misses': self.Misses,
+      'HitRate': self.Hits / lookups if lookups else 0.0,
+      'BytesSaved': self.BytesSaved,
+      }
+
+
+__all__ = (
+  'ExistsCache',
+  'ObjectCache',
+  )
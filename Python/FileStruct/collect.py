@@ -0,0 +1,259 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Garbage collection: everything in Data/ that is not in the keep-set, and
+was not ingested recently, is moved to Trash/<RandomName32>/.
+
+Mark: the keep-set is consumed as a stream and written out as raw binary
+digests into 256 bucket files, one per Data/xx shard, so memory use does
+not depend on its size.
+
+Sweep: every shard is handled by a worker process, which loads only its own
+bucket as a sorted binary array and moves unreferenced objects, with their
+precompressed sidecars (see FileStruct.compress), to Trash.
+
+Derived objects (see FileStruct.derive) are kept only if the keep-set lists
+them, like everything else, and the Derive/ entries of whatever is moved
+to Trash are dropped.
+
+Packed objects (see FileStruct.pack) cannot be removed from their packs, so
+a database that has any is refused rather than half collected.
+
+Writers never have to stop.  Objects ingested after the mark phase started
+(minus GracePeriod) are recognised by their ctime and left alone.  Writers
+that find their content already stored while a collection runs record the
+hash in Temp/GC-Keep.log (see Client._dedup()); after the sweep the log is
+retired and every object listed in it is moved back from Trash.  Objects
+that a writer stored again during the sweep stay in Data/, keep their index
+and derive entries, and their trashed copies are dropped.
+'''
+
+from os.path import join, exists, isdir
+from concurrent.futures import ProcessPoolExecutor
+import bisect
+import fcntl
+import os
+import time
+
+from .core import Error, RandomName32
+from .scan import IterShard
+from .compress import SUFFIXES, MoveSidecars
+from .pack import HasPacks
+
+
+# Objects whose ctime is within this many seconds before the start of a
+# collection are never collected
+GRACE_PERIOD = 3600
+
+
+def _discard(path):
+  # Removes a trashed object that is stored again, and its sidecars
+  for suffix in ('',) + SUFFIXES:
+    try:
+      os.unlink(path + suffix)
+    except FileNotFoundError:
+      pass
+
+
+class _Digests():
+  # Sorted, packed array of fixed size binary digests, for bisect
+  def __init__(self, data, DigestSize):
+    self.DigestSize = DigestSize
+    records = sorted(data[i:i+DigestSize] for i in range(0, len(data), DigestSize))
+    self.data = b''.join(records)
+    self.Count = len(records)
+
+  def __len__(self):
+    return self.Count
+
+  def __getitem__(self, i):
+    return self.data[i*self.DigestSize:(i+1)*self.DigestSize]
+
+  def __contains__(self, digest):
+    i = bisect.bisect_left(self, digest)
+    return i < self.Count and self[i] == digest
+
+
+def _sweep(DataPath, TrashPath, BucketPath, Shard, Cutoff, DigestSize):
+  # Runs in a worker process; handles Data/<Shard>/*/*
+  stats = {'Kept': 0, 'Trashed': 0, 'TrashedBytes': 0, 'Recent': 0}
+  trashed = []
+
+  if not exists(join(DataPath, Shard)):
+    return stats, trashed
+
+  try:
+    with open(BucketPath, 'rb') as f:
+      keep = _Digests(f.read(), DigestSize)
+  except FileNotFoundError:
+    keep = _Digests(b'', DigestSize)
+
+  for entry in IterShard(DataPath, Shard, DigestSize * 2):
+    name = entry.name
+    if bytes.fromhex(name) in keep:
+      stats['Kept'] += 1
+      continue
+    st = entry.stat(follow_symlinks=False)
+    if st.st_ctime >= Cutoff:
+      stats['Recent'] += 1
+      continue
+    os.rename(entry.path, join(TrashPath, name))
+    MoveSidecars(entry.path, join(TrashPath, name))
+    stats['Trashed'] += 1
+    stats['TrashedBytes'] += st.st_size
+    trashed.append(name)
+
+  return stats, trashed
+
+
+class GarbageCollector():
+  def __init__(self, Client, GracePeriod=GRACE_PERIOD, Workers=None):
+    if HasPacks(Client.PackPath):
+      raise Error("'{0}' has packed objects, which garbage collection and eviction cannot remove.".format(Client.Path))
+    self.Client = Client
+    self.GracePeriod = GracePeriod
+    self.Workers = Workers or os.cpu_count() or 1
+    self.DigestSize = Client.DigestSize
+    self.LockPath = join(Client.TempPath, 'GC.lock')
+    self.LogPath = Client.GCLogPath
+    self.DeriveCache = Client.DeriveCache
+    if self.DeriveCache is None and isdir(Client.DerivePath):
+      # Entries of collected objects are dropped even if this client does
+      # not use the cache
+      from .derive import DeriveCache
+      self.DeriveCache = DeriveCache(Client)
+
+  def Run(self, Keep):
+    lockfd = os.open(self.LockPath, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+      try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise Error('Another garbage collection is already running on {0}'.format(self.Client.Path))
+
+      # A log left behind by a collection that died is of no use any more
+      if exists(self.LogPath):
+        os.unlink(self.LogPath)
+
+      with self.Client.TempDir() as TD:
+        return self._run(Keep, TD)
+    finally:
+      os.close(lockfd)
+      if self.DeriveCache is not None and self.DeriveCache is not self.Client.DeriveCache:
+        self.DeriveCache.close()
+
+  def _run(self, Keep, TD):
+    start = time.time()
+    cutoff = start - self.GracePeriod
+
+    # From here on writers record their dedup hits
+    os.close(os.open(self.LogPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o664))
+    try:
+      os.chown(self.LogPath, -1, self.Client.DatabaseGroup.gr_gid)
+      os.chmod(self.LogPath, 0o664)
+      self._mark(Keep, TD.Path)
+
+      trashpath = join(self.Client.TrashPath, RandomName32())
+      self.Client._mkdir(trashpath)
+      stats, trashed = self._sweepall(TD.Path, trashpath, cutoff)
+    except BaseException:
+      os.unlink(self.LogPath)
+      raise
+
+    # Retire the log, wait for writers still appending to it, then put back
+    # whatever they asked for
+    retired = join(TD.Path, 'GC-Keep.log')
+    os.rename(self.LogPath, retired)
+    with open(retired, 'rb') as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      wanted = set(f.read().decode('ascii').split())
+
+    # Objects stored again by a writer during the sweep are kept too, asked
+    # for or not, and their trashed copies dropped
+    restored = []
+    for hash in trashed:
+      destpath = self.Client.HashToPath(hash)
+      if exists(destpath):
+        _discard(join(trashpath, hash))
+      elif hash in wanted:
+        os.rename(join(trashpath, hash), destpath)
+        MoveSidecars(join(trashpath, hash), destpath)
+      else:
+        continue
+      restored.append(hash)
+    if restored:
+      restored = set(restored)
+      trashed = [hash for hash in trashed if hash not in restored]
+      stats['Kept'] += len(restored)
+      stats['Trashed'] -= len(restored)
+      stats['TrashedBytes'] = sum(os.stat(join(trashpath, hash)).st_size for hash in trashed)
+
+    if self.Client.Index is not None:
+      self.Client.Index.RemoveMany(trashed)
+    if self.DeriveCache is not None and trashed:
+      gone = set(bytes.fromhex(hash) for hash in trashed)
+      self.DeriveCache.Compact(lambda source, derived: source in gone or derived in gone)
+    self.Client.InvalidateCache()
+
+    if not os.listdir(trashpath):
+      os.rmdir(trashpath)
+      trashpath = None
+
+    stats.update({
+      'Restored': len(restored),
+      'TrashPath': trashpath,
+      'Seconds': time.time() - start,
+      })
+    return stats
+
+  def _mark(self, Keep, WorkPath):
+    buckets = {}
+    try:
+      for hash in Keep:
+        self.Client.RequireValidHash(hash)
+        shard = hash[0:2]
+        bucket = buckets.get(shard)
+        if bucket is None:
+          bucket = buckets[shard] = open(join(WorkPath, 'keep-' + shard), 'wb')
+        bucket.write(bytes.fromhex(hash))
+    finally:
+      for bucket in buckets.values():
+        bucket.close()
+
+  def _sweepall(self, WorkPath, TrashPath, Cutoff):
+    shards = ['{0:02x}'.format(i) for i in range(256)]
+    args = [(self.Client.DataPath, TrashPath, join(WorkPath, 'keep-' + shard), shard, Cutoff, self.DigestSize) for shard in shards]
+
+    if self.Workers == 1:
+      results = [_sweep(*a) for a in args]
+    else:
+      with ProcessPoolExecutor(max_workers=self.Workers) as pool:
+        results = list(pool.map(_sweep, *zip(*args)))
+
+    stats = {'Kept': 0, 'Trashed': 0, 'TrashedBytes': 0, 'Recent': 0}
+    trashed = []
+    for shardstats, shardtrashed in results:
+      for key in stats:
+        stats[key] += shardstats[key]
+      trashed.extend(shardtrashed)
+    return stats, trashed
+
+
+__all__ = (
+  'GarbageCollector',
+  )
@@ -0,0 +1,397 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Precompressed sidecars, for nginx's gzip_static and brotli_static:
+
+  Data/xx/yy/<hash>      the object
+  Data/xx/yy/<hash>.gz   the same content, gzip'ed
+  Data/xx/yy/<hash>.br   the same content, brotli'ed (needs the brotli module)
+
+Objects never change, so each is compressed once: as it is ingested by a
+client with Compress=..., on a pool of threads that puts never wait for, or
+by a pass over Data/ with Compressor.Run().  Objects smaller than MinSize
+are left alone, and so is content that does not compress to at most
+MaxRatio of its size (judged first from a sample, so already compressed
+images, video and archives cost little).
+
+Sidecars belong to their object: garbage collection and eviction move them
+with it, scrubbing checks that they decompress to it, and Run() removes
+any whose object is gone.
+
+  python -m FileStruct.compress /path/to/database [--encodings gzip,br]
+'''
+
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor, wait
+import argparse
+import os
+import sys
+import threading
+import zlib
+
+from .core import Error, StreamCopy, _writeall
+from .scan import HEX_MATCH
+
+
+# Encoding -> sidecar suffix
+ENCODINGS = {'gzip': '.gz', 'br': '.br'}
+SUFFIXES = tuple(sorted(ENCODINGS.values()))
+
+# Objects smaller than this (bytes) are not compressed
+MIN_SIZE = 1024
+
+# A sidecar is only kept if it is at most this fraction of the object
+MAX_RATIO = 0.9
+
+# Bytes from the start of an object that are test compressed first
+SAMPLE_SIZE = 64 * 1024
+
+# Compressing threads
+WORKERS = 2
+
+# Objects waiting for the threads at most, beyond that puts leave them to Run()
+MAX_PENDING = 10000
+
+GZIP_LEVEL = 9
+BROTLI_QUALITY = 9
+
+
+def _brotli():
+  try:
+    import brotli
+  except ImportError:
+    raise Error("The 'br' encoding needs the brotli module (pip install brotli).")
+  return brotli
+
+
+class _Encoder():
+  # File-like output for StreamCopy() that writes compressed to output
+  def __init__(self, Encoding, output):
+    self.output = output
+    if Encoding == 'gzip':
+      # wbits 31: a gzip header with no name and no time, so the same
+      # content always gives the same sidecar
+      c = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+      self.compress, self.flush = c.compress, c.flush
+    else:
+      c = _brotli().Compressor(quality=BROTLI_QUALITY)
+      self.compress, self.flush = c.process, c.finish
+
+  def write(self, data):
+    _writeall(self.output, memoryview(self.compress(data)))
+    return len(data)
+
+  def close(self):
+    _writeall(self.output, memoryview(self.flush()))
+
+
+class _Decoder():
+  # File-like output for StreamCopy() that feeds the decompressed data to hash
+  def __init__(self, Encoding, hash):
+    self.hash = hash
+    if Encoding == 'gzip':
+      self.d = zlib.decompressobj(31)
+      self.decompress = self.d.decompress
+    else:
+      self.d = None
+      self.decompress = _brotli().Decompressor().process
+
+  def write(self, data):
+    self.hash.update(self.decompress(data))
+    return len(data)
+
+  def close(self):
+    if self.d is not None:
+      if not self.d.eof:
+        raise zlib.error('Truncated gzip stream')
+      self.hash.update(self.d.flush())
+
+
+def SidecarEncoding(name):
+  '''
+  Returns the encoding of a sidecar file name, or None.
+  '''
+  for encoding, suffix in ENCODINGS.items():
+    if name.endswith(suffix):
+      return encoding
+  return None
+
+
+def MoveSidecars(path, destpath):
+  '''
+  Renames the sidecars of the object at path to go with destpath.  Returns
+  how many there were.
+  '''
+  moved = 0
+  for suffix in SUFFIXES:
+    try:
+      os.rename(path + suffix, destpath + suffix)
+      moved += 1
+    except FileNotFoundError:
+      pass
+  return moved
+
+
+def VerifySidecar(Client, hash, path, stream=None):
+  '''
+  True if the sidecar at path decompresses to content that hashes to hash.
+  stream, if given, is used to read it.  None if it cannot be checked (no
+  brotli module) or does not exist.
+  '''
+  encoding = SidecarEncoding(path)
+  hasher = Client.NewHash()
+  try:
+    decoder = _Decoder(encoding, hasher)
+  except Error:
+    return None
+  try:
+    if stream is None:
+      with open(path, 'rb', buffering=0) as f:
+        StreamCopy(f, decoder, None, Client.ChunkSize)
+    else:
+      StreamCopy(stream, decoder, None, Client.ChunkSize)
+    decoder.close()
+  except FileNotFoundError:
+    return None
+  except Exception:
+    # zlib.error, brotli.error: not a valid compressed stream
+    return False
+  return hasher.hexdigest() == hash
+
+
+class Compressor():
+  def __init__(self, Client, Encodings=('gzip',), MinSize=MIN_SIZE, MaxRatio=MAX_RATIO, Workers=WORKERS):
+    '''
+    Encodings is a sequence of keys of ENCODINGS, or just one of them.
+    '''
+    if isinstance(Encodings, str):
+      Encodings = (Encodings,)
+    Encodings = tuple(Encodings or ())
+    if not Encodings:
+      raise ValueError('No encodings given.')
+    for encoding in Encodings:
+      if encoding not in ENCODINGS:
+        raise ValueError("Invalid encoding '{0}', must be one of: {1}".format(encoding, ', '.join(sorted(ENCODINGS))))
+      if encoding == 'br':
+        _brotli()
+    if not 0 < MaxRatio <= 1:
+      raise ValueError('MaxRatio must be over 0 and at most 1: {0}'.format(MaxRatio))
+
+    self.Client = Client
+    self.Encodings = Encodings
+    self.MinSize = max(1, int(MinSize))
+    self.MaxRatio = MaxRatio
+    self.Workers = max(1, int(Workers or WORKERS))
+    self.Counters = {'Compressed': 0, 'Skipped': 0, 'Present': 0, 'Missing': 0, 'Deferred': 0, 'Errors': 0, 'Bytes': 0, 'CompressedBytes': 0}
+    self._lock = threading.Lock()
+    self._pool = None
+    self._pending = set()
+
+  def Stats(self):
+    with self._lock:
+      return dict(self.Counters, Pending=len(self._pending))
+
+  def Submit(self, hash):
+    '''
+    Queues hash to be compressed by the threads, and returns at once.
+    '''
+    with self._lock:
+      if len(self._pending) >= MAX_PENDING:
+        self.Counters['Deferred'] += 1
+        return
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(max_workers=self.Workers)
+      future = self._pool.submit(self._compress, hash)
+      self._pending.add(future)
+    future.add_done_callback(self._done)
+
+  def _done(self, future):
+    with self._lock:
+      self._pending.discard(future)
+
+  def Wait(self):
+    '''
+    Returns once everything Submit()'ed so far is done.
+    '''
+    with self._lock:
+      pending = list(self._pending)
+    wait(pending)
+
+  def close(self):
+    '''
+    Waits for everything Submit()'ed so far, and stops the threads.
+    '''
+    with self._lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.shutdown(wait=True)
+
+  def _compress(self, hash):
+    try:
+      result = self.Compress(hash)
+    except Exception:
+      result = 'Errors'
+    with self._lock:
+      self.Counters[result] += 1
+    return result
+
+  def Compress(self, hash):
+    '''
+    Writes the missing sidecars of hash.  Returns 'Compressed', 'Present'
+    (it has them all), 'Skipped' (too small, or does not compress well) or
+    'Missing'.
+    '''
+    path = self.Client.HashToPath(hash)
+    missing = [encoding for encoding in self.Encodings if not exists(path + ENCODINGS[encoding])]
+    if not missing:
+      return 'Present'
+    try:
+      f = open(path, 'rb', buffering=0)
+    except FileNotFoundError:
+      return 'Missing'
+    with f:
+      size = os.fstat(f.fileno()).st_size
+      if size < self.MinSize:
+        return 'Skipped'
+      sample = f.read(SAMPLE_SIZE)
+      if len(zlib.compress(sample, 1)) > len(sample) * self.MaxRatio:
+        return 'Skipped'
+
+      written = 0
+      for encoding in missing:
+        f.seek(0)
+        written += self._write(encoding, f, path, size)
+    pass#with
+
+    if not written:
+      return 'Skipped'
+    with self._lock:
+      self.Counters['Bytes'] += size
+      self.Counters['CompressedBytes'] += written
+    return 'Compressed'
+
+  def _write(self, encoding, f, path, size):
+    # Returns the size of the sidecar written, 0 if it was not worth it
+    sidecar = path + ENCODINGS[encoding]
+    with self.Client._tempfile() as (tmppath, output):
+      encoder = _Encoder(encoding, output)
+      StreamCopy(f, encoder, None, self.Client.ChunkSize)
+      encoder.close()
+      compressed = os.fstat(output.fileno()).st_size
+      if compressed > size * self.MaxRatio:
+        os.unlink(tmppath)
+        return 0
+      os.fchown(output.fileno(), -1, self.Client.DatabaseGroup.gr_gid)
+      os.fchmod(output.fileno(), 0o444)
+      if self.Client.Durability != 'none':
+        self.Client._syncfile(tmppath, output.fileno())
+      os.rename(tmppath, sidecar)
+    pass#with
+
+    if not exists(path):
+      # Collected or evicted while we were compressing, after its sidecars
+      # were moved along: do not leave this one behind
+      try:
+        os.unlink(sidecar)
+      except FileNotFoundError:
+        pass
+      return 0
+    return compressed
+
+  def Run(self):
+    '''
+    Compresses every object in Data/ that is missing a sidecar, and removes
+    sidecars whose object is gone.  Returns the counters, with Orphans.
+    '''
+    self.Counters['Orphans'] = 0
+    with ThreadPoolExecutor(max_workers=self.Workers) as pool:
+      for result in pool.map(self._rundir, self._dirs()):
+        pass
+    stats = self.Stats()
+    del stats['Pending']
+    return stats
+
+  def _dirs(self):
+    # Every Data/xx/yy directory
+    try:
+      shards = sorted(os.listdir(self.Client.DataPath))
+    except FileNotFoundError:
+      return
+    for shard in shards:
+      if len(shard) != 2 or not HEX_MATCH(shard):
+        continue
+      try:
+        subs = sorted(os.listdir(join(self.Client.DataPath, shard)))
+      except (FileNotFoundError, NotADirectoryError):
+        continue
+      for sub in subs:
+        if len(sub) == 2 and HEX_MATCH(sub):
+          yield join(self.Client.DataPath, shard, sub)
+
+  def _rundir(self, dirpath):
+    try:
+      names = set(os.listdir(dirpath))
+    except FileNotFoundError:
+      return
+    hashlength = self.Client.HashLength
+    for name in sorted(names):
+      if len(name) == hashlength and HEX_MATCH(name):
+        if any(name + ENCODINGS[encoding] not in names for encoding in self.Encodings):
+          self._compress(name)
+      elif SidecarEncoding(name) and name[:hashlength] not in names:
+        # Its object was removed, or it was left behind by a crash
+        try:
+          os.unlink(join(dirpath, name))
+        except FileNotFoundError:
+          continue
+        with self._lock:
+          self.Counters['Orphans'] += 1
+
+
+def main(argv=None):
+  from .core import Client
+  from .bench import ParseSize
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.compress')
+  parser.add_argument('path', help='Database directory')
+  parser.add_argument('--encodings', default='gzip', help='Comma separated: gzip, br')
+  parser.add_argument('--min-size', type=ParseSize, default=MIN_SIZE, help='Smallest object to compress, e.g. 4K')
+  parser.add_argument('--max-ratio', type=float, default=MAX_RATIO)
+  parser.add_argument('--workers', type=int, default=WORKERS)
+  args = parser.parse_args(argv)
+
+  client = Client(args.path)
+  try:
+    compressor = Compressor(client, args.encodings.split(','), args.min_size, args.max_ratio, args.workers)
+  except (ValueError, Error) as e:
+    parser.error(str(e))
+  stats = compressor.Run()
+  for key in sorted(stats):
+    sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+  return 1 if stats['Errors'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'Compressor',
+  'MoveSidecars',
+  'VerifySidecar',
+  'SidecarEncoding',
+  )
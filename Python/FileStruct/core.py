@@ -16,38 +16,222 @@
 #
       
 
-from os.path import join, abspath, isdir, dirname, exists
+from os.path import join, abspath, isdir, exists
 import json
 import re
 import os
 import time
 import random
-import shutil
-import traceback
 import io
-import datetime
 import hashlib
+import functools
 import pwd
 import grp
 import stat
-import subprocess
+import errno
+import fcntl
+import threading
+import contextlib
+import mmap
 
+# shutil, traceback and datetime are only needed by TempDir and
+# for error reports, and are imported where used to keep startup cheap.
 
-HASH_MATCH = re.compile('^[a-f0-9]{40}$').match
+from .cache import ExistsCache, ObjectCache
+
+
+HEX_MATCH = re.compile('[a-f0-9]+').fullmatch
 FILENAME_MATCH = re.compile('^[a-zA-Z0-9_.+-]{1,255}$').match
 
-def RequireValidHash(Hash):
-  if not HASH_MATCH(Hash):
+# Hash algorithms a Version 2 database may declare in its "Hash" setting.
+# BLAKE2b is used with a 32 byte digest, the same length as SHA-256.
+HASH_ALGORITHMS = {
+  'sha1': hashlib.sha1,
+  'sha256': hashlib.sha256,
+  'blake2b': functools.partial(hashlib.blake2b, digest_size=32),
+  }
+
+# Database versions this client understands.  Version 1 is always sha1.
+VERSIONS = (1, 2)
+
+# Adaptive chunk sizes used by StreamCopy when no fixed ChunkSize is given.
+# Reads start small so tiny payloads do not pay for a large allocation, and
+# double after every full read until they reach the maximum.
+CHUNK_SIZE_MIN = 64 * 1024
+CHUNK_SIZE_MAX = 1024 * 1024
+
+# Default for Client(SpoolSize=...): streams up to this size are read into
+# memory and hashed before anything is written to disk.
+SPOOL_SIZE = 1024 * 1024
+
+# Ways Client.PutFile() can place a file into the database, see PutFile()
+PUTFILE_MODES = ('stream', 'link', 'reflink', 'copy_file_range', 'auto')
+
+# Default for Client(ObjectCacheMaxObject=...): larger objects are never
+# kept in the ObjectCache
+OBJECT_CACHE_MAX_OBJECT = 64 * 1024
+
+# Client(Durability=...): what has to be on stable storage before a put returns
+#   none        nothing, the OS writes it back when it likes
+#   file        the object's contents (fsync before the rename)
+#   directory   the contents and the directory entry, with group commit
+DURABILITY_LEVELS = ('none', 'file', 'directory')
+
+# Client(ImageEngine=...), see FileStruct.image
+IMAGE_ENGINES = ('auto', 'pillow', 'convert')
+
+# ioctl(2) request number for a btrfs/xfs reflink clone, from <linux/fs.h>
+FICLONE = 0x40049409
+
+# Errors that mean "this filesystem or kernel cannot do that", as opposed
+# to real I/O errors.  Used to fall back from one PutFile mode to the next.
+_NOT_SUPPORTED_ERRNOS = frozenset((errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EBADF))
+
+def RequireValidHash(Hash, HashLength=40):
+  if not HEX_MATCH(Hash) or len(Hash) != HashLength:
     raise ValueError('Hash is not valid: {0}'.format(str(Hash)))
   
+def _optionkey(Options):
+  # Client.Open() registry key of Options: sequences (e.g. Compress) and
+  # mappings made hashable
+  def hashable(value):
+    if isinstance(value, (list, tuple)):
+      return tuple(hashable(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+      return frozenset(hashable(v) for v in value)
+    if isinstance(value, dict):
+      return tuple(sorted((k, hashable(v)) for k, v in value.items()))
+    return value
+  return hashable(Options)
+
 def FormatException(e):
+  import datetime
+  import traceback
   rval = io.StringIO()
   rval.write("An exception occured on {0}:\n".format(datetime.datetime.now().isoformat()))
   rval.write("=======================================================\n\n")
-  traceback.print_exc(limit=10, file=rval)
+  # From e itself: __exit__ may run on a thread that is not handling it
+  rval.write(''.join(traceback.format_exception(type(e), e, e.__traceback__, limit=10)))
   return rval.getvalue()
 
 
+def _writeall(output, view):
+  # Raw (unbuffered) files may write less than requested
+  while view:
+    n = output.write(view)
+    if n is None:
+      n = len(view)
+    view = view[n:]
+
+
+def StreamCopy(stream, output=None, hash=None, ChunkSize=None):
+  '''
+  Reads `stream` to the end, writing every chunk to `output` and feeding
+  it to `hash` (either may be None).  Returns the number of bytes copied.
+
+  When the stream supports readinto(), a single preallocated buffer is
+  reused for the whole copy and chunks are passed on as memoryview slices.
+  Otherwise plain read(n) is used.
+
+  ChunkSize fixes the read size; by default it grows from CHUNK_SIZE_MIN
+  to CHUNK_SIZE_MAX as long as the stream keeps filling the buffer.
+  '''
+  if ChunkSize is not None:
+    ChunkSize = int(ChunkSize)
+    if ChunkSize <= 0:
+      raise ValueError('ChunkSize must be positive: {0}'.format(ChunkSize))
+    size = maxsize = ChunkSize
+  else:
+    size, maxsize = CHUNK_SIZE_MIN, CHUNK_SIZE_MAX
+
+  total = 0
+  readinto = getattr(stream, 'readinto', None)
+
+  if readinto is not None:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    try:
+      n = readinto(view[:size])
+    except (NotImplementedError, io.UnsupportedOperation):
+      # e.g. an io.RawIOBase subclass that only implements read()
+      view.release()
+      readinto = None
+
+  if readinto is not None:
+    while True:
+      if total:
+        n = readinto(view[:size])
+      if not n:
+        break
+      chunk = view[:n]
+      if hash is not None:
+        hash.update(chunk)
+      if output is not None:
+        _writeall(output, chunk)
+      total += n
+      if n == size and size < maxsize:
+        size = min(size * 2, maxsize)
+        if size > len(buf):
+          view.release()
+          buf = bytearray(size)
+          view = memoryview(buf)
+    pass#while
+    view.release()
+
+  else:
+    while True:
+      buf = stream.read(size)
+      if not buf:
+        break
+      if hash is not None:
+        hash.update(buf)
+      if output is not None:
+        _writeall(output, memoryview(buf))
+      total += len(buf)
+      if len(buf) >= size and size < maxsize:
+        size = min(size * 2, maxsize)
+    pass#while
+
+  return total
+
+
+def StreamRead(stream, Limit):
+  '''
+  Reads from `stream` until it is exhausted or about `Limit` bytes have
+  been read, whichever comes first.  Returns a bytes-like object.
+  '''
+  readinto = getattr(stream, 'readinto', None)
+
+  if readinto is not None:
+    # The buffer starts small and grows, so tiny streams stay cheap
+    buf = bytearray(min(Limit, CHUNK_SIZE_MIN))
+    got = 0
+    try:
+      while got < Limit:
+        if got == len(buf):
+          buf.extend(bytes(min(len(buf) * 3, Limit - len(buf))))
+        with memoryview(buf) as view:
+          n = readinto(view[got:])
+        if not n:
+          break
+        got += n
+      del buf[got:]
+      return buf
+    except (NotImplementedError, io.UnsupportedOperation):
+      if got:
+        raise
+
+  chunks = []
+  got = 0
+  while got < Limit:
+    chunk = stream.read(min(Limit - got, CHUNK_SIZE_MAX))
+    if not chunk:
+      break
+    chunks.append(chunk)
+    got += len(chunk)
+  return b''.join(chunks)
+
+
 def RandomName32():
   '''
   Returns a 32 character unique date-based name like: 
@@ -62,6 +246,26 @@ def RandomName32():
     ).replace('.', '-')
 
 
+def _getgrgid(gid, _cache={}):
+  # Group and user lookups can go to NSS/LDAP, so successful ones are
+  # remembered for the life of the process
+  if gid not in _cache:
+    _cache[gid] = grp.getgrgid(gid)
+  return _cache[gid]
+
+def _getpwuid(uid, _cache={}):
+  if uid not in _cache:
+    _cache[uid] = pwd.getpwuid(uid)
+  return _cache[uid]
+
+
+def _loadconfig(text):
+  # Lines starting with # are comments; most files have none
+  if '#' in text:
+    text = str.join('', (line for line in text.splitlines(True) if not line.lstrip().startswith('#')))
+  return json.loads(text), text
+
+
 class Error(Exception):
   pass
 
@@ -69,21 +273,37 @@ class ConfigError(Error):
   pass
 
 
+# Client.Open() registry: key -> (config file identity, Client)
+_clients = {}
+_clients_lock = threading.Lock()
+
+
 class Client():
-  def __init__(self, Path, InternalLocation='/FileStruct/Data'):
+  def __init__(self, Path, InternalLocation='/FileStruct/Data', ChunkSize=None, SpoolSize=SPOOL_SIZE, ExistsCacheSize=0, Index=False, PrecreateShards=False, Durability='none', ObjectCacheSize=0, ObjectCacheMaxObject=OBJECT_CACHE_MAX_OBJECT, Backend=None, AccessLog=False, ReplicationQueue=False, PackThreshold=0, Compress=None, DeriveCache=False, ImageJobs=0, ImageEngine='auto', ImageWorkers=None, ImageTimeout=None, ImageMaxPixels=None, ImageMaxSide=None):
     self.Path = abspath(Path)
     self.DataPath = join(self.Path, 'Data')
     self.ErrorPath = join(self.Path, 'Error')
     self.TempPath = join(self.Path, 'Temp')
     self.TrashPath = join(self.Path, 'Trash')
+    self.CorruptPath = join(self.Path, 'Corrupt')
     self.StaticPath = join(self.Path, 'Static')
     self.ConfPath = join(self.Path, 'FileStruct.json')
+    self.IndexPath = join(self.Path, 'Index')
+    self.ReplicatePath = join(self.Path, 'Replicate')
+    self.PackPath = join(self.Path, 'Pack')
+    self.DerivePath = join(self.Path, 'Derive')
+    self.GCLogPath = join(self.TempPath, 'GC-Keep.log')
     
     
     self.Conf = None
 
     self.InternalLocation = InternalLocation
     self.Version = 0
+
+    # Set from the "Hash" setting, see NewHash()
+    self.HashName = 'sha1'
+    self.HashLength = 40
+    self.DigestSize = 20
     
     self.DatabaseGroup = None
     self.EffectiveUser = None
@@ -91,15 +311,81 @@ class Client():
     
     self.bin_convert = '/usr/bin/convert'
     
+    # None means adaptive, see StreamCopy()
+    self.ChunkSize = ChunkSize
+
+    # PutStream() hashes streams up to this size in memory first, 0 disables
+    self.SpoolSize = int(SpoolSize or 0)
+
+    # Optional LRU of hashes known to be in Data/, see InvalidateCache()
+    self.ExistsCache = ExistsCache(ExistsCacheSize) if ExistsCacheSize else None
+
+    # Optional LRU of small objects' contents, ObjectCacheSize bytes in total
+    self.ObjectCache = ObjectCache(ObjectCacheSize, ObjectCacheMaxObject) if ObjectCacheSize else None
+
+    # Persistent hash index (FileStruct.index.HashIndex), kept current by _ingestfile
+    self.Index = None
+
+    if Durability not in DURABILITY_LEVELS:
+      raise ValueError("Invalid Durability '{0}', must be one of: {1}".format(Durability, ', '.join(DURABILITY_LEVELS)))
+    self.Durability = Durability
+
+    # FileStruct.durable.GroupCommit for Durability='directory'
+    self.GroupCommit = None
+
+    # Data/xx/yy directories known to exist, as 'xxyy'; None once all of
+    # them are known to exist, see CreateShards()
+    self._shards = set()
 
-    del(Path, InternalLocation)
+    # Optional FileStruct.backend.Backend that Data/ is a read-through cache
+    # of: objects missing locally are fetched from it on access
+    self.Backend = Backend
+    self._flights = None
+    # FileStruct.flight.Flights of Derive() without a DeriveCache
+    self._flightsderive = None
+
+    # FileStruct.evict.AccessLog of client[hash] hits, for eviction
+    self.AccessLog = None
+
+    # FileStruct.replicate.ReplicationQueue that _ingestfile appends to
+    self.ReplicationQueue = None
+
+    # Objects up to this size go into FileStruct.pack.PackStore packs
+    # instead of Data/, 0 disables
+    self.PackThreshold = int(PackThreshold or 0)
+    self.Pack = None
+
+    # FileStruct.compress.Compressor that writes the sidecars of new objects
+    self.Compressor = None
+
+    # FileStruct.derive.DeriveCache of (source hash, spec) -> derived hash
+    self.DeriveCache = None
+
+    # FileStruct.flight.JobSlots capping the image jobs on this host
+    self.ImageJobs = None
+
+    # FileStruct.image.ImageService that runs the TempDir convert_* jobs,
+    # created by the first use of Images
+    self.ImageEngine = ImageEngine
+    self.ImageWorkers = ImageWorkers
+    # Limits of its jobs, None for the FileStruct.image defaults
+    self.ImageTimeout = ImageTimeout
+    self.ImageMaxPixels = ImageMaxPixels
+    self.ImageMaxSide = ImageMaxSide
+    self._images = None
+    self._images_lock = threading.Lock()
+
+    # Set by close()
+    self._closed = False
+
+    del(Path, InternalLocation, ChunkSize, SpoolSize, ExistsCacheSize, Durability, ObjectCacheSize, ObjectCacheMaxObject, Backend, PackThreshold)
 
     
     try:
       stripped_json = None
       with open(self.ConfPath, 'r', encoding='utf-8') as f:
-        stripped_json = str.join('', (line for line in f if not line.lstrip().startswith('#')))
-      self.Conf = json.loads(stripped_json)
+        stripped_json = f.read()
+      self.Conf, stripped_json = _loadconfig(stripped_json)
     except Exception as e:
       raise ConfigError("Error loading config file '{0}': {1}\n\n=== START CONTENTS ===\n{2}\n=== END CONTENTS ===".format(self.ConfPath, str(e), stripped_json))
 
@@ -111,13 +397,21 @@ class Client():
     except Exception as e:
       raise ConfigError("Error reading 'Version' from config file '{0}': {1}".format(self.ConfPath, str(e)))
     
-    if self.Version != 1:
+    if self.Version not in VERSIONS:
       raise ConfigError("This version of the FileStruct client cannot work with database Version {0} as found in config file: '{1}'".format(self.Version, self.ConfPath))
+
+    if self.Version >= 2:
+      self.HashName = self.Conf.get('Hash')
+      if not isinstance(self.HashName, str) or self.HashName not in HASH_ALGORITHMS:
+        raise ConfigError("'Hash' in config file '{0}' must be one of: {1}".format(self.ConfPath, ', '.join(sorted(HASH_ALGORITHMS))))
+    self._newhash = HASH_ALGORITHMS[self.HashName]
+    self.DigestSize = self._newhash().digest_size
+    self.HashLength = self.DigestSize * 2
       
     try:
-      self.DatabaseGroup = grp.getgrgid(os.stat(self.Path).st_gid)
-      self.EffectiveUser = pwd.getpwuid(os.geteuid())
-      self.EffectiveGroup = grp.getgrgid(os.getegid())
+      self.DatabaseGroup = _getgrgid(os.stat(self.Path).st_gid)
+      self.EffectiveUser = _getpwuid(os.geteuid())
+      self.EffectiveGroup = _getgrgid(os.getegid())
     except Exception as e:
       raise ConfigError(e)
     
@@ -126,72 +420,530 @@ class Client():
     if self.EffectiveUser.pw_gid != self.DatabaseGroup.gr_gid and self.EffectiveUser.pw_name not in self.DatabaseGroup.gr_mem:
       raise ConfigError("Effective user (name={0}, uid={1}) is not a member of database group (name={2}, gid={3}) specified in config file '{4}'.".format(self.EffectiveUser.pw_name, self.EffectiveUser.pw_uid, self.DatabaseGroup.gr_name, self.DatabaseGroup.gr_gid, self.ConfPath))
     
-    # Make the basic database directories if they do not exist. 
+    # Make the basic database directories if they do not exist (one scandir
+    # instead of a stat per directory)
     try:
+      present = set(entry.name for entry in os.scandir(self.Path) if entry.is_dir())
       for dir in (self.DataPath, self.ErrorPath, self.TempPath, self.TrashPath, self.StaticPath):
-        if not isdir(dir):
+        if os.path.basename(dir) not in present:
           self._mkdir(dir)
     except Exception as e:
       raise ConfigError("Error checking or creating database directories in '{0}': {1}".format(self.Path, str(e)))
+
+    if self.Durability == 'directory':
+      from .durable import GroupCommit
+      self.GroupCommit = GroupCommit(self.Path)
+
+    if self.Backend is not None:
+      from .backend import SingleFlight
+      self._flights = SingleFlight()
+
+    if AccessLog:
+      from .evict import AccessLog
+      self.AccessLog = AccessLog(self)
+
+    if PrecreateShards:
+      try:
+        self.CreateShards()
+      except Exception as e:
+        raise ConfigError("Error creating shard directories in '{0}': {1}".format(self.DataPath, str(e)))
+
+    if Index:
+      try:
+        if not isdir(self.IndexPath):
+          self._mkdir(self.IndexPath)
+        from .index import HashIndex
+        self.Index = HashIndex(self.IndexPath, self.DigestSize)
+      except Exception as e:
+        raise ConfigError("Error opening hash index in '{0}': {1}".format(self.IndexPath, str(e)))
+
+    if ReplicationQueue:
+      try:
+        if not isdir(self.ReplicatePath):
+          self._mkdir(self.ReplicatePath)
+        from .replicate import ReplicationQueue
+        self.ReplicationQueue = ReplicationQueue(self)
+      except Exception as e:
+        raise ConfigError("Error opening replication queue in '{0}': {1}".format(self.ReplicatePath, str(e)))
+
+    if self.PackThreshold:
+      try:
+        if not isdir(self.PackPath):
+          self._mkdir(self.PackPath)
+        from .pack import PackStore
+        self.Pack = PackStore(self)
+      except Exception as e:
+        raise ConfigError("Error opening packs in '{0}': {1}".format(self.PackPath, str(e)))
+
+    if Compress:
+      from .compress import Compressor
+      try:
+        self.Compressor = Compressor(self, Compress)
+      except Error as e:
+        raise ConfigError(e)
+
+    if DeriveCache:
+      try:
+        if not isdir(self.DerivePath):
+          self._mkdir(self.DerivePath)
+        from .derive import DeriveCache
+        self.DeriveCache = DeriveCache(self)
+      except Exception as e:
+        raise ConfigError("Error opening derive cache in '{0}': {1}".format(self.DerivePath, str(e)))
+
+    if ImageJobs:
+      from .flight import JobSlots
+      self.ImageJobs = JobSlots(self, ImageJobs)
+
+    if ImageEngine not in IMAGE_ENGINES:
+      raise ValueError("Invalid image engine '{0}', must be one of: {1}".format(ImageEngine, ', '.join(IMAGE_ENGINES)))
+    if ImageEngine == 'pillow':
+      # A missing Pillow is a configuration error, not a failed job
+      try:
+        self.Images
+      except Error as e:
+        raise ConfigError(e)
       
   
+  @classmethod
+  def Open(cls, Path, InternalLocation='/FileStruct/Data', **Options):
+    '''
+    Returns a Client shared by the whole process for these arguments,
+    creating it on first use.  Later calls cost one stat of FileStruct.json;
+    a new Client is created only when that file has changed.  The old one
+    is left to the callers that still hold it, so call Open() again for each
+    request instead of keeping the Client.
+    '''
+    Path = abspath(Path)
+    key = (Path, InternalLocation, _optionkey(Options), os.geteuid(), os.getegid())
+    try:
+      st = os.stat(join(Path, 'FileStruct.json'))
+      conf = (st.st_ino, st.st_size, st.st_mtime_ns)
+    except OSError:
+      conf = None
+
+    with _clients_lock:
+      cached = _clients.get(key)
+      if cached is not None and conf is not None and cached[0] == conf:
+        return cached[1]
+      client = cls(Path, InternalLocation, **Options)
+      # Replaced: not closed, callers may still be using it
+      _clients[key] = (conf, client)
+    return client
+
+  def close(self):
+    '''
+    Finishes the background work of this client (sidecars, the access log)
+    and releases its threads and descriptors.  Using it afterwards raises
+    Error; closing it again does nothing.
+    '''
+    if self._closed:
+      return
+    self._closed = True
+    if self.Compressor is not None:
+      self.Compressor.close()
+    if self.AccessLog is not None:
+      self.AccessLog.Flush()
+    if self.GroupCommit is not None:
+      self.GroupCommit.close()
+    if self.Index is not None:
+      self.Index.close()
+    if self.DeriveCache is not None:
+      self.DeriveCache.close()
+    if self.Pack is not None:
+      self.Pack.close()
+    if self._images is not None:
+      self._images.close()
+
+  def _checkopen(self):
+    if self._closed:
+      raise Error("Client of '{0}' is closed.".format(self.Path))
+
+  @property
+  def Images(self):
+    '''
+    The FileStruct.image.ImageService of this client, created on first use.
+    '''
+    if self._images is None:
+      self._checkopen()
+      with self._images_lock:
+        if self._images is None:
+          from .image import ImageService
+          limits = {'Timeout': self.ImageTimeout, 'MaxPixels': self.ImageMaxPixels, 'MaxSide': self.ImageMaxSide}
+          self._images = ImageService(self, self.ImageEngine, self.ImageWorkers, **{k: v for k, v in limits.items() if v is not None})
+    return self._images
+
   def __getitem__(self, hash):
-    RequireValidHash(hash)
-    path = self.HashToPath(hash)
-    
-    if not exists(path):
-      raise KeyError("Hash '{0}' does not exist in database.".format(hash))
+    self._checkopen()
+    if (self.ExistsCache is not None and hash in self.ExistsCache) or (self.ObjectCache is not None and hash in self.ObjectCache):
+      # Only valid hashes ever get into the cache
+      path = join(self.DataPath, hash[0:2], hash[2:4], hash)
+    else:
+      path = self.HashToPath(hash)
+
+      if not exists(path):
+        location = self.Pack.Get(hash) if self.Pack is not None else None
+        if location is not None:
+          return PackedFile(self, hash, location)
+        # Concurrent misses for the same hash share one fetch
+        if self.Backend is None or not self._flights.Do(hash, self._fetch, hash):
+          raise KeyError("Hash '{0}' does not exist in database.".format(hash))
+        if self.Pack is not None and not exists(path):
+          # Small enough to have been fetched into a pack
+          location = self.Pack.Get(hash)
+          if location is None:
+            raise KeyError("Hash '{0}' does not exist in database.".format(hash))
+          return PackedFile(self, hash, location)
 
+      if self.ExistsCache is not None:
+        self.ExistsCache.Add(hash)
+
+    if self.AccessLog is not None:
+      self.AccessLog.Record(hash)
     return HashFile(self, path, hash)
 
   def __contains__(self, hash):
+    self._checkopen()
+    if (self.ExistsCache is not None and hash in self.ExistsCache) or (self.ObjectCache is not None and hash in self.ObjectCache):
+      return True
+
     try:
-      return exists(self.HashToPath(hash))
+      found = exists(self.HashToPath(hash))
     except ValueError: 
       #designed to catch error from RequireValidHash()
       return False
 
+    if found:
+      if self.ExistsCache is not None:
+        self.ExistsCache.Add(hash)
+      return True
+    if self.Pack is not None and hash in self.Pack:
+      return True
+    if self.Backend is not None:
+      # Not fetched until it is actually read
+      return self.Backend.Contains(hash)
+    return False
+
+  def InvalidateCache(self, hash=None):
+    '''
+    Must be called after objects are removed from Data/ (e.g. by garbage
+    collection) so that in-process caches stop reporting them.  Without a
+    hash, everything is dropped.
+    '''
+    for cache in (self.ExistsCache, self.ObjectCache):
+      if cache is None:
+        continue
+      if hash is None:
+        cache.Clear()
+      else:
+        cache.Discard(hash)
+
+
+  def NewHash(self, data=b''):
+    '''
+    Returns a new hashlib object for this database's hash algorithm.
+    '''
+    h = self._newhash()
+    if data:
+      h.update(data)
+    return h
+
+  def RequireValidHash(self, hash):
+    RequireValidHash(hash, self.HashLength)
 
   def HashToPath(self, hash):
-    RequireValidHash(hash)
+    self.RequireValidHash(hash)
     return join(self.DataPath, hash[0:2], hash[2:4], hash)
   
   def HashToInternalURI(self, hash):
-    RequireValidHash(hash)
+    self.RequireValidHash(hash)
     return join(self.InternalLocation, hash[0:2], hash[2:4], hash)
 
 
   def TempDir(self):
+    self._checkopen()
     return TempDir(self)
+
+  def Scan(self, Start=None, Stop=None, Prefix=None, Workers=None):
+    '''
+    Yields (hash, size, mtime) for every object in Data/, in hash order,
+    optionally restricted to Start <= hash < Stop or to a hash Prefix.
+    The shards are listed by a pool of Workers threads.
+    '''
+    from .scan import Scan, WORKERS
+    return Scan(self.DataPath, Start, Stop, Prefix, Workers or WORKERS, self.HashLength)
+
+  def IterHashes(self, Start=None, Stop=None, Prefix=None, Workers=None):
+    '''
+    Like Scan(), but yields only the hashes.
+    '''
+    hashes = (hash for hash, size, mtime in self.Scan(Start, Stop, Prefix, Workers))
+    if self.Pack is None:
+      yield from hashes
+      return
+
+    # Packed objects too, merged into hash order
+    from .scan import PrefixRange
+    import heapq
+    if Prefix:
+      Start, Stop = PrefixRange(Prefix)
+    Start = Start.lower() if Start else None
+    Stop = Stop.lower() if Stop else None
+    packed = sorted(hash for hash in self.Pack.IterHashes() if (Start is None or hash >= Start) and (Stop is None or hash < Stop))
+    yield from heapq.merge(hashes, packed)
+
+  def RebuildIndex(self):
+    '''
+    Recreates the hash index from the Data/ tree.  Only needed after files
+    were added or removed behind FileStruct's back, or to create the index
+    for an existing database.
+    '''
+    if self.Index is None:
+      raise Error('This client was created without Index=True.')
+    self._checkopen()
+    self.Index.Rebuild(self.DataPath)
  
   
   def PutStream(self, stream):
-    sha1 = hashlib.sha1()
-    with self.TempDir() as TD:
-      with open(TD['StreamFile'].Path, 'wb', buffering=0) as output:
-        while True:
-          buf = stream.read(4096)
-          if not buf:
-            break
-          sha1.update(buf)
-          output.write(buf)
-        pass#while
-      pass#with
+    # Small streams are spooled into memory, so content that is already in
+    # the database costs a stat and no disk writes at all.
+    self._checkopen()
+    head = b''
+    if self.SpoolSize:
+      head = StreamRead(stream, self.SpoolSize + 1)
+      if len(head) <= self.SpoolSize:
+        return self.PutData(head)
+
+    hasher = self.NewHash(head)
+    with self._tempfile() as (path, output):
+      _writeall(output, memoryview(head))
+      StreamCopy(stream, output, hasher, self.ChunkSize)
       
-      hash = sha1.hexdigest()
-      self._ingestfile(TD['StreamFile'].Path, hash)
+      hash = hasher.hexdigest()
+      self._ingestfile(path, hash, output.fileno())
       return hash
+    pass#with
     pass#with  
 
   
   def PutData(self, data):
-    stream = io.BytesIO(data)
-    return self.PutStream(stream)
+    self._checkopen()
+    if data is None:
+      data = b''
+    hash = self.NewHash(data).hexdigest()
 
-  def PutFile(self, path):
-    with open(path, 'rb', buffering=0) as stream:
-      return self.PutStream(stream)
+    if self._dedup(hash):
+      return hash
+
+    return self._putdata(data, hash)
+
+  def _putdata(self, data, hash):
+    # Stores data, already known to hash to hash and not to be present
+    if self.Pack is not None and len(data) <= self.PackThreshold:
+      self._putpacked(hash, data)
+      return hash
+
+    with self._tempfile() as (path, output):
+      _writeall(output, memoryview(data).cast('B'))
+      self._ingestfile(path, hash, output.fileno(), Checked=True)
+      return hash
+    pass#with
+
+  def PutFile(self, path, Mode='stream'):
+    '''
+    Mode selects how the file gets into Data/:
+      stream            read it and write a new copy (the default)
+      link              hardlink the source itself into Data/
+      reflink           FICLONE the source (btrfs, xfs)
+      copy_file_range   let the kernel copy the data
+      auto              reflink, else copy_file_range, else stream
+
+    All modes other than stream hash the source in one pass and skip the
+    copy entirely if the content is already in the database.
+
+    With Mode='link' the database object and `path` are the same inode, so
+    ingesting it changes the group and permissions (r--r--r--) of `path`
+    too, and the source must be on the same filesystem as the database.
+    The source must not be modified afterwards.
+    '''
+    if Mode not in PUTFILE_MODES:
+      raise ValueError("Invalid PutFile mode '{0}', must be one of: {1}".format(Mode, ', '.join(PUTFILE_MODES)))
+    self._checkopen()
+
+    if Mode == 'stream':
+      with open(path, 'rb', buffering=0) as stream:
+        return self.PutStream(stream)
+
+    if Mode == 'link' and not isinstance(path, (str, bytes, os.PathLike)):
+      raise TypeError("PutFile mode 'link' requires a path, not {0}".format(type(path).__name__))
+
+    with open(path, 'rb', buffering=0) as source:
+      before = os.fstat(source.fileno())
+      hasher = self.NewHash()
+      StreamCopy(source, None, hasher, self.ChunkSize)
+      hash = hasher.hexdigest()
+
+      if self._dedup(hash):
+        return hash
+
+      if Mode == 'link':
+        with self.TempDir() as TD:
+          # The new name shares the source's inode, and so its descriptor
+          os.link(path, TD['PutFile'].Path)
+          self._checkunchanged(path, source, before)
+          self._ingestfile(TD['PutFile'].Path, hash, source.fileno(), Checked=True)
+          return hash
+
+      with self._tempfile() as (target, output):
+        self._copyfile(source, output, Mode)
+        self._checkunchanged(path, source, before)
+        self._ingestfile(target, hash, output.fileno(), Checked=True)
+        return hash
+    pass#with
+
+
+  def _putpacked(self, hash, data):
+    if self.Pack.Put(hash, data) and self.ReplicationQueue is not None:
+      self.ReplicationQueue.Append(hash)
+
+  def _openobject(self, hash):
+    '''
+    Returns a readable binary stream of an object stored here, in Data/ or
+    in a pack, or raises KeyError.  Never goes to the Backend.
+    '''
+    try:
+      return open(self.HashToPath(hash), 'rb', buffering=0)
+    except FileNotFoundError:
+      location = self.Pack.Get(hash) if self.Pack is not None else None
+      if location is None:
+        raise KeyError("Hash '{0}' does not exist in database.".format(hash))
+      return io.BytesIO(self.Pack.Read(location))
+
+  @contextlib.contextmanager
+  def _tempfile(self):
+    # A bare file in Temp/ for the put methods to write to and ingest: no
+    # TempDir to create and remove.  It is deleted if anything goes wrong.
+    path = join(self.TempPath, RandomName32())
+    try:
+      with open(path, 'xb', buffering=0) as output:
+        yield path, output
+    except BaseException:
+      try:
+        os.unlink(path)
+      except FileNotFoundError:
+        pass
+      raise
+
+  def _checkunchanged(self, path, source, before):
+    # The hash is only valid if the source did not change under us
+    after = os.fstat(source.fileno())
+    if (before.st_size, before.st_mtime_ns) != (after.st_size, after.st_mtime_ns):
+      raise Error("File '{0}' was modified while being ingested.".format(path))
+
+  def _copyfile(self, source, output, Mode):
+    # Copies an open source file into the open, empty output file without
+    # passing the data through userspace where the kernel and filesystem
+    # allow it.
+    if Mode in ('reflink', 'auto'):
+      try:
+        fcntl.ioctl(output.fileno(), FICLONE, source.fileno())
+        return
+      except OSError as e:
+        if Mode == 'reflink' or e.errno not in _NOT_SUPPORTED_ERRNOS:
+          raise
+
+    if Mode in ('copy_file_range', 'auto'):
+      try:
+        offset = 0
+        while True:
+          n = os.copy_file_range(source.fileno(), output.fileno(), CHUNK_SIZE_MAX * 64, offset, offset)
+          if not n:
+            return
+          offset += n
+      except (OSError, AttributeError) as e:
+        # AttributeError: os.copy_file_range needs Python 3.8+ on Linux
+        if Mode == 'copy_file_range' or getattr(e, 'errno', errno.ENOSYS) not in _NOT_SUPPORTED_ERRNOS:
+          raise
+        output.seek(0)
+        output.truncate()
+
+    source.seek(0)
+    StreamCopy(source, output, None, self.ChunkSize)
+
+
+  def PutMany(self, Items, Workers=None, Ordered=True, MaxPending=None, Mode='stream'):
+    '''
+    Ingests an iterable of bytes, paths and streams on a thread pool.
+    Yields a FileStruct.batch.PutResult(Index, Item, Hash, Error) per item,
+    see FileStruct.batch.PutMany().
+    '''
+    from .batch import PutMany
+    return PutMany(self, Items, Workers, Ordered, MaxPending, Mode)
 
+  def PutFiles(self, Paths, Workers=None, Ordered=True, MaxPending=None, Mode='stream'):
+    '''
+    Like PutMany(), but every item is passed to PutFile(item, Mode).
+    '''
+    from .batch import PutMany
+    return PutMany(self, Paths, Workers, Ordered, MaxPending, Put=lambda path: self.PutFile(path, Mode))
+
+
+  def _makeshard(self, hash, Force=False):
+    # Makes sure Data/xx/yy/ exists for hash, checking the disk only the
+    # first time each shard is seen
+    shards = self._shards
+    if not Force and (shards is None or hash[0:4] in shards):
+      return
+    for dir in (join(self.DataPath, hash[0:2]), join(self.DataPath, hash[0:2], hash[2:4])):
+      if not isdir(dir):
+        try:
+          self._mkdir(dir)
+        except FileExistsError:
+          # Created by another writer in the meantime
+          pass
+        if self.GroupCommit is not None:
+          self.GroupCommit.SyncDir(os.path.dirname(dir))
+    if shards is not None:
+      shards.add(hash[0:4])
+
+  def CreateShards(self):
+    '''
+    Creates all 65,536 Data/xx/yy/ directories, so that ingesting never
+    has to check for or create them again.  Data/ff/ff is created last and
+    marks a complete set, so this is nearly free once done.
+    '''
+    if not isdir(join(self.DataPath, 'ff', 'ff')):
+      for i in range(256):
+        top = join(self.DataPath, '{0:02x}'.format(i))
+        try:
+          present = set(os.listdir(top))
+        except FileNotFoundError:
+          try:
+            self._mkdir(top)
+          except FileExistsError:
+            pass
+          present = ()
+        for j in range(256):
+          sub = '{0:02x}'.format(j)
+          if sub not in present:
+            try:
+              self._mkdir(join(top, sub))
+            except FileExistsError:
+              pass
+        if self.GroupCommit is not None:
+          self.GroupCommit.SyncDir(top)
+      if self.GroupCommit is not None:
+        self.GroupCommit.SyncDir(self.DataPath)
+    self._shards = None
+
+  def _syncfile(self, path, fd=None):
+    if fd is None:
+      with open(path, 'rb', buffering=0) as f:
+        return self._syncfile(path, f.fileno())
+    if self.GroupCommit is not None:
+      self.GroupCommit.SyncFile(fd)
+    else:
+      os.fsync(fd)
 
   def _mkdir(self, dir):
     os.mkdir(dir)
@@ -200,26 +952,262 @@ class Client():
     os.chown(dir, -1, self.DatabaseGroup.gr_gid)
     
  
-  def _ingestfile(self, sourcepath, hash):
+  def _dedup(self, hash):
+    '''
+    True if hash is already stored, so the caller need not write it.
+
+    This always checks the disk, never ExistsCache: the caller is about to
+    throw its own copy away.  While a garbage collection is running, the
+    hash is also recorded in its keep log (see FileStruct.collect).
+    '''
     destpath = self.HashToPath(hash)
+    if not exists(destpath):
+      return self.Pack is not None and hash in self.Pack
+
+    try:
+      fd = os.open(self.GCLogPath, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+      found = True
+    else:
+      try:
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        os.write(fd, (hash + '\n').encode('ascii'))
+        try:
+          active = os.stat(self.GCLogPath).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+          active = False
+      finally:
+        os.close(fd)
+      # The collector reads the log once it has retired it.  If it was
+      # retired before this entry got in, the sweep is over and the object
+      # is safe only if it is still there.
+      found = active or exists(destpath)
+
+    if found and self.ExistsCache is not None:
+      self.ExistsCache.Add(hash)
+    return found
+
+  def CollectGarbage(self, Keep, GracePeriod=None, Workers=None):
+    '''
+    Moves every object whose hash is not in the iterable Keep to a new
+    Trash/<RandomName32>/ directory.  Objects ingested less than GracePeriod
+    seconds before the call are kept regardless.  Writers may keep running.
+    Returns a dict of statistics.  Raises Error if the database has packs.
+    '''
+    self._checkopen()
+    from .collect import GarbageCollector, GRACE_PERIOD
+    if GracePeriod is None:
+      GracePeriod = GRACE_PERIOD
+    return GarbageCollector(self, GracePeriod, Workers).Run(Keep)
+
+  def Scrub(self, Rate=None, Workers=None, Resume=True):
+    '''
+    Rehashes every object in Data/, reading at most Rate bytes per second,
+    and moves the ones that do not match their name to Corrupt/.  Packed
+    objects are rehashed too, and only reported.  Resumes an interrupted
+    scrub unless Resume is False.  Returns a dict of statistics.
+    '''
+    self._checkopen()
+    from .scrub import Scrubber
+    return Scrubber(self, Rate, Workers).Run(Resume)
+
+  def Evict(self, MaxBytes=None, MaxObjects=None, LowWater=None, Pinned=None, Replicated=None, GracePeriod=None, Workers=None):
+    '''
+    If Data/ holds more than MaxBytes or MaxObjects, moves the least
+    recently used objects to a new Trash/<RandomName32>/ directory until it
+    is under LowWater times both caps.  Objects in Pinned, ingested less
+    than GracePeriod seconds ago, still in the replication queue, or for
+    which Replicated(hash) is false are kept.  Returns a dict of statistics.
+    Raises Error if the database has packs.
+    '''
+    self._checkopen()
+    from .evict import Evictor, LOW_WATER, GRACE_PERIOD
+    if LowWater is None:
+      LowWater = LOW_WATER
+    if GracePeriod is None:
+      GracePeriod = GRACE_PERIOD
+    return Evictor(self, MaxBytes, MaxObjects, LowWater, Pinned, Replicated, GracePeriod, Workers).Run()
+
+  def Derive(self, hash, Spec, Make):
+    '''
+    Returns the hash of the object derived from hash by Spec (any JSON
+    value describing the transform).  Make(hash) makes, stores and returns
+    it, and is only called if the DeriveCache does not have it.  Without a
+    DeriveCache, concurrent calls on this host for the same hash and Spec
+    still call Make only once.
+    '''
+    self._checkopen()
+    if self.DeriveCache is not None:
+      return self.DeriveCache.Derive(hash, Spec, Make)
+    from .derive import DeriveKey
+    key = DeriveKey(self, hash, Spec).hex()
+    with self._deriveflights().Hold([key]) as flight:
+      derived = flight.Results.get(key)
+      if derived is None:
+        derived = Make(hash)
+        flight.Publish(key, derived)
+    return derived
+
+  def _deriveflights(self):
+    # FileStruct.flight.Flights of Derive() and DeriveImages()
+    if self.DeriveCache is not None:
+      return self.DeriveCache.Flights
+    if self._flightsderive is None:
+      from .flight import Flights
+      self._flightsderive = Flights(self)
+    return self._flightsderive
+
+  def DeriveImages(self, hash, Outputs):
+    '''
+    Returns the hashes of the images made from hash as described by
+    Outputs (as for TempDir.convert_multi, without DestFileName).  Those in
+    the DeriveCache are not made again; the rest are made together by one
+    image job, and concurrent requests for them on this host wait for
+    it instead of making their own, with or without a DeriveCache.
+    '''
+    self._checkopen()
+    specs = []
+    for output in Outputs:
+      spec = dict(output, Op='convert')
+      spec.pop('DestFileName', None)
+      if 'Normalize' in spec:
+        spec['Normalize'] = [int(n) for n in spec['Normalize']]
+      if spec.get('Quality') is not None:
+        spec['Quality'] = int(spec['Quality'])
+      specs.append(spec)
+
+    if self.DeriveCache is not None:
+      hashes = [self.DeriveCache.Lookup(hash, spec) for spec in specs]
+    else:
+      hashes = [None] * len(specs)
+    missing = [i for i, derived in enumerate(hashes) if derived is None]
+    if not missing:
+      return hashes
+
+    from .derive import DeriveKey
+    keys = dict((i, DeriveKey(self, hash, specs[i]).hex()) for i in missing)
+    with self._deriveflights().Hold(keys.values()) as flight:
+      # Made by the workers we waited for?
+      for i in missing:
+        hashes[i] = flight.Results.get(keys[i])
+        if hashes[i] is None and self.DeriveCache is not None:
+          hashes[i] = self.DeriveCache.Stored(hash, specs[i])
+      missing = [i for i, derived in enumerate(hashes) if derived is None]
+      if missing:
+        self._deriveimages(hash, specs, hashes, missing)
+        for i in missing:
+          flight.Publish(keys[i], hashes[i])
+    return hashes
 
-    if exists(destpath):
+  def _deriveimages(self, hash, specs, hashes, missing):
+    outputs = []
+    for i in missing:
+      output = dict(specs[i], DestFileName='output-{0}'.format(i))
+      del(output['Op'])
+      outputs.append(output)
+    with self.TempDir() as TD:
+      TD['source'].Link(hash)
+      made = TD.convert_multi('source', outputs)
+    pass#with
+
+    for i, derived in zip(missing, made):
+      hashes[i] = derived
+      if self.DeriveCache is not None:
+        self.DeriveCache.Put(hash, specs[i], derived)
+    return hashes
+
+  def _fetch(self, hash):
+    '''
+    Copies hash from the Backend into Data/.  Returns False if the backend
+    does not have it either.  Raises Error if what the backend returns does
+    not hash to hash.
+    '''
+    if exists(self.HashToPath(hash)) or (self.Pack is not None and hash in self.Pack):
+      # Fetched by a flight that finished just before this one started
+      return True
+
+    try:
+      stream = self.Backend.GetStream(hash)
+    except KeyError:
+      return False
+
+    hasher = self.NewHash()
+    with stream:
+      with self._tempfile() as (path, output):
+        StreamCopy(stream, output, hasher, self.ChunkSize)
+        if hasher.hexdigest() != hash:
+          raise Error("Object '{0}' from backend is corrupt, its content hashes to {1}".format(hash, hasher.hexdigest()))
+        # Not Checked: another process may have fetched it meanwhile
+        self._ingestfile(path, hash, output.fileno())
+    pass#with
+    return True
+
+  def _ingestfile(self, sourcepath, hash, fd=None, Checked=False):
+    '''
+    Moves the file at sourcepath into Data/ as hash, or deletes it if that
+    content is already stored.  fd, if given, is an
+    open descriptor of that file, used instead of the path for the group,
+    mode and size.  Checked means the caller has just called _dedup() and
+    found nothing, after hashing data it wrote itself: if another writer
+    stores the same content meanwhile, the rename replaces it with an
+    identical file.
+    '''
+    destpath = self.HashToPath(hash)
+
+    if not Checked and self._dedup(hash):
+      os.unlink(sourcepath)
       return
-    
-    if not isdir(dirname(dirname(destpath))):
-      self._mkdir(dirname(dirname(destpath)))
 
-    if not isdir(dirname(destpath)):
-      self._mkdir(dirname(destpath))
+    if self.Pack is not None:
+      size = os.fstat(fd).st_size if fd is not None else os.stat(sourcepath).st_size
+      if size <= self.PackThreshold:
+        with open(sourcepath, 'rb') as f:
+          self._putpacked(hash, f.read())
+        os.unlink(sourcepath)
+        return
     
-    # Set the file group to the database group
-    os.chown(sourcepath, -1, self.DatabaseGroup.gr_gid)
-
-    # Set perms to r--r--r-- (or 444)
-    os.chmod(sourcepath, (stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH))
+    self._makeshard(hash)
     
+    # Set the file group to the database group, and perms to r--r--r-- (or 444)
+    mode = stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH
+    if fd is not None:
+      os.fchown(fd, -1, self.DatabaseGroup.gr_gid)
+      os.fchmod(fd, mode)
+    else:
+      os.chown(sourcepath, -1, self.DatabaseGroup.gr_gid)
+      os.chmod(sourcepath, mode)
+    
+    if self.Index is not None or self.Compressor is not None:
+      size = os.fstat(fd).st_size if fd is not None else os.stat(sourcepath).st_size
+
+    # The contents must be on disk before the name is
+    if self.Durability != 'none':
+      self._syncfile(sourcepath, fd)
+
     # Move it into the DB dir
-    os.rename(sourcepath, destpath)
+    try:
+      os.rename(sourcepath, destpath)
+    except FileNotFoundError:
+      # The shard directory was removed behind our back
+      if not exists(sourcepath):
+        raise
+      self._makeshard(hash, Force=True)
+      os.rename(sourcepath, destpath)
+
+    if self.GroupCommit is not None:
+      self.GroupCommit.SyncDir(os.path.dirname(destpath))
+
+    if self.Index is not None:
+      self.Index.Append(hash, size)
+
+    if self.ReplicationQueue is not None:
+      self.ReplicationQueue.Append(hash)
+
+    if self.Compressor is not None and size >= self.Compressor.MinSize:
+      self.Compressor.Submit(hash)
+
+    if self.ExistsCache is not None:
+      self.ExistsCache.Add(hash)
     
 
 
@@ -239,6 +1227,7 @@ class TempDir():
       with open(join(self.Path, 'Python-Exception.txt'), 'wt', encoding='utf-8') as ef:
         ef.write(FormatException(exc_value))
       
+    import shutil
     if exc_type is not None or self.Retain:
       shutil.move(self.Path, self.Client.ErrorPath)
     else:
@@ -250,35 +1239,25 @@ class TempDir():
     return TempFile(self, join(self.Path, FileName))
   
   def convert_resize(self, SourceFileName, DestFileName, SizeSpec):
-    cmd = (
-      self.Client.bin_convert,
-      self[SourceFileName].Path,
-      '-resize', SizeSpec,
-      self[DestFileName].Path,
-      )
-
-    try:
-      subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-      raise Error(e.output)
+    self.Client.Images.Run(self[SourceFileName].Path, [{'Path': self[DestFileName].Path, 'Resize': SizeSpec}])
 
   def convert_normalize(self, SourceFileName, DestFileName, Width, Height):
-    Width = int(Width)
-    Height = int(Height)
-
-    cmd = (
-      self.Client.bin_convert,
-      self[SourceFileName].Path,
-      '-resize', '{0}x{1}^'.format(Width, Height),
-      '-gravity', 'center',
-      '-extent', '{0}x{1}'.format(Width, Height),
-      self[DestFileName].Path,
-      )
+    self.Client.Images.Run(self[SourceFileName].Path, [{'Path': self[DestFileName].Path, 'Normalize': (Width, Height)}])
 
-    try:
-      subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-      raise Error(e.output)
+  def convert_multi(self, SourceFileName, Outputs):
+    '''
+    Makes every output in Outputs from a single decode of SourceFileName,
+    as one job of the client's ImageService, then ingests them all.
+    Returns their hashes, in the same order.
+
+    Each output is a dict of DestFileName and either Resize (a size spec,
+    as for convert_resize) or Normalize ((Width, Height), as for
+    convert_normalize), and optionally Quality (1-100) and Format (e.g.
+    'webp', instead of going by the DestFileName extension).
+    '''
+    Outputs = list(Outputs)
+    self.Client.Images.Run(self[SourceFileName].Path, [dict(output, Path=self[output['DestFileName']].Path) for output in Outputs])
+    return [self[output['DestFileName']].Ingest() for output in Outputs]
 
 
 class BaseFile():
@@ -293,42 +1272,108 @@ class BaseFile():
     with self.GetStream() as stream:
       return stream.read()
 
+  def GetRange(self, Offset, Length):
+    '''
+    Returns up to Length bytes starting at Offset, read with os.pread so
+    that nothing else is read or copied.  Short only at the end of the file.
+    '''
+    Offset, Length = int(Offset), int(Length)
+    if Offset < 0 or Length < 0:
+      raise ValueError('Offset and Length must not be negative: {0}, {1}'.format(Offset, Length))
+    fd = os.open(self.Path, os.O_RDONLY)
+    try:
+      # pread may return less than asked for before the end of the file
+      chunks = []
+      while Length:
+        chunk = os.pread(fd, Length, Offset)
+        if not chunk:
+          break
+        chunks.append(chunk)
+        Offset += len(chunk)
+        Length -= len(chunk)
+      return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+    finally:
+      os.close(fd)
+
 
 class HashFile(BaseFile):
   def __init__(self, Client, Path, Hash):
     super().__init__(Client, Path)
     self.Hash = Hash
 
+  def GetData(self):
+    cache = self.Client.ObjectCache
+    if cache is None:
+      return super().GetData()
+    data = cache.Get(self.Hash)
+    if data is None:
+      data = super().GetData()
+      cache.Add(self.Hash, data)
+    return data
+
+  def GetView(self):
+    '''
+    Returns a read-only memoryview of the whole object, backed by mmap.
+    Objects never change, so the view may be shared between threads; the
+    mapping is released when the last reference to the view is gone.
+    '''
+    with open(self.Path, 'rb', buffering=0) as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        # mmap cannot map an empty file
+        return memoryview(b'')
+      return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
   @property
   def InternalURI(self):
     return self.Client.HashToInternalURI(self.Hash)
 
 
+class PackedFile(HashFile):
+  '''
+  An object stored in a pack (see FileStruct.pack).  It has no file, so
+  Path and InternalURI are None.
+  '''
+  def __init__(self, Client, Hash, Location):
+    super().__init__(Client, None, Hash)
+    self.Location = Location
+
+  def GetStream(self):
+    return io.BytesIO(self.GetData())
+
+  def GetData(self):
+    return self.Client.Pack.Read(self.Location)
+
+  def GetRange(self, Offset, Length):
+    Offset, Length = int(Offset), int(Length)
+    if Offset < 0 or Length < 0:
+      raise ValueError('Offset and Length must not be negative: {0}, {1}'.format(Offset, Length))
+    return self.Client.Pack.Read(self.Location, Offset, Length)
+
+  def GetView(self):
+    return memoryview(self.GetData())
+
+  @property
+  def InternalURI(self):
+    return None
+
+
 class TempFile(BaseFile):
   def __init__(self, TempDir, Path):
     super().__init__(TempDir.Client, Path)
     self.TempDir = TempDir
   
   def Ingest(self):
-    sha1 = hashlib.sha1()
+    hasher = self.Client.NewHash()
     with open(self.Path, 'rb', buffering=0) as f:
-      while True:
-        buf = f.read(4096)
-        if not buf:
-          break
-        sha1.update(buf)
+      StreamCopy(f, None, hasher, self.Client.ChunkSize)
     
-    hash = sha1.hexdigest()
-    self.Client._ingestfile(self.Path, hash)
+      hash = hasher.hexdigest()
+      self.Client._ingestfile(self.Path, hash, f.fileno())
     return hash
 
   def PutStream(self, stream):
     with open(self.Path, 'wb', buffering=0) as f:
-      while True:
-        buf = stream.read(4096)
-        if not buf:
-          break
-        f.write(buf)
+      StreamCopy(stream, f, None, self.Client.ChunkSize)
 
   def PutData(self, data):
     stream = io.BytesIO(data)
@@ -339,7 +1384,12 @@ class TempFile(BaseFile):
       return self.PutStream(stream)
   
   def Link(self, hash):
-    os.symlink(self.Client[hash].Path, self.Path)
+    file = self.Client[hash]
+    if file.Path is None:
+      # Packed, there is no file to link to
+      self.PutData(file.GetData())
+    else:
+      os.symlink(file.Path, self.Path)
 
   def Delete(self):
     os.unlink(self.Path)
@@ -0,0 +1,364 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Persistent cache of derived objects (thumbnails, conversions), for
+Client(DeriveCache=True): (source hash, transform spec) -> derived hash.
+
+  Derive/Derived.idx  sorted fixed size records of (key, source, derived)
+                      binary digests, where key is the hash of the source
+                      digest and the normalized spec
+  Derive/Journal.log  the same records, appended as entries are added
+  Derive/Lock         flock(2) target; appenders and readers hold it
+                      shared, Compact() exclusive
+
+A spec is any JSON value describing the transform.  It is normalized
+(sorted keys, no whitespace), so equal specs give the same key.  A hit
+costs a dict lookup or a binary search in the mmap'ed index, plus a stat to
+check that the derived object is still stored, and never starts a process.
+Concurrent misses for the same entry, in any process on the host, are made
+once: the others wait for it (see FileStruct.flight).
+
+Garbage collection keeps a derived object only if Keep lists it, like any
+other object, and drops the entries whose source or derived object is
+collected or evicted (see FileStruct.collect).
+
+  python -m FileStruct.derive {compact,stats} /path/to/database
+'''
+
+from os.path import join
+import argparse
+import bisect
+import fcntl
+import json
+import mmap
+import os
+import sys
+import threading
+
+from .flight import Flights
+
+# Journal size (bytes) after which Put() compacts the index
+COMPACT_SIZE = 1024 * 1024
+
+# Marks the loaded state as unknown, forcing a reload
+_UNKNOWN = object()
+
+
+def NormalizeSpec(Spec):
+  '''
+  Returns the canonical JSON text of Spec.
+  '''
+  return json.dumps(Spec, sort_keys=True, separators=(',', ':'))
+
+
+def DeriveKey(Client, hash, Spec):
+  '''
+  Returns the binary key of (hash, Spec): the hash of the source digest
+  and the normalized spec.
+  '''
+  return Client.NewHash(bytes.fromhex(hash) + NormalizeSpec(Spec).encode('utf-8')).digest()
+
+
+class _Records():
+  # Sequence view over the keys in a mapped Derived.idx, for bisect
+  def __init__(self, mm, DigestSize):
+    self.mm = mm
+    self.DigestSize = DigestSize
+    self.RecordSize = DigestSize * 3
+    self.Count = len(mm) // self.RecordSize if mm is not None else 0
+
+  def __len__(self):
+    return self.Count
+
+  def __getitem__(self, i):
+    start = i * self.RecordSize
+    return self.mm[start:start+self.DigestSize]
+
+  def Entry(self, i):
+    # (source, derived) of record i
+    start = i * self.RecordSize + self.DigestSize
+    return self.mm[start:start+self.DigestSize], self.mm[start+self.DigestSize:start+2*self.DigestSize]
+
+  def Get(self, key):
+    i = bisect.bisect_left(self, key)
+    if i < self.Count and self[i] == key:
+      return self.Entry(i)
+    return None
+
+
+class DeriveCache():
+  def __init__(self, Client, CompactSize=COMPACT_SIZE):
+    self.Client = Client
+    self.Path = Client.DerivePath
+    self.DigestSize = Client.DigestSize
+    self.RecordSize = self.DigestSize * 3
+    self.CompactSize = CompactSize
+    self.IndexPath = join(self.Path, 'Derived.idx')
+    self.JournalPath = join(self.Path, 'Journal.log')
+    self.LockPath = join(self.Path, 'Lock')
+    self.Counters = {'Hits': 0, 'Misses': 0}
+    self.Flights = Flights(Client)
+
+    self._lock = threading.RLock()
+    self._lockfd = os.open(self.LockPath, os.O_RDWR | os.O_CREAT, 0o664)
+    self._records = _Records(None, self.DigestSize)
+    self._indexid = _UNKNOWN
+    self._journalid = _UNKNOWN
+    self._journaloffset = 0
+    # key -> (source, derived) from the journal
+    self._added = {}
+    self.Refresh()
+
+  def close(self):
+    with self._lock:
+      self._records = _Records(None, self.DigestSize)
+      if self._lockfd is not None:
+        os.close(self._lockfd)
+        self._lockfd = None
+
+  def _fileid(self, path):
+    try:
+      st = os.stat(path)
+    except FileNotFoundError:
+      return None
+    return (st.st_dev, st.st_ino)
+
+  def Key(self, hash, Spec):
+    '''
+    Returns the binary key of (hash, Spec).
+    '''
+    return DeriveKey(self.Client, hash, Spec)
+
+
+  #============================================================================
+  # Reading
+
+  def Refresh(self):
+    '''
+    Picks up entries added by other clients and processes, and reopens
+    Derived.idx if it was rewritten.
+    '''
+    with self._lock:
+      fcntl.flock(self._lockfd, fcntl.LOCK_SH)
+      try:
+        self._reload()
+      finally:
+        fcntl.flock(self._lockfd, fcntl.LOCK_UN)
+
+  def _reload(self, Full=False):
+    # Caller holds the lock (shared or exclusive)
+    if Full:
+      self._indexid = _UNKNOWN
+
+    indexid = self._fileid(self.IndexPath)
+    if indexid != self._indexid:
+      self._records = _Records(None, self.DigestSize)
+      self._indexid = indexid
+      # The journal is only ever removed together with a new index
+      self._journalid = _UNKNOWN
+      if indexid is not None:
+        with open(self.IndexPath, 'rb') as f:
+          if os.fstat(f.fileno()).st_size:
+            self._records = _Records(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), self.DigestSize)
+
+    journalid = self._fileid(self.JournalPath)
+    if journalid != self._journalid:
+      self._journalid = journalid
+      self._journaloffset = 0
+      self._added = {}
+    if journalid is not None:
+      with open(self.JournalPath, 'rb') as f:
+        f.seek(self._journaloffset)
+        data = f.read()
+      # A trailing partial record is picked up next time
+      end = len(data) - len(data) % self.RecordSize
+      self._journaloffset += end
+      size = self.DigestSize
+      for i in range(0, end, self.RecordSize):
+        self._added[data[i:i+size]] = (data[i+size:i+2*size], data[i+2*size:i+3*size])
+
+  def _lookup(self, key):
+    found = self._added.get(key)
+    if found is None:
+      found = self._records.Get(key)
+    return found
+
+  def Get(self, hash, Spec):
+    '''
+    Returns the hash derived from hash by Spec, or None.  The derived
+    object may have been removed since.
+    '''
+    key = self.Key(hash, Spec)
+    with self._lock:
+      found = self._lookup(key)
+      if found is None:
+        self.Refresh()
+        found = self._lookup(key)
+    return found[1].hex() if found is not None else None
+
+  def Entries(self):
+    '''
+    Returns a list of (source, derived) binary digests of every entry.
+    '''
+    with self._lock:
+      self.Refresh()
+      entries = dict((self._records[i], self._records.Entry(i)) for i in range(len(self._records)))
+      entries.update(self._added)
+    return list(entries.values())
+
+
+  #============================================================================
+  # Writing
+
+  def Put(self, hash, Spec, Derived):
+    '''
+    Records that Spec applied to hash gives Derived.
+    '''
+    key = self.Key(hash, Spec)
+    source = bytes.fromhex(hash)
+    derived = bytes.fromhex(Derived)
+    with self._lock:
+      fcntl.flock(self._lockfd, fcntl.LOCK_SH)
+      try:
+        fd = os.open(self.JournalPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+          os.write(fd, key + source + derived)
+          size = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+          os.close(fd)
+      finally:
+        fcntl.flock(self._lockfd, fcntl.LOCK_UN)
+      # Read again with the rest of the journal, which is harmless
+      self._added[key] = (source, derived)
+
+    if self.CompactSize and size >= self.CompactSize:
+      self.Compact(Wait=False)
+
+  def Lookup(self, hash, Spec):
+    '''
+    Returns the hash derived from hash by Spec if it is cached and still
+    stored, otherwise None.  Counted as a hit or a miss.
+    '''
+    derived = self.Stored(hash, Spec)
+    with self._lock:
+      self.Counters['Hits' if derived is not None else 'Misses'] += 1
+    return derived
+
+  def Stored(self, hash, Spec):
+    '''
+    Like Lookup(), but not counted.
+    '''
+    derived = self.Get(hash, Spec)
+    if derived is not None and derived not in self.Client:
+      return None
+    return derived
+
+  def Derive(self, hash, Spec, Make):
+    '''
+    Returns the hash derived from hash by Spec: the cached one if it is
+    still stored, otherwise the one returned by Make(hash), which is then
+    cached.  Only one of the callers that miss at the same time calls Make.
+    '''
+    derived = self.Lookup(hash, Spec)
+    if derived is None:
+      key = self.Key(hash, Spec).hex()
+      with self.Flights.Hold([key]) as flight:
+        # Made by the worker we waited for?
+        derived = flight.Results.get(key) or self.Stored(hash, Spec)
+        if derived is None:
+          derived = Make(hash)
+          self.Put(hash, Spec, derived)
+          flight.Publish(key, derived)
+    return derived
+
+  def Compact(self, Drop=None, Wait=True):
+    '''
+    Merges the journal into Derived.idx, leaving out the entries for which
+    Drop(source, derived) (binary digests) is true.  Returns False if Wait
+    is False and another compaction holds the lock.
+    '''
+    # The thread lock is always taken before the file lock, as in Refresh()
+    # and Put()
+    with self._lock:
+      # A separate descriptor, since flock() locks are per open file
+      fd = os.open(self.LockPath, os.O_RDWR)
+      try:
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX | (0 if Wait else fcntl.LOCK_NB))
+        except BlockingIOError:
+          return False
+        self._reload(Full=True)
+        entries = dict((self._records[i], self._records.Entry(i)) for i in range(len(self._records)))
+        entries.update(self._added)
+
+        tmppath = self.IndexPath + '.tmp'
+        with open(tmppath, 'wb') as f:
+          for key in sorted(entries):
+            source, derived = entries[key]
+            if Drop is None or not Drop(source, derived):
+              f.write(key + source + derived)
+          f.flush()
+          os.fsync(f.fileno())
+        os.chmod(tmppath, 0o664)
+        os.rename(tmppath, self.IndexPath)
+        try:
+          os.unlink(self.JournalPath)
+        except FileNotFoundError:
+          pass
+        self._reload(Full=True)
+        return True
+      finally:
+        os.close(fd)
+
+  def Stats(self):
+    with self._lock:
+      stats = dict(self.Counters)
+      stats.update(('Flights' + key, value) for key, value in self.Flights.Stats().items())
+      stats.update({
+        'Records': len(self._records),
+        'JournalAdded': len(self._added),
+        'JournalBytes': self._journaloffset,
+        })
+      return stats
+
+
+def main(argv=None):
+  from .core import Client
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.derive')
+  parser.add_argument('command', choices=('compact', 'stats'))
+  parser.add_argument('path', help='Database directory')
+  args = parser.parse_args(argv)
+
+  client = Client(args.path, DeriveCache=True)
+  if args.command == 'compact':
+    client.DeriveCache.Compact()
+  stats = client.DeriveCache.Stats()
+  for key in sorted(stats):
+    sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'DeriveCache',
+  'DeriveKey',
+  'NormalizeSpec',
+  )
@@ -0,0 +1,171 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Group commit for Client(Durability='directory').
+
+Every ingest has to wait twice: until its data is on disk (before the
+rename, so a name never points at incomplete content) and until its
+directory entry is (after the rename).  Instead of an fsync per file and
+per directory, waiting threads queue up and a single commit thread flushes
+everything queued so far at once, then wakes them all.  While one flush
+runs the next batch collects, so the batch size follows the load and a
+lone writer does not wait for company.
+
+On Linux a flush is one syncfs(2) call for the whole filesystem.  Where
+that is not available, each file in the batch is fsync'ed and each
+distinct directory once.
+'''
+
+import os
+import threading
+
+
+def _syncfs():
+  # libc's syncfs(), or None
+  try:
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    syncfs = libc.syncfs
+  except (ImportError, OSError, AttributeError):
+    return None
+  syncfs.argtypes = (ctypes.c_int,)
+
+  def call(fd):
+    if syncfs(fd) != 0:
+      e = ctypes.get_errno()
+      raise OSError(e, os.strerror(e))
+  return call
+
+
+class _Request():
+  __slots__ = ('fd', 'dir', 'event', 'error')
+
+  def __init__(self, fd, dir):
+    self.fd = fd
+    self.dir = dir
+    self.event = threading.Event()
+    self.error = None
+
+
+class GroupCommit():
+  def __init__(self, Path, SyncFS=True):
+    '''
+    Path is any directory on the filesystem to be flushed (the database).
+    SyncFS=False always uses per-file and per-directory fsync.
+    '''
+    self.Path = Path
+    self.SyncFS = _syncfs() if SyncFS else None
+    self.Commits = 0
+    self.Requests = 0
+    self._cond = threading.Condition()
+    self._pending = []
+    self._pid = None
+    self._thread = None
+
+  def SyncFile(self, fd):
+    '''
+    Returns once the contents of the open file fd are on stable storage.
+    '''
+    self._wait(_Request(fd, None))
+
+  def SyncDir(self, dir):
+    '''
+    Returns once the entries of directory dir are on stable storage.
+    '''
+    self._wait(_Request(None, dir))
+
+  def _wait(self, request):
+    with self._cond:
+      if self._pid != os.getpid():
+        # First use, or first use in a forked child: threads do not survive fork
+        self._pending = []
+        self._thread = threading.Thread(target=self._run, name='FileStruct-GroupCommit', daemon=True)
+        self._thread.start()
+        self._pid = os.getpid()
+      self._pending.append(request)
+      self._cond.notify()
+    request.event.wait()
+    if request.error is not None:
+      raise request.error
+
+  def close(self):
+    '''
+    Stops the flushing thread once it is done with what it was given.  A
+    later request starts a new one.
+    '''
+    with self._cond:
+      if self._thread is not None and self._pid == os.getpid():
+        # None in the queue tells the thread to stop
+        self._pending.append(None)
+        self._cond.notify()
+      self._pid = None
+      self._thread = None
+
+  def _run(self):
+    while True:
+      with self._cond:
+        while not self._pending:
+          self._cond.wait()
+        batch, self._pending = self._pending, []
+      stop = None in batch
+      batch = [request for request in batch if request is not None]
+
+      if batch:
+        try:
+          self._flush(batch)
+          error = None
+        except OSError as e:
+          error = e
+
+        self.Commits += 1
+        self.Requests += len(batch)
+        for request in batch:
+          request.error = error
+          request.event.set()
+      if stop:
+        return
+
+  def _flush(self, batch):
+    if self.SyncFS is not None:
+      fd = os.open(self.Path, os.O_RDONLY)
+      try:
+        self.SyncFS(fd)
+      finally:
+        os.close(fd)
+      return
+
+    dirs = set()
+    for request in batch:
+      if request.fd is not None:
+        os.fsync(request.fd)
+      else:
+        dirs.add(request.dir)
+    for dir in dirs:
+      fd = os.open(dir, os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
+
+  def Stats(self):
+    return {'Commits': self.Commits, 'Requests': self.Requests}
+
+
+__all__ = (
+  'GroupCommit',
+  )
@@ -0,0 +1,369 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Cache mode: keeps Data/ under a size and/or object count cap by moving the
+least recently used objects to Trash/<RandomName32>/.
+
+Nothing happens while Data/ is under the caps.  Once it is over either one,
+the coldest objects are evicted in one batch until it is under LowWater
+times both of them, so that the next run does not follow right away.
+
+An object was last used at the latest of its ctime (when it was ingested),
+its atime (if the filesystem keeps them) and its last entry in the access
+log.  With Client(AccessLog=True), client[hash] adds the hash to an
+in-memory set, which is appended to Temp/Access.log as one write of fixed
+size (time, digest) records every FLUSH_INTERVAL seconds.  A run retires
+the log and keeps what it learned in Temp/Access.state.
+
+Objects that are pinned, were ingested within GracePeriod, or are not yet
+replicated are never evicted.  If the database has a Replicate/ directory,
+its queue is read on every run, whether or not the Client was created with
+ReplicationQueue=True, and a queue that cannot be read stops the run.
+Eviction shares the lock and the keep log of garbage collection
+(FileStruct.collect), so writers that deduplicate against an object while
+it is being evicted get it back, and like it refuses databases with packs.
+
+Like the garbage collector, a run does not hold the whole database in
+memory: the access times are split into one file per Data/xx shard, each
+shard is written out as a sorted run of fixed size records, and the runs
+are merged coldest first.
+
+  python -m FileStruct.evict /path/to/database --max-bytes 100G
+'''
+
+from os.path import join, exists, isdir
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import fcntl
+import heapq
+import os
+import struct
+import sys
+import threading
+import time
+
+from .core import Error
+from .collect import GarbageCollector
+from .scan import IterShard
+from .compress import MoveSidecars
+
+
+# Objects ingested within this many seconds are never evicted
+GRACE_PERIOD = 600
+
+# A run evicts down to this fraction of the caps
+LOW_WATER = 0.9
+
+# The access log is appended to at most this often per process, or when
+# this many distinct hashes are waiting
+FLUSH_INTERVAL = 60
+FLUSH_MAX = 4096
+
+_STAMP = struct.Struct('<I')
+
+# Per object record of a sweep: last used, size, ctime, last access logged
+_OBJECT = struct.Struct('<dQdI')
+
+# Records read at a time from the work files
+_READ_RECORDS = 4096
+
+
+def ReadAccessLog(Path, DigestSize):
+  '''
+  Returns {hash: time} from an access log or state file, latest time per
+  hash.
+  '''
+  times = {}
+  try:
+    with open(Path, 'rb') as f:
+      data = f.read()
+  except FileNotFoundError:
+    return times
+  size = _STAMP.size + DigestSize
+  # A torn last record (a writer that died mid-write) is ignored
+  for i in range(0, len(data) - size + 1, size):
+    stamp, = _STAMP.unpack_from(data, i)
+    hash = data[i+_STAMP.size:i+size].hex()
+    if stamp > times.get(hash, 0):
+      times[hash] = stamp
+  return times
+
+
+def _readrecords(Path, Size):
+  # Yields the fixed size records of a file, a few thousand at a time
+  try:
+    f = open(Path, 'rb')
+  except FileNotFoundError:
+    return
+  with f:
+    while True:
+      data = f.read(Size * _READ_RECORDS)
+      # A torn last record (a writer that died mid-write) is ignored
+      for i in range(0, len(data) - Size + 1, Size):
+        yield data[i:i+Size]
+      if len(data) < Size * _READ_RECORDS:
+        return
+
+
+def _writelog(Path, times):
+  data = b''.join(_STAMP.pack(int(stamp)) + bytes.fromhex(hash) for hash, stamp in times.items())
+  with open(Path, 'wb') as f:
+    f.write(data)
+
+
+class AccessLog():
+  def __init__(self, Client, FlushInterval=FLUSH_INTERVAL, FlushMax=FLUSH_MAX):
+    self.Path = join(Client.TempPath, 'Access.log')
+    self.Group = Client.DatabaseGroup.gr_gid
+    self.FlushInterval = FlushInterval
+    self.FlushMax = FlushMax
+    self._pending = set()
+    self._last = time.monotonic()
+    self._lock = threading.Lock()
+
+  def Record(self, hash):
+    with self._lock:
+      self._pending.add(hash)
+      now = time.monotonic()
+      if len(self._pending) < self.FlushMax and now - self._last < self.FlushInterval:
+        return
+      pending, self._pending = self._pending, set()
+      self._last = now
+    self._write(pending)
+
+  def Flush(self):
+    '''
+    Appends everything recorded so far to the log now.
+    '''
+    with self._lock:
+      pending, self._pending = self._pending, set()
+      self._last = time.monotonic()
+    self._write(pending)
+
+  def _write(self, hashes):
+    if not hashes:
+      return
+    stamp = _STAMP.pack(int(time.time()))
+    data = b''.join(stamp + bytes.fromhex(hash) for hash in hashes)
+
+    try:
+      fd = os.open(self.Path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+      fd = os.open(self.Path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+      try:
+        os.fchown(fd, -1, self.Group)
+        os.fchmod(fd, 0o664)
+      except PermissionError:
+        # Somebody else created it first
+        pass
+    try:
+      # Shared with other writers, exclusive for the evictor retiring it.
+      # Records that miss the retired log only cost some recency.
+      fcntl.flock(fd, fcntl.LOCK_SH)
+      os.write(fd, data)
+    finally:
+      os.close(fd)
+
+
+class Evictor(GarbageCollector):
+  def __init__(self, Client, MaxBytes=None, MaxObjects=None, LowWater=LOW_WATER, Pinned=None, Replicated=None, GracePeriod=GRACE_PERIOD, Workers=None):
+    '''
+    Pinned is a container of hashes that are never evicted.  Replicated is
+    called with a hash and must return True only if the object can be
+    fetched again from elsewhere.  Without it, Client.Backend.Contains is
+    used if there is no replication queue; without either, every object is
+    assumed to be disposable.  Objects pending in the replication queue
+    (FileStruct.replicate) of the database are never evicted either way.
+    '''
+    if MaxBytes is None and MaxObjects is None:
+      raise ValueError('Give MaxBytes, MaxObjects or both.')
+    if not 0 < LowWater <= 1:
+      raise ValueError('LowWater must be in (0, 1]: {0}'.format(LowWater))
+    super(Evictor, self).__init__(Client, GracePeriod, Workers)
+    self.MaxBytes = MaxBytes
+    self.MaxObjects = MaxObjects
+    self.LowWater = LowWater
+    self.Pinned = Pinned if Pinned is not None else ()
+    self.ReplicationQueue = Client.ReplicationQueue
+    if self.ReplicationQueue is None and isdir(Client.ReplicatePath):
+      # Queued objects stay even if this client does not append to the queue
+      from .replicate import ReplicationQueue
+      self.ReplicationQueue = ReplicationQueue(Client)
+    if Replicated is None and self.ReplicationQueue is None and Client.Backend is not None:
+      Replicated = Client.Backend.Contains
+    self.Replicated = Replicated
+    self.Pending = ()
+    self.AccessLogPath = join(Client.TempPath, 'Access.log')
+    self.StatePath = join(Client.TempPath, 'Access.state')
+
+  def Run(self):
+    if self.ReplicationQueue is not None:
+      # Objects queued later are within the grace period
+      try:
+        self.Pending = self.ReplicationQueue.Pending()
+      except (OSError, ValueError, KeyError, TypeError) as e:
+        raise Error("Not evicting: cannot read the replication queue in '{0}': {1}".format(self.ReplicationQueue.Path, str(e)))
+    return super(Evictor, self).Run(None)
+
+  def _mark(self, Keep, WorkPath):
+    # Nothing is kept by name, see _sweepall()
+    pass
+
+  def _readaccess(self, WorkPath):
+    # Splits the state file and the retired log into access-<shard> files
+    paths = [self.StatePath]
+    if exists(self.AccessLogPath):
+      retired = join(WorkPath, 'Access.log')
+      os.rename(self.AccessLogPath, retired)
+      with open(retired, 'rb') as f:
+        # Wait for writers still appending to it
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      paths.append(retired)
+
+    buckets = {}
+    try:
+      for path in paths:
+        for record in _readrecords(path, _STAMP.size + self.DigestSize):
+          shard = record[_STAMP.size:_STAMP.size+1].hex()
+          bucket = buckets.get(shard)
+          if bucket is None:
+            bucket = buckets[shard] = open(join(WorkPath, 'access-' + shard), 'wb')
+          bucket.write(record)
+    finally:
+      for bucket in buckets.values():
+        bucket.close()
+
+  def _statshard(self, WorkPath, shard):
+    # Writes Data/<shard>/*/* to objects-<shard>, coldest first, and returns
+    # (count, bytes)
+    times = ReadAccessLog(join(WorkPath, 'access-' + shard), self.DigestSize)
+    records = []
+    for entry in IterShard(self.Client.DataPath, shard, self.Client.HashLength):
+      try:
+        st = entry.stat(follow_symlinks=False)
+      except FileNotFoundError:
+        continue
+      accessed = times.get(entry.name, 0)
+      records.append((max(st.st_ctime, st.st_atime, accessed), st.st_size, st.st_ctime, accessed, bytes.fromhex(entry.name)))
+    records.sort()
+    with open(join(WorkPath, 'objects-' + shard), 'wb') as f:
+      f.write(b''.join(_OBJECT.pack(*record[:4]) + record[4] for record in records))
+    return len(records), sum(record[1] for record in records)
+
+  def _objects(self, WorkPath, shard):
+    # Yields (lastused, size, ctime, accessed, hash) from objects-<shard>
+    for record in _readrecords(join(WorkPath, 'objects-' + shard), _OBJECT.size + self.DigestSize):
+      yield _OBJECT.unpack_from(record) + (record[_OBJECT.size:].hex(),)
+
+  def _sweepall(self, WorkPath, TrashPath, Cutoff):
+    shards = ['{0:02x}'.format(i) for i in range(256)]
+    self._readaccess(WorkPath)
+
+    count, size = 0, 0
+    with ThreadPoolExecutor(max_workers=self.Workers) as pool:
+      for shardcount, shardsize in pool.map(lambda shard: self._statshard(WorkPath, shard), shards):
+        count += shardcount
+        size += shardsize
+
+    stats = {'Objects': count, 'Bytes': size, 'Kept': count, 'Trashed': 0, 'TrashedBytes': 0, 'Recent': 0, 'Pinned': 0, 'Unreplicated': 0}
+    trashed = []
+
+    if (self.MaxBytes is not None and size > self.MaxBytes) or (self.MaxObjects is not None and count > self.MaxObjects):
+      maxsize = self.MaxBytes * self.LowWater if self.MaxBytes is not None else float('inf')
+      maxcount = self.MaxObjects * self.LowWater if self.MaxObjects is not None else float('inf')
+
+      runs = [self._objects(WorkPath, shard) for shard in shards]
+      try:
+        for lastused, objsize, ctime, accessed, hash in heapq.merge(*runs):
+          if size <= maxsize and count <= maxcount:
+            break
+          if ctime >= Cutoff:
+            stats['Recent'] += 1
+            continue
+          if hash in self.Pinned:
+            stats['Pinned'] += 1
+            continue
+          if hash in self.Pending or (self.Replicated is not None and not self.Replicated(hash)):
+            stats['Unreplicated'] += 1
+            continue
+          try:
+            os.rename(self.Client.HashToPath(hash), join(TrashPath, hash))
+          except FileNotFoundError:
+            # Removed meanwhile
+            continue
+          MoveSidecars(self.Client.HashToPath(hash), join(TrashPath, hash))
+          size -= objsize
+          count -= 1
+          stats['Trashed'] += 1
+          stats['TrashedBytes'] += objsize
+          trashed.append(hash)
+      finally:
+        for run in runs:
+          run.close()
+      stats['Kept'] -= stats['Trashed']
+
+    # Remember the log for the objects that are left
+    gone = set(trashed)
+    tmppath = self.StatePath + '.tmp'
+    with open(tmppath, 'wb') as f:
+      for shard in shards:
+        f.write(b''.join(_STAMP.pack(int(accessed)) + bytes.fromhex(hash) for lastused, objsize, ctime, accessed, hash in self._objects(WorkPath, shard) if accessed and hash not in gone))
+    os.replace(tmppath, self.StatePath)
+
+    return stats, trashed
+
+
+def main(argv=None):
+  from .core import Client
+  from .bench import ParseSize
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.evict')
+  parser.add_argument('path', help='Database directory')
+  parser.add_argument('--max-bytes', type=ParseSize, default=None, help='Size cap of Data/, e.g. 100G')
+  parser.add_argument('--max-objects', type=int, default=None, help='Object count cap of Data/')
+  parser.add_argument('--low-water', type=float, default=LOW_WATER, help='Evict down to this fraction of the caps')
+  parser.add_argument('--grace-period', type=int, default=GRACE_PERIOD, help='Never evict objects ingested within this many seconds')
+  parser.add_argument('--pinned', default=None, help='File with hashes that are never evicted, one per line')
+  parser.add_argument('--interval', type=float, default=None, help='Run again every this many seconds')
+  args = parser.parse_args(argv)
+  if args.max_bytes is None and args.max_objects is None:
+    parser.error('Give --max-bytes, --max-objects or both.')
+
+  client = Client(args.path)
+  while True:
+    pinned = None
+    if args.pinned:
+      with open(args.pinned, 'r', encoding='ascii') as f:
+        pinned = set(line.strip() for line in f if line.strip())
+    stats = client.Evict(args.max_bytes, args.max_objects, args.low_water, pinned, GracePeriod=args.grace_period)
+    for key in sorted(stats):
+      sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+    sys.stdout.flush()
+    if args.interval is None:
+      return 0
+    time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'Evictor',
+  'AccessLog',
+  'ReadAccessLog',
+  )
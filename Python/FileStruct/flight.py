@@ -0,0 +1,270 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Coordination of expensive work between all the threads and processes of a
+host, with flock(2) on lock files in Temp/ and no server:
+
+  Temp/Flight/<key>.lock        held by the one worker making <key>; the
+                                others wait for it, then find its result
+  Temp/Jobs-<host>/<n>.lock     one per image job slot on this host
+
+The kernel releases the locks of a process that dies, so the next waiter
+takes over from a crashed owner at once.  An owner that hangs is taken over
+after Timeout seconds.
+
+A flight lock file is removed by its owner while still locked.  A waiter
+that then gets the lock on the removed file starts over with a new one, so
+two workers never both believe they own a key.  Before removing it, the
+owner may write its result (a short text, such as a hash) into the file;
+the waiters still have it open, read it from there and need not redo the
+work, and nothing is left behind to clean up.
+'''
+
+from os.path import join, isdir
+import contextlib
+import fcntl
+import os
+import re
+import socket
+import threading
+import time
+
+from .core import Error
+
+
+# Seconds to wait for another worker's flight before doing the work anyway
+TIMEOUT = 60
+
+# Seconds between attempts at a lock held by somebody else
+POLL_INTERVAL = 0.02
+
+# Longest result (bytes) an owner can hand to its waiters
+RESULT_MAX = 4096
+
+
+def _lockfile(Client, path):
+  # Opens path, creating it for the database group
+  try:
+    return os.open(path, os.O_RDWR)
+  except FileNotFoundError:
+    pass
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+  try:
+    os.fchown(fd, -1, Client.DatabaseGroup.gr_gid)
+    os.fchmod(fd, 0o664)
+  except PermissionError:
+    # Created by somebody else
+    pass
+  return fd
+
+
+def _trylock(fd, deadline):
+  # Waits for an exclusive flock on fd until deadline (None: forever).
+  # Returns whether it has it, and whether it had to wait.
+  try:
+    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    return True, False
+  except BlockingIOError:
+    pass
+  while deadline is None or time.monotonic() < deadline:
+    time.sleep(POLL_INTERVAL)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      return True, True
+    except BlockingIOError:
+      pass
+  return False, True
+
+
+class _Held():
+  # What Flights.Hold() yields
+  def __init__(self):
+    # key -> result of the owner that was waited for
+    self.Results = {}
+    # key -> descriptor of the lock file held
+    self.Fds = {}
+
+  def Publish(self, Key, Result):
+    '''
+    Hands Result (a str) to the workers waiting for Key, if it is held.
+    '''
+    fd = self.Fds.get(Key)
+    if fd is None:
+      return
+    data = Result.encode('utf-8')
+    if len(data) > RESULT_MAX:
+      raise ValueError('Flight result longer than {0} bytes.'.format(RESULT_MAX))
+    os.ftruncate(fd, 0)
+    os.pwrite(fd, data, 0)
+
+
+class Flights():
+  def __init__(self, Client, Timeout=TIMEOUT):
+    self.Client = Client
+    self.Path = join(Client.TempPath, 'Flight')
+    self.Timeout = Timeout
+    self.Counters = {'Led': 0, 'Waited': 0, 'TakenOver': 0}
+    self._lock = threading.Lock()
+
+  def Stats(self):
+    with self._lock:
+      return dict(self.Counters)
+
+  def _count(self, key):
+    with self._lock:
+      self.Counters[key] += 1
+
+  @contextlib.contextmanager
+  def Hold(self, Keys):
+    '''
+    Holds the flights of Keys (hex strings) for the duration of the with
+    block.  They are taken in sorted order, so holders of overlapping keys
+    never deadlock.  After waiting Timeout seconds in all, goes ahead
+    without the rest.
+
+    Yields an object with Results, {key: result} for the keys whose owner
+    published a result while this worker waited, and Publish(Key, Result)
+    to hand a result to the workers waiting for this one.  For the other
+    keys the caller must check for a result again inside the block: the
+    worker it waited for may have made it.
+    '''
+    if not isdir(self.Path):
+      try:
+        self.Client._mkdir(self.Path)
+      except FileExistsError:
+        pass
+    deadline = time.monotonic() + self.Timeout if self.Timeout is not None else None
+    held = []
+    flight = _Held()
+    try:
+      for key in sorted(set(Keys)):
+        path = join(self.Path, key + '.lock')
+        fd, result = self._acquire(path, deadline)
+        if fd is not None:
+          held.append((path, fd))
+          flight.Fds[key] = fd
+        elif result is not None:
+          flight.Results[key] = result
+      yield flight
+    finally:
+      for path, fd in reversed(held):
+        # Removed before it is unlocked, see the module docstring
+        try:
+          os.unlink(path)
+        except FileNotFoundError:
+          pass
+        os.close(fd)
+
+  def _acquire(self, path, deadline):
+    # Returns (a descriptor of path, locked, None), (None, the result the
+    # owner published) or (None, None) if taken over
+    waited = False
+    while True:
+      fd = _lockfile(self.Client, path)
+      try:
+        locked, w = _trylock(fd, deadline)
+        waited = waited or w
+        if not locked:
+          self._count('TakenOver')
+          os.close(fd)
+          return None, None
+        try:
+          current = os.stat(path).st_ino == os.fstat(fd).st_ino
+        except FileNotFoundError:
+          current = False
+      except BaseException:
+        os.close(fd)
+        raise
+      if current:
+        self._count('Waited' if waited else 'Led')
+        return fd, None
+      # The owner we waited for removed it: take its result, or start over
+      # on a new one if it left none
+      try:
+        result = os.pread(fd, RESULT_MAX, 0)
+      finally:
+        os.close(fd)
+      if result:
+        self._count('Waited')
+        return None, result.decode('utf-8')
+
+
+class JobSlots():
+  def __init__(self, Client, Slots, Timeout=None):
+    '''
+    At most Slots jobs hold a slot at once on this host, across all
+    processes using the database.
+    '''
+    Slots = int(Slots)
+    if Slots < 1:
+      raise ValueError('Slots must be at least 1: {0}'.format(Slots))
+    self.Client = Client
+    self.Slots = Slots
+    self.Timeout = Timeout
+    host = re.sub('[^a-zA-Z0-9_.-]', '_', socket.gethostname()) or 'localhost'
+    self.Path = join(Client.TempPath, 'Jobs-' + host)
+    self.Counters = {'Jobs': 0, 'Waited': 0}
+    self._lock = threading.Lock()
+
+  def Stats(self):
+    with self._lock:
+      return dict(self.Counters)
+
+  @contextlib.contextmanager
+  def Hold(self):
+    '''
+    Holds a job slot for the duration of the with block, waiting for one
+    to be free.  Raises Error after Timeout seconds.
+    '''
+    if not isdir(self.Path):
+      try:
+        self.Client._mkdir(self.Path)
+      except FileExistsError:
+        pass
+    deadline = time.monotonic() + self.Timeout if self.Timeout is not None else None
+    fd = self._acquire(deadline)
+    try:
+      yield
+    finally:
+      os.close(fd)
+
+  def _acquire(self, deadline):
+    waited = False
+    while True:
+      for i in range(self.Slots):
+        fd = _lockfile(self.Client, join(self.Path, '{0}.lock'.format(i)))
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          os.close(fd)
+          continue
+        with self._lock:
+          self.Counters['Jobs'] += 1
+          if waited:
+            self.Counters['Waited'] += 1
+        return fd
+      if deadline is not None and time.monotonic() >= deadline:
+        raise Error('No image job slot free on {0} after {1} seconds.'.format(socket.gethostname(), self.Timeout))
+      waited = True
+      time.sleep(POLL_INTERVAL)
+
+
+__all__ = (
+  'Flights',
+  'JobSlots',
+  )
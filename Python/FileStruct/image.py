@@ -0,0 +1,572 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Image jobs (resize, normalize, several outputs from one decode) for
+TempDir.convert_resize(), convert_normalize() and convert_multi(), run by a
+fixed pool of worker threads per client (Client.Images, created on first
+use) instead of a process per call:
+
+  Engine 'pillow'   in process, with Pillow, which releases the GIL while
+                    it decodes, resizes and encodes
+  Engine 'convert'  one ImageMagick convert process per job, its pixel
+                    cache held to MaxMemory of RAM, killed after Timeout
+  Engine 'auto'     Pillow if it is installed, otherwise convert; jobs
+                    Pillow cannot do the same way (animations, geometry
+                    like '50%' or '@10000') go to convert
+
+Jobs wait in a queue for Workers threads, and each holds one of the host's
+image job slots (Client(ImageJobs=N), see FileStruct.flight) while it runs.
+The width and height of the source are read from its header before it is
+decoded, and sources of more than MaxPixels pixels, or wider or higher than
+MaxSide, are refused whatever the engine.  Formats without a header ImageSize
+can read are only checked by the engine: Pillow refuses more than MaxPixels
+itself, and convert refuses sides over MaxSide, but past MaxPixels or
+MaxMemory it moves its pixel cache to disk instead of refusing.
+
+Pillow writes what convert would by default: a JPEG gets the quantization
+tables of a JPEG source (convert keeps its quality), or quality 92, and the
+ICC profile of the source is kept.
+
+A caller waits Timeout seconds for its job at most, queued and running, and
+then cancels it.  A cancelled convert is killed.  A cancelled Pillow job
+stops at its next step (Pillow cannot be interrupted while it decodes or
+resizes), and gives up its job slot.  Pillow outputs are encoded in memory
+and written under the job's lock, so once Run() has given up nothing more
+is written to the caller's TempDir, which may be gone.
+'''
+
+from os.path import splitext
+import io
+import os
+import re
+import struct
+import threading
+import time
+
+from .core import Error, IMAGE_ENGINES
+
+
+ENGINES = IMAGE_ENGINES
+
+# Worker threads per client
+WORKERS = 4
+
+# Seconds a caller waits for its job
+TIMEOUT = 60
+
+# Largest source (width x height) decoded
+MAX_PIXELS = 50 * 1000 * 1000
+
+# Largest width or height of a source decoded
+MAX_SIDE = 65535
+
+# Pixel cache of a convert process kept in RAM, the rest goes to disk
+MAX_MEMORY = 256 * 1024 * 1024
+
+# Geometry Pillow resizes to the same size as convert: WxH, Wx, xH, W or
+# N%, with an optional ! (exact), ^ (fill), > (only shrink) or < (only enlarge)
+GEOMETRY_MATCH = re.compile('^([0-9]+)?(?:x([0-9]*))?([!^<>]?)$').match
+PERCENT_MATCH = re.compile(r'^([0-9]+(?:\.[0-9]+)?)%$').match
+
+
+class _Unsupported(Exception):
+  # A job Pillow cannot do as convert would
+  pass
+
+
+class _Cancelled(Exception):
+  # The caller of a job gave up on it
+  pass
+
+
+class _Job():
+  # Lets the caller of a job that gave up on it stop it writing anything more
+  def __init__(self):
+    self.Cancelled = False
+    self.Lock = threading.Lock()
+    # The running convert, if any
+    self.Process = None
+
+  def Cancel(self):
+    with self.Lock:
+      self.Cancelled = True
+      process = self.Process
+    if process is not None:
+      process.kill()
+      process.wait()
+
+  def Check(self):
+    if self.Cancelled:
+      raise _Cancelled()
+
+
+# PIL.Image once imported, False once the import has failed
+_Image = None
+
+# Held while Image.MAX_IMAGE_PIXELS is lowered
+_pil_lock = threading.Lock()
+
+
+def _pil():
+  # Returns PIL.Image, or None if Pillow is not installed
+  global _Image
+  if _Image is None:
+    try:
+      from PIL import Image
+    except ImportError:
+      Image = False
+    _Image = Image
+  return _Image or None
+
+
+def ImageSize(path):
+  '''
+  Returns (width, height) of the image at path from its header, without
+  decoding it.  PNG, GIF, JPEG and WebP are read directly, anything else
+  with Pillow if it is installed.  None if it cannot tell.
+  '''
+  with open(path, 'rb') as f:
+    head = f.read(32)
+    if head.startswith(b'\x89PNG\r\n\x1a\n') and head[12:16] == b'IHDR':
+      return struct.unpack('>II', head[16:24])
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+      return struct.unpack('<HH', head[6:10])
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+      return _webpsize(head)
+    if head[:2] == b'\xff\xd8':
+      f.seek(2)
+      return _jpegsize(f)
+
+  Image = _pil()
+  if Image is None:
+    return None
+  try:
+    with Image.open(path) as im:
+      return im.size
+  except Exception:
+    return None
+
+
+def _webpsize(head):
+  chunk = head[12:16]
+  if chunk == b'VP8X':
+    return (int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1)
+  if chunk == b'VP8L':
+    bits = int.from_bytes(head[21:25], 'little')
+    return ((bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1)
+  if chunk == b'VP8 ':
+    return (int.from_bytes(head[26:28], 'little') & 0x3fff, int.from_bytes(head[28:30], 'little') & 0x3fff)
+  return None
+
+
+def _jpegsize(f):
+  # Walks the segments to the first start of frame
+  while True:
+    marker = f.read(2)
+    if len(marker) < 2 or marker[0] != 0xff:
+      return None
+    if marker[1] == 0xff:
+      # Fill byte
+      f.seek(-1, os.SEEK_CUR)
+      continue
+    if 0xd0 <= marker[1] <= 0xd9 or marker[1] == 0x01:
+      # No length
+      continue
+    data = f.read(2)
+    if len(data) < 2:
+      return None
+    length = struct.unpack('>H', data)[0]
+    if 0xc0 <= marker[1] <= 0xcf and marker[1] not in (0xc4, 0xc8, 0xcc):
+      data = f.read(5)
+      if len(data) < 5:
+        return None
+      height, width = struct.unpack('>HH', data[1:5])
+      return (width, height)
+    f.seek(length - 2, os.SEEK_CUR)
+
+
+def ResizeSize(SizeSpec, Size):
+  '''
+  Returns the (width, height) that convert -resize SizeSpec gives an image
+  of Size.  Raises ValueError for geometry it does not know.
+  '''
+  width, height = Size
+  m = PERCENT_MATCH(SizeSpec)
+  if m:
+    scale = float(m.group(1)) / 100
+    return (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+  m = GEOMETRY_MATCH(SizeSpec)
+  if not m or not (m.group(1) or m.group(2)):
+    raise ValueError('Unsupported size spec: {0}'.format(SizeSpec))
+  boxw = int(m.group(1)) if m.group(1) else None
+  boxh = int(m.group(2)) if m.group(2) else None
+  flag = m.group(3)
+
+  if flag == '!' and boxw and boxh:
+    return (boxw, boxh)
+  if flag == '>' and (boxw is None or width <= boxw) and (boxh is None or height <= boxh):
+    return Size
+  if flag == '<' and ((boxw is not None and width >= boxw) or (boxh is not None and height >= boxh)):
+    return Size
+
+  scales = []
+  if boxw is not None:
+    scales.append(boxw / width)
+  if boxh is not None:
+    scales.append(boxh / height)
+  scale = max(scales) if flag == '^' else min(scales)
+  return (max(1, int(round(width * scale))), max(1, int(round(height * scale))))
+
+
+def _box(output):
+  # (width, height) the output is sized by, or None if it may need more of
+  # the source than that (only enlarge, percentages, unknown geometry)
+  if 'Normalize' in output:
+    return output['Normalize']
+  m = GEOMETRY_MATCH(output['Resize'])
+  if m and m.group(1) and m.group(2) and m.group(3) in ('', '!', '^', '>'):
+    return (int(m.group(1)), int(m.group(2)))
+  return None
+
+
+def ConvertArgs(Source, Outputs, MaxMemory=MAX_MEMORY, MaxPixels=MAX_PIXELS, MaxSide=MAX_SIDE):
+  '''
+  Returns the convert arguments (without the binary) that make Outputs
+  (as for ImageService.Submit) from Source.
+  '''
+  before = [
+    '-limit', 'memory', str(MaxMemory),
+    '-limit', 'map', str(MaxMemory),
+    '-limit', 'area', str(MaxPixels),
+    '-limit', 'width', str(MaxSide),
+    '-limit', 'height', str(MaxSide),
+    ]
+  boxes = [_box(output) for output in Outputs]
+  if None not in boxes:
+    # JPEG only: let libjpeg decode at a reduced scale, down to twice the
+    # largest output, instead of the full resolution
+    before += ['-define', 'jpeg:size={0}x{1}'.format(2 * max(b[0] for b in boxes), 2 * max(b[1] for b in boxes))]
+
+  def ops(output):
+    if 'Resize' in output:
+      args = ['-resize', output['Resize']]
+    else:
+      width, height = output['Normalize']
+      args = [
+        '-resize', '{0}x{1}^'.format(width, height),
+        '-gravity', 'center',
+        '-extent', '{0}x{1}'.format(width, height),
+        ]
+    if output.get('Quality') is not None:
+      args += ['-quality', str(output['Quality'])]
+    return args
+
+  def dest(output):
+    if output.get('Format'):
+      return output['Format'] + ':' + output['Path']
+    return output['Path']
+
+  if len(Outputs) == 1:
+    return before + [Source] + ops(Outputs[0]) + [dest(Outputs[0])]
+
+  args = ['-respect-parentheses'] + before + [Source]
+  for output in Outputs:
+    # Each output works on a copy of the decoded source and drops it once
+    # written; settings like -gravity stay inside the parentheses
+    args += ['(', '-clone', '0--1'] + ops(output) + ['-write', dest(output), '-delete', '0--1', ')']
+  return args + ['null:']
+
+
+class ImageService():
+  def __init__(self, Client, Engine='auto', Workers=None, Timeout=TIMEOUT, MaxPixels=MAX_PIXELS, MaxMemory=MAX_MEMORY, MaxSide=MAX_SIDE):
+    '''
+    Engine is one of ENGINES.  'pillow' raises Error if Pillow is not
+    installed.
+    '''
+    if Engine not in ENGINES:
+      raise ValueError("Invalid image engine '{0}', must be one of: {1}".format(Engine, ', '.join(ENGINES)))
+    if Engine == 'pillow' and _pil() is None:
+      raise Error("The 'pillow' image engine needs Pillow (pip install Pillow).")
+    Workers = int(Workers or WORKERS)
+    if Workers < 1:
+      raise ValueError('Workers must be at least 1: {0}'.format(Workers))
+
+    self.Client = Client
+    self.Engine = Engine
+    self.Workers = Workers
+    self.Timeout = Timeout
+    self.MaxPixels = MaxPixels
+    self.MaxMemory = MaxMemory
+    self.MaxSide = MaxSide
+    self.Counters = {'Jobs': 0, 'Pillow': 0, 'Convert': 0, 'Refused': 0, 'Killed': 0, 'TimedOut': 0, 'Errors': 0}
+    self._lock = threading.Lock()
+    self._pool = None
+    self._pending = set()
+
+  def close(self):
+    '''
+    Waits for the jobs already queued and stops the worker threads.
+    '''
+    with self._lock:
+      pool, self._pool = self._pool, None
+    if pool is not None:
+      pool.shutdown(wait=True)
+
+  def Stats(self):
+    with self._lock:
+      return dict(self.Counters, Pending=len(self._pending))
+
+  def _count(self, key):
+    with self._lock:
+      self.Counters[key] += 1
+
+  def _outputs(self, Outputs):
+    # Checked copies of Outputs
+    outputs = []
+    for output in Outputs:
+      checked = {'Path': output['Path']}
+      if 'Resize' in output:
+        checked['Resize'] = str(output['Resize'])
+      elif 'Normalize' in output:
+        width, height = output['Normalize']
+        checked['Normalize'] = (int(width), int(height))
+      else:
+        raise ValueError('Output needs Resize or Normalize: {0}'.format(output))
+      if output.get('Quality') is not None:
+        checked['Quality'] = int(output['Quality'])
+      if output.get('Format'):
+        if not output['Format'].isalnum():
+          raise ValueError('Invalid format: {0}'.format(output['Format']))
+        checked['Format'] = output['Format']
+      outputs.append(checked)
+    if not outputs:
+      raise ValueError('No outputs given.')
+    return outputs
+
+  def Submit(self, Source, Outputs):
+    '''
+    Queues a job making every output in Outputs from one decode of the
+    image file at Source, and returns a concurrent.futures.Future of it.
+
+    Each output is a dict of Path and either Resize (a convert -resize
+    size spec) or Normalize ((Width, Height): resized to fill, then cropped
+    to it around the center), and optionally Quality (1-100) and Format
+    (e.g. 'webp', instead of going by the extension of Path, or else the
+    format of Source).  A job not started within Timeout seconds fails.
+    '''
+    return self._submit(Source, Outputs)[0]
+
+  def _submit(self, Source, Outputs):
+    # Returns the Future and the _Job
+    outputs = self._outputs(Outputs)
+    deadline = time.monotonic() + self.Timeout if self.Timeout is not None else None
+    job = _Job()
+    with self._lock:
+      if self._pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        self._pool = ThreadPoolExecutor(max_workers=self.Workers)
+      future = self._pool.submit(self._job, Source, outputs, deadline, job)
+      self._pending.add(future)
+    future.add_done_callback(self._done)
+    return future, job
+
+  def _done(self, future):
+    with self._lock:
+      self._pending.discard(future)
+
+  def Run(self, Source, Outputs):
+    '''
+    Submit()s the job and waits for it.  Raises Error if it fails, or is
+    not done within Timeout seconds.
+    '''
+    from concurrent.futures import TimeoutError
+    future, job = self._submit(Source, Outputs)
+    try:
+      return future.result(self.Timeout)
+    except TimeoutError:
+      # Whatever the job does from here on, it writes nothing more
+      future.cancel()
+      job.Cancel()
+      self._count('TimedOut')
+      raise Error('Image job on {0} not done after {1} seconds.'.format(Source, self.Timeout))
+
+  def _job(self, source, outputs, deadline, job):
+    with self._lock:
+      self.Counters['Jobs'] += 1
+    try:
+      try:
+        size = ImageSize(source)
+      except OSError as e:
+        raise Error('Cannot read image {0}: {1}'.format(source, e))
+      if size is not None and (size[0] * size[1] > self.MaxPixels or max(size) > self.MaxSide):
+        self._count('Refused')
+        raise Error('Image {0} is {1}x{2}, over the limit of {3} pixels or {4} per side.'.format(source, size[0], size[1], self.MaxPixels, self.MaxSide))
+
+      if self.Client.ImageJobs is not None:
+        with self.Client.ImageJobs.Hold():
+          self._run(source, outputs, deadline, job)
+      else:
+        self._run(source, outputs, deadline, job)
+    except _Cancelled:
+      raise Error('Image job on {0} cancelled.'.format(source))
+    except Exception:
+      self._count('Errors')
+      raise
+
+  def _run(self, source, outputs, deadline, job):
+    job.Check()
+    if deadline is not None and time.monotonic() >= deadline:
+      raise Error('Image job on {0} not started within {1} seconds.'.format(source, self.Timeout))
+    engine = self.Engine
+    if engine == 'auto':
+      engine = 'pillow' if _pil() is not None else 'convert'
+    if engine == 'pillow':
+      try:
+        self._pillow(source, outputs, job)
+        self._count('Pillow')
+        return
+      except _Unsupported as e:
+        if self.Engine == 'pillow':
+          raise Error('Cannot do with Pillow: {0}'.format(e))
+    self._convert(source, outputs, deadline, job)
+    self._count('Convert')
+
+  def _convert(self, source, outputs, deadline, job):
+    import subprocess
+    cmd = [self.Client.bin_convert] + ConvertArgs(source, outputs, self.MaxMemory, self.MaxPixels, self.MaxSide)
+    timeout = max(0, deadline - time.monotonic()) if deadline is not None else None
+    with job.Lock:
+      job.Check()
+      try:
+        process = job.Process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+      except OSError as e:
+        raise Error('Cannot run {0}: {1}'.format(self.Client.bin_convert, e))
+    try:
+      output = process.communicate(timeout=timeout)[0]
+    except subprocess.TimeoutExpired:
+      process.kill()
+      process.communicate()
+      self._count('Killed')
+      raise Error('convert of {0} killed after {1} seconds.'.format(source, self.Timeout))
+    finally:
+      with job.Lock:
+        job.Process = None
+    if job.Cancelled:
+      # Killed by Cancel()
+      self._count('Killed')
+      raise _Cancelled()
+    if process.returncode:
+      raise Error(output)
+
+  def _pillow(self, source, outputs, job):
+    Image = _pil()
+    with _pil_lock:
+      # Pillow's own limit on what it decodes.  It is process wide, so the
+      # lowest of all the services wins; each also checks its own above.
+      if Image.MAX_IMAGE_PIXELS is None or Image.MAX_IMAGE_PIXELS > self.MaxPixels:
+        Image.MAX_IMAGE_PIXELS = self.MaxPixels
+    try:
+      im = Image.open(source)
+    except Image.DecompressionBombError as e:
+      self._count('Refused')
+      raise Error('Image {0} refused: {1}'.format(source, e))
+    except Exception as e:
+      raise Error('Cannot read image {0}: {1}'.format(source, e))
+    with im:
+      if im.format in ('GIF', 'PNG', 'WEBP') and getattr(im, 'is_animated', False):
+        raise _Unsupported('animated image')
+      # A camera JPEG with previews in it is written as a plain JPEG
+      sourceformat = 'JPEG' if im.format == 'MPO' else im.format
+      qtables = getattr(im, 'quantization', None) if sourceformat == 'JPEG' else None
+      profile = im.info.get('icc_profile')
+      sizes = []
+      for output in outputs:
+        if 'Resize' in output:
+          try:
+            sizes.append(ResizeSize(output['Resize'], im.size))
+          except ValueError as e:
+            raise _Unsupported(e)
+        else:
+          sizes.append(None)
+      formats = [self._format(Image, output, sourceformat) for output in outputs]
+
+      boxes = [_box(output) for output in outputs]
+      if None not in boxes and sourceformat == 'JPEG':
+        # Decode at a reduced scale, down to twice the largest output
+        im.draft(im.mode, (2 * max(b[0] for b in boxes), 2 * max(b[1] for b in boxes)))
+      try:
+        job.Check()
+        im.load()
+        if im.mode in ('P', '1'):
+          im = im.convert('RGBA' if 'transparency' in im.info else 'RGB')
+        # Sizes are from the full size, whatever the decode was reduced to
+        for output, size, format in zip(outputs, sizes, formats):
+          job.Check()
+          if 'Resize' in output:
+            out = im.resize(size, Image.LANCZOS) if size != im.size else im
+          else:
+            out = _normalize(Image, im, output['Normalize'])
+          if format == 'JPEG' and out.mode not in ('RGB', 'L', 'CMYK'):
+            out = out.convert('RGB')
+          options = {}
+          if output.get('Quality') is not None:
+            options['quality'] = output['Quality']
+          elif format == 'JPEG' and qtables:
+            options['qtables'] = qtables
+          elif format == 'JPEG':
+            options['quality'] = 92
+          if profile:
+            options['icc_profile'] = profile
+          data = io.BytesIO()
+          out.save(data, format, **options)
+          with job.Lock:
+            job.Check()
+            with open(output['Path'], 'wb') as f:
+              f.write(data.getbuffer())
+      except (OSError, ValueError) as e:
+        raise Error('Cannot convert image {0}: {1}'.format(source, e))
+    pass#with
+
+  def _format(self, Image, output, sourceformat):
+    # Pillow's name of the format of output
+    if output.get('Format'):
+      format = Image.registered_extensions().get('.' + output['Format'].lower(), output['Format'].upper())
+    else:
+      format = Image.registered_extensions().get(splitext(output['Path'])[1].lower(), sourceformat)
+    if format not in Image.SAVE:
+      raise _Unsupported('format {0}'.format(format))
+    return format
+
+
+def _normalize(Image, im, Box):
+  # convert -resize WxH^ -gravity center -extent WxH
+  width, height = Box
+  resized = ResizeSize('{0}x{1}^'.format(width, height), im.size)
+  im = im.resize(resized, Image.LANCZOS)
+  left = (resized[0] - width) // 2
+  top = (resized[1] - height) // 2
+  return im.crop((left, top, left + width, top + height))
+
+
+__all__ = (
+  'ConvertArgs',
+  'ImageService',
+  'ImageSize',
+  'ResizeSize',
+  )
@@ -0,0 +1,449 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Persistent index of the hashes stored in Data/.
+
+  Index/Hashes.idx    8 byte magic, then sorted fixed size records of
+                      (binary digest, 8 byte big-endian size)
+  Index/Journal.log   lines of "+<hash> <size>" and "-<hash>" appended
+                      as objects come and go
+  Index/Lock          flock(2) target; appenders hold it shared,
+                      Compact() and Rebuild() exclusive
+
+Hashes.idx is opened with mmap, so membership is a binary search and
+range/prefix scans are sequential reads.  The journal is merged into it
+by Compact(), which runs automatically once the journal grows past
+CompactSize.
+
+Command line:
+
+  python -m FileStruct.index {rebuild,compact,stats,list} /path/to/database
+'''
+
+from os.path import join, isdir
+import argparse
+import bisect
+import fcntl
+import mmap
+import os
+import struct
+import sys
+import threading
+
+from .scan import Scan, PrefixRange
+
+
+MAGIC = b'FSIDX001'
+SIZE = struct.Struct('>Q')
+
+# Journal size (bytes) after which Append() compacts the index
+COMPACT_SIZE = 16 * 1024 * 1024
+
+# Marks the loaded journal state as unknown, forcing a reset on reload
+_UNKNOWN = object()
+
+
+class _Records():
+  # Sequence view over the records in a mapped Hashes.idx, for bisect
+  def __init__(self, mm, DigestSize):
+    self.mm = mm
+    self.DigestSize = DigestSize
+    self.RecordSize = DigestSize + SIZE.size
+    self.Count = (len(mm) - len(MAGIC)) // self.RecordSize if mm is not None else 0
+
+  def __len__(self):
+    return self.Count
+
+  def __getitem__(self, i):
+    offset = len(MAGIC) + i * self.RecordSize
+    return self.mm[offset:offset+self.DigestSize]
+
+  def Size(self, i):
+    offset = len(MAGIC) + i * self.RecordSize + self.DigestSize
+    return SIZE.unpack_from(self.mm, offset)[0]
+
+
+class HashIndex():
+  def __init__(self, Path, DigestSize=20, CompactSize=COMPACT_SIZE):
+    self.Path = Path
+    self.DigestSize = DigestSize
+    self.CompactSize = CompactSize
+    self.IndexPath = join(Path, 'Hashes.idx')
+    self.JournalPath = join(Path, 'Journal.log')
+    self.LockPath = join(Path, 'Lock')
+
+    if not isdir(self.Path):
+      os.mkdir(self.Path)
+
+    self._lock = threading.RLock()
+    self._lockfd = os.open(self.LockPath, os.O_RDWR | os.O_CREAT, 0o664)
+    self._mm = None
+    self._records = _Records(None, DigestSize)
+    self._indexid = _UNKNOWN
+    self._journalid = _UNKNOWN
+    self._journaloffset = 0
+    self._added = {}
+    self._removed = set()
+    self._sortedadded = None
+    self.Refresh()
+
+  def close(self):
+    with self._lock:
+      self._unmap()
+      if self._lockfd is not None:
+        os.close(self._lockfd)
+        self._lockfd = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.close()
+
+  def _unmap(self):
+    # Not closed explicitly: running Range() iterators may still use it
+    self._records = _Records(None, self.DigestSize)
+    self._mm = None
+
+  def _flock(self, op):
+    fcntl.flock(self._lockfd, op)
+
+  def _fileid(self, path):
+    try:
+      st = os.stat(path)
+    except FileNotFoundError:
+      return None
+    return (st.st_dev, st.st_ino)
+
+
+  #============================================================================
+  # Reading
+
+  def Refresh(self):
+    '''
+    Picks up journal entries written by other clients and processes, and
+    reopens Hashes.idx if it was rewritten.
+    '''
+    with self._lock:
+      self._flock(fcntl.LOCK_SH)
+      try:
+        self._reload()
+      finally:
+        self._flock(fcntl.LOCK_UN)
+
+  def _reload(self, Full=False):
+    # Caller holds the index lock (shared or exclusive)
+    if Full:
+      self._indexid = _UNKNOWN
+
+    indexid = self._fileid(self.IndexPath)
+    if indexid != self._indexid:
+      self._unmap()
+      self._indexid = indexid
+      # The journal is only ever replaced together with the index
+      self._journalid = _UNKNOWN
+      if indexid is not None:
+        with open(self.IndexPath, 'rb') as f:
+          if os.fstat(f.fileno()).st_size > len(MAGIC):
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            if mm[:len(MAGIC)] != MAGIC:
+              raise ValueError("Not a FileStruct index file: '{0}'".format(self.IndexPath))
+            self._mm = mm
+            self._records = _Records(mm, self.DigestSize)
+
+    journalid = self._fileid(self.JournalPath)
+    if journalid != self._journalid:
+      self._journalid = journalid
+      self._journaloffset = 0
+      self._added = {}
+      self._removed = set()
+      self._sortedadded = None
+    if journalid is not None:
+      self._readjournal()
+
+  def _readjournal(self):
+    with open(self.JournalPath, 'rb') as f:
+      f.seek(self._journaloffset)
+      data = f.read()
+    # Ignore a trailing partial line, it is picked up next time
+    end = data.rfind(b'\n') + 1
+    self._journaloffset += end
+    for line in data[:end].splitlines():
+      self._applyline(line)
+
+  def _applyline(self, line):
+    if line[:1] == b'+':
+      hash, size = line[1:].split()
+      digest = bytes.fromhex(hash.decode('ascii'))
+      self._added[digest] = int(size)
+      self._removed.discard(digest)
+      self._sortedadded = None
+    elif line[:1] == b'-':
+      digest = bytes.fromhex(line[1:].decode('ascii'))
+      self._added.pop(digest, None)
+      self._removed.add(digest)
+      self._sortedadded = None
+
+  def _find(self, digest):
+    # Position of digest in the mapped records, or None
+    records = self._records
+    i = bisect.bisect_left(records, digest)
+    if i < len(records) and records[i] == digest:
+      return i
+    return None
+
+  def _lookup(self, digest):
+    if digest in self._added:
+      return self._added[digest]
+    if digest in self._removed:
+      return None
+    i = self._find(digest)
+    return self._records.Size(i) if i is not None else None
+
+  def Get(self, hash, default=None):
+    '''
+    Returns the size recorded for hash, or default.  On a miss the journal
+    is re-read once, to see objects added by other processes.
+    '''
+    digest = bytes.fromhex(hash)
+    with self._lock:
+      size = self._lookup(digest)
+      if size is None:
+        self.Refresh()
+        size = self._lookup(digest)
+    return default if size is None else size
+
+  def __contains__(self, hash):
+    try:
+      return self.Get(hash) is not None
+    except (ValueError, TypeError):
+      return False
+
+  def __len__(self):
+    with self._lock:
+      count = len(self._records)
+      for digest in self._removed:
+        if self._find(digest) is not None:
+          count -= 1
+      for digest in self._added:
+        if self._find(digest) is None:
+          count += 1
+      return count
+
+  def __iter__(self):
+    for hash, size in self.Range():
+      yield hash
+
+  def Range(self, Start=None, Stop=None):
+    '''
+    Yields (hash, size) in hash order for Start <= hash < Stop, where the
+    bounds are hex strings (or None for open ends).
+    '''
+    start = bytes.fromhex(Start.ljust(self.DigestSize * 2, '0')) if Start else None
+    stop = bytes.fromhex(Stop.ljust(self.DigestSize * 2, '0')) if Stop else None
+    return self._range(start, stop)
+
+  def Prefix(self, Prefix):
+    '''
+    Yields (hash, size) in hash order for every hash starting with the hex
+    string Prefix.
+    '''
+    return self.Range(*PrefixRange(Prefix))
+
+  def _range(self, start, stop):
+    with self._lock:
+      records = self._records
+      removed = set(self._removed)
+      if self._sortedadded is None:
+        self._sortedadded = sorted(self._added.items())
+      added = self._sortedadded
+
+    i = bisect.bisect_left(records, start) if start is not None else 0
+    end = bisect.bisect_left(records, stop) if stop is not None else len(records)
+    j = bisect.bisect_left(added, (start,)) if start is not None else 0
+
+    while i < end or j < len(added):
+      digest = records[i] if i < end else None
+      if j < len(added) and (stop is None or added[j][0] < stop) and (digest is None or added[j][0] <= digest):
+        if added[j][0] == digest:
+          i += 1
+        yield added[j][0].hex(), added[j][1]
+        j += 1
+      elif digest is not None:
+        if digest not in removed:
+          yield digest.hex(), records.Size(i)
+        i += 1
+      else:
+        break
+
+
+  #============================================================================
+  # Writing
+
+  def _journal(self, data):
+    with self._lock:
+      self._flock(fcntl.LOCK_SH)
+      try:
+        fd = os.open(self.JournalPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+          view = memoryview(data)
+          while view:
+            view = view[os.write(fd, view):]
+          size = os.lseek(fd, 0, os.SEEK_CUR)
+        finally:
+          os.close(fd)
+      finally:
+        self._flock(fcntl.LOCK_UN)
+      # Applying them again when the journal is re-read is harmless
+      for line in data.splitlines():
+        self._applyline(line)
+
+    if self.CompactSize and size >= self.CompactSize:
+      self.Compact(Wait=False)
+
+  def Append(self, hash, size):
+    self._journal('+{0} {1}\n'.format(hash, int(size)).encode('ascii'))
+
+  def Remove(self, hash):
+    self._journal('-{0}\n'.format(hash).encode('ascii'))
+
+  def RemoveMany(self, hashes):
+    data = ''.join('-{0}\n'.format(hash) for hash in hashes).encode('ascii')
+    if data:
+      self._journal(data)
+
+  def _write(self, items):
+    # Writes (digest, size) pairs, already sorted, as the new Hashes.idx
+    tmppath = self.IndexPath + '.tmp'
+    with open(tmppath, 'wb') as f:
+      f.write(MAGIC)
+      pack = struct.Struct('>{0}sQ'.format(self.DigestSize)).pack
+      for digest, size in items:
+        f.write(pack(digest, size))
+      f.flush()
+      os.fsync(f.fileno())
+    os.chmod(tmppath, 0o664)
+    os.rename(tmppath, self.IndexPath)
+
+  def _exclusive(self, Wait):
+    # A separate descriptor, since flock() locks are per open file
+    fd = os.open(self.LockPath, os.O_RDWR)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX | (0 if Wait else fcntl.LOCK_NB))
+    except BlockingIOError:
+      os.close(fd)
+      return None
+    return fd
+
+  def Compact(self, Wait=True):
+    '''
+    Merges the journal into Hashes.idx.  Returns False if Wait is False and
+    another compaction or rebuild holds the lock.
+    '''
+    # The thread lock is always taken before the file lock, as in Refresh()
+    # and _journal()
+    with self._lock:
+      fd = self._exclusive(Wait)
+      if fd is None:
+        return False
+      try:
+        self._reload(Full=True)
+        added = sorted(self._added.items())
+        removed = self._removed
+        records = self._records
+
+        def merged():
+          i = j = 0
+          while i < len(records) or j < len(added):
+            digest = records[i] if i < len(records) else None
+            if j < len(added) and (digest is None or added[j][0] <= digest):
+              if added[j][0] == digest:
+                i += 1
+              yield added[j]
+              j += 1
+            else:
+              if digest not in removed:
+                yield digest, records.Size(i)
+              i += 1
+
+        self._replace(merged())
+        return True
+      finally:
+        os.close(fd)
+
+  def Rebuild(self, DataPath):
+    '''
+    Recreates the index from the Data/ tree, discarding the journal.
+    '''
+    with self._lock:
+      fd = self._exclusive(True)
+      try:
+        self._replace((bytes.fromhex(hash), size) for hash, size, mtime in Scan(DataPath, HashLength=self.DigestSize*2))
+      finally:
+        os.close(fd)
+
+  def _replace(self, items):
+    # Caller holds the exclusive lock
+    self._write(items)
+    try:
+      os.unlink(self.JournalPath)
+    except FileNotFoundError:
+      pass
+    self._reload(Full=True)
+
+  def Stats(self):
+    with self._lock:
+      return {
+        'Records': len(self._records),
+        'JournalAdded': len(self._added),
+        'JournalRemoved': len(self._removed),
+        'JournalBytes': self._journaloffset,
+        }
+
+
+def main(argv=None):
+  from .core import Client
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.index')
+  parser.add_argument('command', choices=('rebuild', 'compact', 'stats', 'list'))
+  parser.add_argument('path', help='Database directory')
+  parser.add_argument('--prefix', default='', help='Hex prefix for list')
+  args = parser.parse_args(argv)
+
+  client = Client(args.path, Index=True)
+  index = client.Index
+  if args.command == 'rebuild':
+    client.RebuildIndex()
+  elif args.command == 'compact':
+    index.Compact()
+  elif args.command == 'list':
+    for hash, size in index.Prefix(args.prefix):
+      sys.stdout.write('{0} {1}\n'.format(hash, size))
+  if args.command != 'list':
+    stats = index.Stats()
+    stats['Objects'] = len(index)
+    for key in sorted(stats):
+      sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+
+
+if __name__ == '__main__':
+  main()
+
+
+__all__ = (
+  'HashIndex',
+  )
@@ -0,0 +1,143 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Copies every object of one database into another that uses a different
+hash algorithm, e.g. a Version 1 (sha1) database into a Version 2 blake2b
+one, and writes a mapping file with one "oldhash newhash" line per object,
+in old hash order.
+
+The target must already be set up (directory, group, FileStruct.json).
+Objects are read, checked against their old hash and rehashed in the same
+pass, on a pool of threads.  The source is never modified.
+
+  python -m FileStruct.migrate /old/database /new/database --map old-to-new.txt
+'''
+
+from os.path import exists
+import argparse
+import os
+import sys
+import time
+
+from .core import Error, StreamCopy
+from .batch import PutMany, WORKERS
+
+
+class _Hashers():
+  # Feeds the same data to several hashlib objects
+  def __init__(self, *hashers):
+    self.hashers = hashers
+
+  def update(self, data):
+    for h in self.hashers:
+      h.update(data)
+
+
+def _migrate(Source, Target, hash, sizes):
+  old, new = Source.NewHash(), Target.NewHash()
+  with Target.TempDir() as TD:
+    path = TD['Migrate'].Path
+    with Source._openobject(hash) as source:
+      with open(path, 'wb', buffering=0) as output:
+        size = StreamCopy(source, output, _Hashers(old, new), Target.ChunkSize)
+
+        if old.hexdigest() != hash:
+          raise Error("Object '{0}' is corrupt, its content hashes to {1}".format(hash, old.hexdigest()))
+
+        newhash = new.hexdigest()
+        Target._ingestfile(path, newhash, output.fileno())
+    sizes[newhash] = size
+    return newhash
+  pass#with
+
+
+def Migrate(Source, Target, MapPath, Workers=WORKERS):
+  '''
+  Copies every object in Client Source into Client Target and writes the
+  "oldhash newhash" mapping to MapPath.  Objects that fail (unreadable or
+  corrupt) are left out of the mapping and reported in the returned stats
+  as Errors, a list of (hash, exception).
+  '''
+  if exists(MapPath):
+    raise Error("Mapping file '{0}' already exists.".format(MapPath))
+
+  start = time.time()
+  stats = {'Objects': 0, 'Migrated': 0, 'Bytes': 0, 'Errors': []}
+
+  # The target may pack small objects, so sizes are taken while copying
+  sizes = {}
+  tmppath = MapPath + '.tmp'
+  with open(tmppath, 'w', encoding='ascii') as mapfile:
+    results = PutMany(Target, Source.IterHashes(), Workers, Put=lambda hash: _migrate(Source, Target, hash, sizes))
+    for result in results:
+      stats['Objects'] += 1
+      if result.Error is not None:
+        stats['Errors'].append((result.Item, result.Error))
+        continue
+      mapfile.write('{0} {1}\n'.format(result.Item, result.Hash))
+      stats['Migrated'] += 1
+      stats['Bytes'] += sizes.pop(result.Hash)
+    mapfile.flush()
+    os.fsync(mapfile.fileno())
+  os.rename(tmppath, MapPath)
+
+  stats['Seconds'] = time.time() - start
+  return stats
+
+
+def ReadMap(MapPath):
+  '''
+  Yields (oldhash, newhash) from a mapping file written by Migrate().
+  '''
+  with open(MapPath, 'r', encoding='ascii') as f:
+    for line in f:
+      old, new = line.split()
+      yield old, new
+
+
+def main(argv=None):
+  from .core import Client
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.migrate')
+  parser.add_argument('source', help='Database directory to copy from')
+  parser.add_argument('target', help='Database directory to copy into, already set up')
+  parser.add_argument('--map', required=True, help='Mapping file to write, must not exist')
+  parser.add_argument('--workers', type=int, default=WORKERS)
+  args = parser.parse_args(argv)
+
+  source = Client(args.source)
+  target = Client(args.target)
+  if source.HashName == target.HashName:
+    parser.error('Both databases use {0}, there is nothing to migrate.'.format(source.HashName))
+
+  stats = Migrate(source, target, args.map, args.workers)
+  for hash, e in stats['Errors']:
+    sys.stderr.write('{0}: {1}\n'.format(hash, e))
+  stats['Errors'] = len(stats['Errors'])
+  for key in sorted(stats):
+    sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+  return 1 if stats['Errors'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'Migrate',
+  'ReadMap',
+  )
@@ -0,0 +1,354 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Packfile storage for small objects, for Client(PackThreshold=...).
+
+Objects up to PackThreshold bytes are appended to large pack files instead
+of getting a file (an inode, a directory entry and a block) each in Data/:
+
+  Pack/00000001.pack   the objects' contents, back to back
+  Pack/00000001.log    (digest, 8 byte offset, 4 byte length) records in
+                       the order they were appended, while the pack is open
+  Pack/00000001.idx    the same records sorted by digest, once the pack
+                       has grown past PACK_SIZE and is sealed
+
+There is one open pack at a time.  Appenders (from any process) hold an
+exclusive flock on its .log while they append the data and then its record,
+so a record never points at data that is not there, and a crash leaves at
+worst unreferenced bytes at the end of the .pack.  Sealing writes the .idx
+and then removes the .log.
+
+Readers keep the open pack's records in a dict and look up sealed ones by
+binary search in the mmap'ed .idx files.  Packs are never rewritten.  A
+lookup that misses checks whether Pack/ or an open .log has changed since
+it last looked, so objects packed by other processes are found: the
+directory is listed again only when its mtime has changed, and a .log is
+reread only when it has grown.
+
+Garbage collection and eviction cannot remove packed objects without
+rewriting packs, so they refuse to run on a database that has any (see
+HasPacks()), whatever the PackThreshold of the client.  Packed objects
+are never collected or evicted.  Scrubbing rehashes them and reports corrupt
+ones, which stay where they are.
+'''
+
+from os.path import join, exists
+import bisect
+import fcntl
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+from .core import Error, _writeall
+
+
+# A pack is sealed, and a new one started, once it is this large (bytes)
+PACK_SIZE = 256 * 1024 * 1024
+
+_LOCATION = struct.Struct('>QI')
+_PACKNAME = re.compile(r'^([0-9]{8})\.(log|idx)$').match
+
+# A directory mtime this recent (seconds) may hide a change made within the
+# same timestamp tick, so it is not trusted
+_RACY = 2
+
+
+def HasPacks(Path):
+  '''
+  True if the Pack/ directory at Path holds any pack, whether or not the
+  client looking uses PackThreshold.
+  '''
+  try:
+    return any(_PACKNAME(name) for name in os.listdir(Path))
+  except FileNotFoundError:
+    return False
+
+
+class _Sorted():
+  # The digests of a sealed .idx file, as a sequence for bisect
+  def __init__(self, mm, DigestSize):
+    self.mm = mm
+    self.DigestSize = DigestSize
+    self.RecordSize = DigestSize + _LOCATION.size
+    self.Count = len(mm) // self.RecordSize
+
+  def __len__(self):
+    return self.Count
+
+  def __getitem__(self, i):
+    start = i * self.RecordSize
+    return self.mm[start:start+self.DigestSize]
+
+  def Get(self, digest):
+    i = bisect.bisect_left(self, digest)
+    if i < self.Count and self[i] == digest:
+      return _LOCATION.unpack_from(self.mm, i * self.RecordSize + self.DigestSize)
+    return None
+
+
+class PackStore():
+  def __init__(self, Client):
+    self.Client = Client
+    self.Path = Client.PackPath
+    self.DigestSize = Client.DigestSize
+    self.RecordSize = self.DigestSize + _LOCATION.size
+    # Open packs: digest -> (pack, offset, length), and how much of each
+    # .log has been read
+    self._open = {}
+    self._logpos = {}
+    # Sealed packs: pack -> _Sorted
+    self._sealed = {}
+    # Descriptors for reading, by pack
+    self._fds = {}
+    # st_mtime_ns of Pack/ when it was last listed, None to list it again
+    self._dirmtime = None
+    self._lock = threading.Lock()
+
+  def _packpath(self, pack, ext):
+    return join(self.Path, '{0:08d}.{1}'.format(pack, ext))
+
+  def Get(self, hash):
+    '''
+    Returns (pack, offset, length) of hash, or None if it is not packed.
+    '''
+    digest = bytes.fromhex(hash)
+    location = self._get(digest)
+    if location is None:
+      with self._lock:
+        self._refresh()
+      location = self._get(digest)
+    return location
+
+  def __contains__(self, hash):
+    return self.Get(hash) is not None
+
+  def _get(self, digest):
+    location = self._open.get(digest)
+    if location is not None:
+      return location
+    for pack, index in list(self._sealed.items()):
+      location = index.Get(digest)
+      if location is not None:
+        return (pack,) + location
+    return None
+
+  def _refresh(self):
+    # Picks up packs sealed, started and appended to by anyone
+    st = os.stat(self.Path)
+    if st.st_mtime_ns == self._dirmtime:
+      for pack in list(self._logpos):
+        try:
+          size = os.stat(self._packpath(pack, 'log')).st_size
+        except FileNotFoundError:
+          # Sealed, the directory has changed too
+          continue
+        if size - size % self.RecordSize > self._logpos[pack]:
+          self._readlog(pack)
+      return
+
+    self._dirmtime = st.st_mtime_ns if time.time() - st.st_mtime > _RACY else None
+    for name in os.listdir(self.Path):
+      m = _PACKNAME(name)
+      if m is None:
+        continue
+      pack = int(m.group(1))
+      if m.group(2) == 'idx':
+        if pack not in self._sealed:
+          self._loadidx(pack)
+      elif pack not in self._sealed:
+        self._readlog(pack)
+
+  def _loadidx(self, pack):
+    with open(self._packpath(pack, 'idx'), 'rb') as f:
+      if os.fstat(f.fileno()).st_size == 0:
+        mm = b''
+      else:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._sealed[pack] = _Sorted(mm, self.DigestSize)
+    self._logpos.pop(pack, None)
+    for digest in [d for d, location in self._open.items() if location[0] == pack]:
+      del self._open[digest]
+
+  def _readlog(self, pack):
+    try:
+      with open(self._packpath(pack, 'log'), 'rb') as f:
+        f.seek(self._logpos.get(pack, 0))
+        data = f.read()
+    except FileNotFoundError:
+      # Sealed meanwhile, the next refresh finds the .idx
+      return
+    end = len(data) - len(data) % self.RecordSize
+    for i in range(0, end, self.RecordSize):
+      digest = data[i:i+self.DigestSize]
+      self._open[digest] = (pack,) + _LOCATION.unpack_from(data, i + self.DigestSize)
+    self._logpos[pack] = self._logpos.get(pack, 0) + end
+
+  def close(self):
+    with self._lock:
+      fds, self._fds = self._fds, None
+    for fd in (fds or {}).values():
+      os.close(fd)
+
+  def Read(self, location, Offset=0, Length=None):
+    '''
+    Returns the contents of the object at location, or Length bytes of
+    them starting at Offset.
+    '''
+    pack, offset, length = location
+    Offset = min(Offset, length)
+    Length = length - Offset if Length is None else min(Length, length - Offset)
+    fds = self._fds
+    if fds is None:
+      raise Error("The packs in '{0}' are closed.".format(self.Path))
+    fd = fds.get(pack)
+    if fd is None:
+      with self._lock:
+        if self._fds is None:
+          raise Error("The packs in '{0}' are closed.".format(self.Path))
+        fd = self._fds.get(pack)
+        if fd is None:
+          fd = self._fds[pack] = os.open(self._packpath(pack, 'pack'), os.O_RDONLY)
+    chunks = []
+    offset += Offset
+    while Length:
+      chunk = os.pread(fd, Length, offset)
+      if not chunk:
+        break
+      chunks.append(chunk)
+      offset += len(chunk)
+      Length -= len(chunk)
+    return b''.join(chunks)
+
+  def Put(self, hash, data):
+    '''
+    Appends data to the open pack as hash.  Returns False if hash was
+    already packed.
+    '''
+    digest = bytes.fromhex(hash)
+    with self._lock:
+      while True:
+        self._refresh()
+        if self._get(digest) is not None:
+          return False
+        logs = sorted(pack for pack in self._logpos)
+        pack = logs[-1] if logs else max(self._sealed, default=0) + 1
+        stored = self._append(pack, digest, data)
+        if stored is not None:
+          return stored
+
+  def _create(self, path):
+    # Opens path for appending, creating it for the database group
+    try:
+      return os.open(path, os.O_WRONLY | os.O_APPEND)
+    except FileNotFoundError:
+      pass
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+    try:
+      os.fchown(fd, -1, self.Client.DatabaseGroup.gr_gid)
+      os.fchmod(fd, 0o664)
+    except PermissionError:
+      # Created by somebody else
+      pass
+    return fd
+
+  def _append(self, pack, digest, data):
+    # None means the pack was sealed under us, and the caller retries
+    logfd = self._create(self._packpath(pack, 'log'))
+    try:
+      fcntl.flock(logfd, fcntl.LOCK_EX)
+      st = os.fstat(logfd)
+      if st.st_nlink == 0:
+        return None
+      if exists(self._packpath(pack, 'idx')):
+        # We recreated the .log of a pack sealed since we last looked
+        os.unlink(self._packpath(pack, 'log'))
+        return None
+      if st.st_size % self.RecordSize:
+        # The last appender died while writing its record
+        os.ftruncate(logfd, st.st_size - st.st_size % self.RecordSize)
+
+      # Somebody may have appended it since we last looked
+      self._readlog(pack)
+      if digest in self._open:
+        return False
+
+      with open(self._create(self._packpath(pack, 'pack')), 'ab', buffering=0) as output:
+        offset = os.fstat(output.fileno()).st_size
+        _writeall(output, memoryview(data).cast('B'))
+        if self.Client.Durability != 'none':
+          self.Client._syncfile(None, output.fileno())
+
+      record = digest + _LOCATION.pack(offset, len(data))
+      os.write(logfd, record)
+      if self.Client.Durability == 'directory':
+        self.Client._syncfile(None, logfd)
+      self._open[digest] = (pack, offset, len(data))
+      self._logpos[pack] = st.st_size - st.st_size % self.RecordSize + self.RecordSize
+
+      if offset + len(data) >= PACK_SIZE:
+        self._seal(pack, logfd)
+      return True
+    finally:
+      os.close(logfd)
+
+  def _seal(self, pack, logfd):
+    # Called with the .log locked and fully read
+    records = sorted(digest + _LOCATION.pack(offset, length) for digest, (p, offset, length) in self._open.items() if p == pack)
+    tmppath = self._packpath(pack, 'idx.tmp')
+    with open(tmppath, 'wb') as f:
+      f.write(b''.join(records))
+      if self.Client.Durability != 'none':
+        self.Client._syncfile(tmppath, f.fileno())
+    os.chmod(tmppath, 0o444)
+    os.rename(tmppath, self._packpath(pack, 'idx'))
+    os.unlink(self._packpath(pack, 'log'))
+    self._loadidx(pack)
+
+  def IterHashes(self):
+    '''
+    Yields every packed hash, in no particular order.
+    '''
+    with self._lock:
+      self._refresh()
+      digests = list(self._open)
+      sealed = list(self._sealed.values())
+    for digest in digests:
+      yield digest.hex()
+    for index in sealed:
+      for i in range(len(index)):
+        yield index[i].hex()
+
+  def Stats(self):
+    with self._lock:
+      self._refresh()
+      objects = len(self._open) + sum(len(index) for index in self._sealed.values())
+      packs = len(set(self._logpos) | set(self._sealed))
+    size = 0
+    for name in os.listdir(self.Path):
+      if name.endswith('.pack'):
+        size += os.stat(join(self.Path, name)).st_size
+    return {'Objects': objects, 'Packs': packs, 'Bytes': size}
+
+
+__all__ = (
+  'PackStore',
+  'HasPacks',
+  )
@@ -0,0 +1,362 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Write-behind replication: every new object is copied to a secondary store
+(a FileStruct.backend.Backend, or another database) in the background.
+
+  Replicate/Journal.log   fixed size (8 byte time, digest) records, appended
+                          by _ingestfile() of clients with
+                          ReplicationQueue=True
+  Replicate/Offset.json   {"Journal": inode, "Offset": bytes}: everything
+                          before Offset has been replicated
+  Replicate/Lock          flock(2) target held by the running Replicator
+  Replicate/Failed.jsonl  objects given up on after all retries
+
+Appending costs an open, a shared flock and one write; nothing waits for
+the secondary store.  The Replicator reads the journal in batches, copies
+each batch on a pool of threads (retrying failures with exponential
+backoff), and saves the offset after each batch, so a crash repeats at
+most one batch; copying is idempotent.  Once everything is replicated and
+the journal has grown past ROTATE_SIZE, it is removed and a new one starts.
+
+  python -m FileStruct.replicate /path/to/database --target /path/to/replica
+'''
+
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import fcntl
+import json
+import os
+import random
+import struct
+import sys
+import threading
+import time
+
+from .core import Error
+
+
+# Copying threads
+WORKERS = 4
+
+# Journal records per batch, per worker
+BATCH = 16
+
+# Attempts after the first one, and the delays between them: BACKOFF
+# seconds, doubling up to MAX_BACKOFF
+RETRIES = 8
+BACKOFF = 0.5
+MAX_BACKOFF = 60
+
+# Seconds between looks at an empty journal
+POLL_INTERVAL = 1
+
+# A fully replicated journal larger than this (bytes) is started over
+ROTATE_SIZE = 1024 * 1024
+
+_STAMP = struct.Struct('<d')
+
+
+class ReplicationQueue():
+  def __init__(self, Client):
+    self.Client = Client
+    self.Path = Client.ReplicatePath
+    self.JournalPath = join(self.Path, 'Journal.log')
+    self.OffsetPath = join(self.Path, 'Offset.json')
+    self.FailedPath = join(self.Path, 'Failed.jsonl')
+    self.RecordSize = _STAMP.size + Client.DigestSize
+
+  def Append(self, hash):
+    '''
+    Queues hash for replication.
+    '''
+    record = _STAMP.pack(time.time()) + bytes.fromhex(hash)
+    while True:
+      try:
+        fd = os.open(self.JournalPath, os.O_WRONLY | os.O_APPEND)
+      except FileNotFoundError:
+        fd = os.open(self.JournalPath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o664)
+        try:
+          os.fchown(fd, -1, self.Client.DatabaseGroup.gr_gid)
+          os.fchmod(fd, 0o664)
+        except PermissionError:
+          # Somebody else created it first
+          pass
+      try:
+        # Shared with other appenders, exclusive for rotation
+        fcntl.flock(fd, fcntl.LOCK_SH)
+        if os.fstat(fd).st_nlink == 0:
+          # Rotated away while we waited for the lock
+          continue
+        os.write(fd, record)
+        return
+      finally:
+        os.close(fd)
+
+  def Committed(self):
+    '''
+    Returns (journal inode, offset) of the replication progress.
+    '''
+    try:
+      with open(self.OffsetPath, 'r', encoding='utf-8') as f:
+        saved = json.load(f)
+      return saved['Journal'], saved['Offset']
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+      # Missing, or torn by a crash: start over, copying is idempotent
+      return None, 0
+
+  def Commit(self, Journal, Offset):
+    tmppath = self.OffsetPath + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as f:
+      json.dump({'Journal': Journal, 'Offset': Offset}, f)
+    os.replace(tmppath, self.OffsetPath)
+
+  def Read(self, Count=None):
+    '''
+    Returns (journal inode, offset, [(time, hash)]) for up to Count (or
+    all) records after the committed offset.  The inode is None if there
+    is no journal.
+    '''
+    try:
+      fd = os.open(self.JournalPath, os.O_RDONLY)
+    except FileNotFoundError:
+      return None, 0, []
+    try:
+      journal = os.fstat(fd).st_ino
+      committed, offset = self.Committed()
+      if committed != journal:
+        offset = 0
+      size = Count * self.RecordSize if Count is not None else max(0, os.fstat(fd).st_size - offset)
+      data = os.pread(fd, size, offset)
+    finally:
+      os.close(fd)
+
+    records = []
+    for i in range(0, len(data) - self.RecordSize + 1, self.RecordSize):
+      stamp, = _STAMP.unpack_from(data, i)
+      records.append((stamp, data[i+_STAMP.size:i+self.RecordSize].hex()))
+    return journal, offset, records
+
+  def Pending(self):
+    '''
+    Returns the set of hashes not replicated yet: still queued, or given
+    up on.
+    '''
+    journal, offset, records = self.Read()
+    pending = set(hash for stamp, hash in records)
+    try:
+      with open(self.FailedPath, 'r', encoding='utf-8') as f:
+        pending.update(json.loads(line)['Hash'] for line in f if line.strip())
+    except FileNotFoundError:
+      pass
+    return pending
+
+  def Rotate(self):
+    '''
+    Removes the journal if everything in it is replicated and it is larger
+    than ROTATE_SIZE.
+    '''
+    try:
+      fd = os.open(self.JournalPath, os.O_RDONLY)
+    except FileNotFoundError:
+      return False
+    try:
+      st = os.fstat(fd)
+      if st.st_size < ROTATE_SIZE:
+        return False
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      st = os.fstat(fd)
+      if self.Committed() != (st.st_ino, st.st_size):
+        return False
+      # Reset first: the next journal may get the same inode number.  A
+      # crash in between only makes the old journal be replayed.
+      self.Commit(None, 0)
+      os.unlink(self.JournalPath)
+      return True
+    finally:
+      os.close(fd)
+
+  def Stats(self):
+    '''
+    Depth: records waiting.  Lag: seconds since the oldest of them was
+    queued, 0 when there are none.
+    '''
+    journal, offset, records = self.Read(1)
+    size = 0
+    if journal is not None:
+      try:
+        size = os.stat(self.JournalPath).st_size
+      except FileNotFoundError:
+        pass
+    return {
+      'Depth': max(0, size - offset) // self.RecordSize,
+      'Lag': max(0.0, time.time() - records[0][0]) if records else 0.0,
+      'Offset': offset,
+      }
+
+
+class _Stopped(Exception):
+  pass
+
+
+class Replicator():
+  def __init__(self, Client, Target, Workers=WORKERS, Retries=RETRIES, Backoff=BACKOFF, MaxBackoff=MAX_BACKOFF, PollInterval=POLL_INTERVAL):
+    '''
+    Target is a FileStruct.backend.Backend, or the Client or path of another
+    database (with the same hash algorithm).
+    '''
+    from .core import Client as _Client
+    from .backend import ClientBackend
+    if isinstance(Target, str):
+      Target = _Client(Target)
+    if isinstance(Target, _Client):
+      if Target.HashName != Client.HashName:
+        raise Error("Cannot replicate a {0} database to a {1} one.".format(Client.HashName, Target.HashName))
+      Target = ClientBackend(Target)
+
+    self.Client = Client
+    self.Target = Target
+    self.Queue = Client.ReplicationQueue or ReplicationQueue(Client)
+    self.Workers = max(1, int(Workers or WORKERS))
+    self.Retries = Retries
+    self.Backoff = Backoff
+    self.MaxBackoff = MaxBackoff
+    self.PollInterval = PollInterval
+    self.LockPath = join(self.Queue.Path, 'Lock')
+    self.Counters = {'Replicated': 0, 'Skipped': 0, 'Missing': 0, 'Retries': 0, 'Failed': 0, 'Batches': 0}
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+
+  def Stop(self):
+    '''
+    Makes Run() return after the batch in progress, or at once from a
+    backoff wait (that batch is repeated by the next Run()).
+    '''
+    self._stop.set()
+
+  def Stats(self):
+    with self._lock:
+      stats = dict(self.Counters)
+    stats.update(self.Queue.Stats())
+    return stats
+
+  def Run(self, Once=False):
+    '''
+    Replicates until Stop() is called, or with Once until the journal is
+    drained.  Returns Stats().
+    '''
+    if not exists(self.Queue.Path):
+      self.Client._mkdir(self.Queue.Path)
+    lockfd = os.open(self.LockPath, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+      try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise Error('Another replicator is already running on {0}'.format(self.Client.Path))
+      with ThreadPoolExecutor(max_workers=self.Workers) as pool:
+        self._run(pool, Once)
+    finally:
+      os.close(lockfd)
+    return self.Stats()
+
+  def _run(self, pool, Once):
+    while not self._stop.is_set():
+      journal, offset, records = self.Queue.Read(self.Workers * BATCH)
+      if not records:
+        self.Queue.Rotate()
+        if Once:
+          return
+        self._stop.wait(self.PollInterval)
+        continue
+
+      try:
+        results = list(pool.map(self._copy, [hash for stamp, hash in records]))
+      except _Stopped:
+        return
+
+      with self._lock:
+        for result in results:
+          self.Counters[result] += 1
+        self.Counters['Batches'] += 1
+      self.Queue.Commit(journal, offset + len(records) * self.Queue.RecordSize)
+
+  def _copy(self, hash):
+    for attempt in range(self.Retries + 1):
+      try:
+        if self.Target.Contains(hash):
+          return 'Skipped'
+        try:
+          stream = self.Client._openobject(hash)
+        except KeyError:
+          # Removed (garbage collected, evicted) before it got copied
+          return 'Missing'
+        with stream:
+          self.Target.Put(hash, stream)
+        return 'Replicated'
+      except Exception as e:
+        if attempt == self.Retries:
+          self._failed(hash, e)
+          return 'Failed'
+        with self._lock:
+          self.Counters['Retries'] += 1
+        delay = min(self.MaxBackoff, self.Backoff * 2 ** attempt) * random.uniform(0.5, 1)
+        if self._stop.wait(delay):
+          raise _Stopped()
+
+  def _failed(self, hash, e):
+    record = {'Hash': hash, 'Error': '{0}: {1}'.format(type(e).__name__, e), 'Time': time.time()}
+    with self._lock:
+      with open(self.Queue.FailedPath, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def main(argv=None):
+  from .core import Client
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.replicate')
+  parser.add_argument('path', help='Database directory')
+  parser.add_argument('--target', default=None, help='Database directory to replicate to')
+  parser.add_argument('--workers', type=int, default=WORKERS)
+  parser.add_argument('--once', action='store_true', help='Exit once the queue is drained')
+  parser.add_argument('--stats', action='store_true', help='Only print the queue depth and lag')
+  args = parser.parse_args(argv)
+  if args.target is None and not args.stats:
+    parser.error('Give --target or --stats.')
+
+  client = Client(args.path)
+  if args.stats:
+    stats = ReplicationQueue(client).Stats()
+  else:
+    replicator = Replicator(client, args.target, args.workers)
+    try:
+      stats = replicator.Run(args.once)
+    except KeyboardInterrupt:
+      stats = replicator.Stats()
+  for key in sorted(stats):
+    sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+  return 1 if stats.get('Failed') else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'ReplicationQueue',
+  'Replicator',
+  )
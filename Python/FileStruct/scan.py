@@ -0,0 +1,154 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Enumeration of the Data/xx/yy/ tree with os.scandir.
+
+Each of the 256 top level shards is listed by a thread from a pool (the
+work is almost all system calls, which release the GIL).  Results are
+yielded in hash order, and only a bounded number of shards are held in
+memory at once.  A hash range can be given so that the work can be split
+across machines.
+'''
+
+from os.path import join
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import os
+import re
+
+
+# Default number of scanning threads
+WORKERS = 8
+
+HEX_MATCH = re.compile('[a-f0-9]+').fullmatch
+
+
+def PrefixRange(Prefix):
+  '''
+  Returns the (Start, Stop) hex string range covering every hash starting
+  with Prefix.  Stop is None when there is no upper bound.
+  '''
+  Prefix = Prefix.lower()
+  if not Prefix:
+    return None, None
+  if not HEX_MATCH(Prefix):
+    raise ValueError('Hash prefix is not valid: {0}'.format(Prefix))
+  stop = int(Prefix, 16) + 1
+  if stop >= 16 ** len(Prefix):
+    return Prefix, None
+  return Prefix, '{0:0{1}x}'.format(stop, len(Prefix))
+
+
+def _overlaps(prefix, Start, Stop):
+  # Does any hash starting with prefix fall into [Start, Stop)?
+  if Stop is not None:
+    n = max(len(prefix), len(Stop))
+    if prefix.ljust(n, '0') >= Stop.ljust(n, '0'):
+      return False
+  if Start is not None:
+    n = max(len(prefix), len(Start))
+    if prefix.ljust(n, 'f') < Start.ljust(n, '0'):
+      return False
+  return True
+
+
+def IterShard(DataPath, Shard, HashLength=40, Start=None, Stop=None):
+  '''
+  Yields an os.DirEntry for every object file in Data/<Shard>/*/, in hash
+  order, restricted to Start <= hash < Stop.
+  '''
+  shardpath = join(DataPath, Shard)
+  try:
+    subs = sorted(os.listdir(shardpath))
+  except FileNotFoundError:
+    return
+
+  for sub in subs:
+    prefix = Shard + sub
+    if len(sub) != 2 or not HEX_MATCH(sub) or not _overlaps(prefix, Start, Stop):
+      continue
+    try:
+      with os.scandir(join(shardpath, sub)) as it:
+        entries = sorted(it, key=lambda entry: entry.name)
+    except (FileNotFoundError, NotADirectoryError):
+      continue
+    for entry in entries:
+      name = entry.name
+      if len(name) != HashLength or not name.startswith(prefix) or not HEX_MATCH(name):
+        continue
+      if (Start is not None and name < Start) or (Stop is not None and name >= Stop):
+        continue
+      if entry.is_file(follow_symlinks=False):
+        yield entry
+
+
+def _scanshard(DataPath, Shard, HashLength, Start, Stop):
+  rval = []
+  for entry in IterShard(DataPath, Shard, HashLength, Start, Stop):
+    try:
+      st = entry.stat(follow_symlinks=False)
+    except FileNotFoundError:
+      # Removed (e.g. garbage collected) while we were looking
+      continue
+    rval.append((entry.name, st.st_size, st.st_mtime))
+  return rval
+
+
+def Scan(DataPath, Start=None, Stop=None, Prefix=None, Workers=WORKERS, HashLength=40):
+  '''
+  Yields (hash, size, mtime) for every object in DataPath, in hash order.
+  Start and Stop are hex strings bounding the range as Start <= hash < Stop;
+  Prefix is a shortcut for the range of hashes starting with it.
+  '''
+  if Prefix:
+    if Start is not None or Stop is not None:
+      raise ValueError('Give either Prefix or Start/Stop, not both.')
+    Start, Stop = PrefixRange(Prefix)
+  Start = Start.lower() if Start else None
+  Stop = Stop.lower() if Stop else None
+
+  shards = [shard for shard in ('{0:02x}'.format(i) for i in range(256)) if _overlaps(shard, Start, Stop)]
+  if not shards:
+    return
+  Workers = max(1, min(int(Workers or 1), len(shards)))
+
+  with ThreadPoolExecutor(max_workers=Workers) as pool:
+    pending = deque()
+    shards = iter(shards)
+    try:
+      # Keep at most 2 * Workers shards in flight or waiting to be yielded
+      for shard in shards:
+        pending.append(pool.submit(_scanshard, DataPath, shard, HashLength, Start, Stop))
+        if len(pending) >= 2 * Workers:
+          break
+      while pending:
+        results = pending.popleft().result()
+        for shard in shards:
+          pending.append(pool.submit(_scanshard, DataPath, shard, HashLength, Start, Stop))
+          break
+        yield from results
+    finally:
+      for future in pending:
+        future.cancel()
+
+
+__all__ = (
+  'Scan',
+  'IterShard',
+  'PrefixRange',
+  )
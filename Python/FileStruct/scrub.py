@@ -0,0 +1,353 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+'''
+Integrity scrubbing: every object in Data/ is read back and rehashed, and
+objects whose content no longer matches their name are moved to
+Corrupt/<RandomName32>/ and reported in Corrupt/Report.jsonl.  Their
+precompressed sidecars (see FileStruct.compress) go with them, and a sidecar
+that does not decompress to its object's content is removed.
+
+The Data/xx/yy directories are handed to a pool of threads in hash order.
+All reads share one token bucket, so the total read rate stays under Rate
+bytes per second however many threads there are.  After each directory
+(and every directory before it) is done, the next prefix is saved in
+Temp/Scrub.checkpoint, and an interrupted scrub resumes from there.
+
+Packed objects (see FileStruct.pack) are rehashed after Data/, whatever the
+PackThreshold of the client.  Packs are never rewritten, so corrupt ones
+are only reported, with the Pack of the record set instead of the Path.
+
+  python -m FileStruct.scrub /path/to/database [--rate 50M] [--workers 4]
+'''
+
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import argparse
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+
+from .core import Error, StreamCopy, RandomName32
+from .scan import IterShard, HEX_MATCH
+from .compress import SUFFIXES, MoveSidecars, VerifySidecar
+from .pack import HasPacks, PackStore
+
+
+# Default number of hashing threads
+WORKERS = 4
+
+
+class TokenBucket():
+  '''
+  Thread safe rate limiter.  Consume(n) blocks until n more bytes may be
+  read without going over Rate bytes per second on average; up to Burst
+  bytes may go through at once after an idle period.
+  '''
+  def __init__(self, Rate, Burst=None):
+    self.Rate = float(Rate)
+    if self.Rate <= 0:
+      raise ValueError('Rate must be positive: {0}'.format(Rate))
+    self.Burst = float(Burst or Rate)
+    self.Tokens = self.Burst
+    self.Time = time.monotonic()
+    self.Lock = threading.Lock()
+
+  def Consume(self, n):
+    with self.Lock:
+      now = time.monotonic()
+      self.Tokens = min(self.Burst, self.Tokens + (now - self.Time) * self.Rate) - n
+      self.Time = now
+      # A debt is paid off by sleeping, outside the lock, so other threads
+      # queue up behind it instead of all waking at once
+      wait = -self.Tokens / self.Rate if self.Tokens < 0 else 0
+    if wait:
+      time.sleep(wait)
+
+
+def _next(prefix):
+  # The 'xxyy' prefix after this one, None after 'ffff'
+  n = int(prefix, 16) + 1
+  return '{0:04x}'.format(n) if n < 0x10000 else None
+
+
+class _Throttled():
+  # Read-only stream wrapper that charges every read to a TokenBucket
+  def __init__(self, stream, Bucket):
+    self.stream = stream
+    self.Bucket = Bucket
+
+  def readinto(self, buf):
+    n = self.stream.readinto(buf)
+    if n:
+      self.Bucket.Consume(n)
+    return n
+
+
+class Scrubber():
+  def __init__(self, Client, Rate=None, Workers=WORKERS):
+    self.Client = Client
+    self.Bucket = TokenBucket(Rate) if Rate else None
+    self.Workers = max(1, int(Workers or WORKERS))
+    self.LockPath = join(Client.TempPath, 'Scrub.lock')
+    self.CheckpointPath = join(Client.TempPath, 'Scrub.checkpoint')
+    self.ReportPath = join(Client.CorruptPath, 'Report.jsonl')
+    self.QuarantinePath = None
+    self._lock = threading.Lock()
+
+  def Run(self, Resume=True):
+    lockfd = os.open(self.LockPath, os.O_RDWR | os.O_CREAT, 0o664)
+    try:
+      try:
+        fcntl.flock(lockfd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        raise Error('Another scrub is already running on {0}'.format(self.Client.Path))
+      return self._run(Resume)
+    finally:
+      os.close(lockfd)
+
+  def Checkpoint(self):
+    '''
+    Returns the saved progress of an interrupted scrub, or None.
+    '''
+    try:
+      with open(self.CheckpointPath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+    except FileNotFoundError:
+      return None
+
+  def _run(self, Resume):
+    start = time.time()
+    stats = {'Objects': 0, 'Bytes': 0, 'Corrupt': 0, 'CorruptSidecars': 0, 'Packed': 0, 'CorruptPacked': 0, 'Next': '', 'Started': start}
+
+    checkpoint = self.Checkpoint() if Resume else None
+    if checkpoint:
+      stats.update(checkpoint)
+    resumed = stats['Next']
+
+    with ThreadPoolExecutor(max_workers=self.Workers) as pool:
+      pending = deque()
+      prefixes = (prefix for prefix in self._prefixes() if prefix >= resumed)
+      try:
+        for prefix in prefixes:
+          pending.append((prefix, pool.submit(self._scrubdir, prefix)))
+          if len(pending) >= 2 * self.Workers:
+            break
+        while pending:
+          prefix, future = pending.popleft()
+          objects, size, corrupt, sidecars = future.result()
+          for prefix2 in prefixes:
+            pending.append((prefix2, pool.submit(self._scrubdir, prefix2)))
+            break
+          stats['Objects'] += objects
+          stats['Bytes'] += size
+          stats['Corrupt'] += corrupt
+          stats['CorruptSidecars'] += sidecars
+          if _next(prefix) is not None:
+            stats['Next'] = _next(prefix)
+            self._save(stats)
+      finally:
+        for prefix, future in pending:
+          future.cancel()
+
+    self._scrubpacks(stats)
+
+    # A complete pass leaves nothing to resume
+    if exists(self.CheckpointPath):
+      os.unlink(self.CheckpointPath)
+
+    del stats['Next']
+    stats.update({
+      'Resumed': resumed or None,
+      'QuarantinePath': self.QuarantinePath,
+      'Seconds': time.time() - start,
+      })
+    return stats
+
+  def _prefixes(self):
+    # Every existing Data/xx/yy directory as 'xxyy', in order
+    try:
+      shards = sorted(os.listdir(self.Client.DataPath))
+    except FileNotFoundError:
+      return
+    for shard in shards:
+      if len(shard) != 2 or not HEX_MATCH(shard):
+        continue
+      try:
+        subs = sorted(os.listdir(join(self.Client.DataPath, shard)))
+      except (FileNotFoundError, NotADirectoryError):
+        continue
+      for sub in subs:
+        if len(sub) == 2 and HEX_MATCH(sub):
+          yield shard + sub
+
+  def _save(self, stats):
+    tmppath = self.CheckpointPath + '.tmp'
+    with open(tmppath, 'w', encoding='utf-8') as f:
+      json.dump(stats, f)
+    os.replace(tmppath, self.CheckpointPath)
+
+  def _scrubdir(self, prefix):
+    objects = size = corrupt = sidecars = 0
+    try:
+      names = set(os.listdir(join(self.Client.DataPath, prefix[0:2], prefix[2:4])))
+    except FileNotFoundError:
+      names = set()
+    for entry in IterShard(self.Client.DataPath, prefix[0:2], self.Client.HashLength, prefix, _next(prefix)):
+      result = self.Verify(entry.name, entry.path)
+      if result is None:
+        # Removed (e.g. garbage collected) while we were looking
+        continue
+      objects += 1
+      size += result[0]
+      if result[1] != entry.name:
+        self._quarantine(entry.name, entry.path, *result)
+        corrupt += 1
+        continue
+      for suffix in SUFFIXES:
+        if entry.name + suffix in names and self._checksidecar(entry.name, entry.path + suffix):
+          sidecars += 1
+    return objects, size, corrupt, sidecars
+
+  def _scrubpacks(self, stats):
+    # Rehashes every packed object; a client without PackThreshold reads
+    # the packs through a PackStore of its own
+    pack = self.Client.Pack
+    if pack is None:
+      if not HasPacks(self.Client.PackPath):
+        return
+      pack = PackStore(self.Client)
+    try:
+      for hash in pack.IterHashes():
+        location = pack.Get(hash)
+        if self.Bucket is not None:
+          self.Bucket.Consume(location[2])
+        actual = self.Client.NewHash(pack.Read(location)).hexdigest()
+        stats['Packed'] += 1
+        stats['Bytes'] += location[2]
+        if actual != hash:
+          stats['CorruptPacked'] += 1
+          path = pack._packpath(location[0], 'pack')
+          with self._lock:
+            self._report({'Hash': hash, 'Actual': actual, 'Size': location[2], 'Pack': path, 'Offset': location[1], 'Time': time.time()})
+    finally:
+      if pack is not self.Client.Pack:
+        pack.close()
+
+  def _checksidecar(self, hash, path):
+    # Removes the sidecar at path if it does not decompress to the object;
+    # it can be made again.  True if it was removed.
+    try:
+      f = open(path, 'rb', buffering=0)
+    except FileNotFoundError:
+      return False
+    with f:
+      stream = f if self.Bucket is None else _Throttled(f, self.Bucket)
+      if VerifySidecar(self.Client, hash, path, stream) is not False:
+        return False
+    try:
+      os.unlink(path)
+    except FileNotFoundError:
+      return False
+    return True
+
+  def Verify(self, hash, path=None):
+    '''
+    Rehashes one object.  Returns (size, actualhash), or None if the object
+    does not exist.
+    '''
+    hasher = self.Client.NewHash()
+    try:
+      with open(path or self.Client.HashToPath(hash), 'rb', buffering=0) as f:
+        stream = f if self.Bucket is None else _Throttled(f, self.Bucket)
+        size = StreamCopy(stream, None, hasher, self.Client.ChunkSize)
+    except FileNotFoundError:
+      return None
+    return size, hasher.hexdigest()
+
+  def _quarantine(self, hash, path, size, actual):
+    with self._lock:
+      if self.QuarantinePath is None:
+        if not exists(self.Client.CorruptPath):
+          self.Client._mkdir(self.Client.CorruptPath)
+        self.QuarantinePath = join(self.Client.CorruptPath, RandomName32())
+        self.Client._mkdir(self.QuarantinePath)
+
+      destpath = join(self.QuarantinePath, hash)
+      try:
+        os.rename(path, destpath)
+      except FileNotFoundError:
+        return
+      MoveSidecars(path, destpath)
+
+      if self.Client.Index is not None:
+        self.Client.Index.Remove(hash)
+      self.Client.InvalidateCache(hash)
+
+      self._report({'Hash': hash, 'Actual': actual, 'Size': size, 'Path': destpath, 'Time': time.time()})
+
+  def _report(self, record):
+    # Caller holds self._lock
+    if not exists(self.Client.CorruptPath):
+      self.Client._mkdir(self.Client.CorruptPath)
+    with open(self.ReportPath, 'a', encoding='utf-8') as f:
+      f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def ReadReport(ReportPath):
+  '''
+  Yields the records of a Corrupt/Report.jsonl file as dicts.
+  '''
+  try:
+    with open(ReportPath, 'r', encoding='utf-8') as f:
+      for line in f:
+        if line.strip():
+          yield json.loads(line)
+  except FileNotFoundError:
+    return
+
+
+def main(argv=None):
+  from .core import Client
+  from .bench import ParseSize
+  parser = argparse.ArgumentParser(prog='python -m FileStruct.scrub')
+  parser.add_argument('path', help='Database directory')
+  parser.add_argument('--rate', type=ParseSize, default=None, help='Maximum bytes read per second, e.g. 50M')
+  parser.add_argument('--workers', type=int, default=WORKERS)
+  parser.add_argument('--restart', action='store_true', help='Ignore the checkpoint of an interrupted scrub')
+  args = parser.parse_args(argv)
+
+  client = Client(args.path)
+  stats = client.Scrub(args.rate, args.workers, Resume=not args.restart)
+  for key in sorted(stats):
+    sys.stdout.write('{0}: {1}\n'.format(key, stats[key]))
+  return 1 if stats['Corrupt'] or stats['CorruptPacked'] else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
+
+
+__all__ = (
+  'Scrubber',
+  'TokenBucket',
+  'ReadReport',
+  )
@@ -0,0 +1,167 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import asyncio
+import hashlib
+import io
+import os
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.aio
+
+
+
+class AsyncReader():
+  # Minimal stand-in for aiohttp's StreamReader
+  def __init__(self, data, ChunkSize=1000):
+    self.Stream = io.BytesIO(data)
+    self.ChunkSize = ChunkSize
+    self.Reads = 0
+
+  async def read(self, n=-1):
+    self.Reads += 1
+    await asyncio.sleep(0)
+    return self.Stream.read(min(n, self.ChunkSize))
+
+
+class TestAsyncClient(TestClientOps):
+
+  def setUp(self):
+    super(TestAsyncClient, self).setUp()
+    self.AsyncClient = FileStruct.aio.AsyncClient(self.Path, self.InternalLocation, Concurrency=2, SpoolSize=4096)
+
+  def tearDown(self):
+    self.AsyncClient.close()
+    super(TestAsyncClient, self).tearDown()
+
+  def arun(self, coro):
+    return asyncio.run(coro)
+
+  def test_PutStreamSmall(self):
+    data = b'small async upload'
+    reader = AsyncReader(data, 5)
+    file_hash = self.arun(self.AsyncClient.PutStream(reader))
+    self.assertEqual(file_hash, hashlib.sha1(data).hexdigest())
+    self.assertGreater(reader.Reads, 1)
+    self.assertEqual(self.Client[file_hash].GetData(), data)
+
+  def test_PutStreamLarge(self):
+    data = os.urandom(50000)
+    file_hash = self.arun(self.AsyncClient.PutStream(AsyncReader(data, 3000)))
+    self.assertEqual(file_hash, hashlib.sha1(data).hexdigest())
+    self.assertEqual(self.Client[file_hash].GetData(), data)
+    self.assertEqual(os.listdir(self.Client.TempPath), [])
+
+  def test_PutStreamExisting(self):
+    file_hash = self.arun(self.AsyncClient.PutStream(AsyncReader(self.FileContents)))
+    self.assertEqual(file_hash, self.FileHash)
+
+  def test_PutStreamSync(self):
+    data = os.urandom(10000)
+    file_hash = self.arun(self.AsyncClient.PutStream(io.BytesIO(data)))
+    self.assertEqual(file_hash, hashlib.sha1(data).hexdigest())
+
+  def test_PutStreamFail(self):
+    temp = []
+    client = self.Client
+    class FailingReader(AsyncReader):
+      async def read(self, n=-1):
+        if self.Reads > 10:
+          # Written to a single file in Temp/, not a TempDir
+          temp.extend(entry.is_file() for entry in os.scandir(client.TempPath))
+          raise TestAsyncClient.UnhandledTestException()
+        return await super(FailingReader, self).read(n)
+    with self.assertRaises(self.UnhandledTestException):
+      self.arun(self.AsyncClient.PutStream(FailingReader(os.urandom(50000))))
+    self.assertEqual(temp, [True])
+    self.assertEqual(os.listdir(self.Client.TempPath), [])
+    self.assertEqual(os.listdir(self.Client.ErrorPath), [])
+
+  def test_PutStreamInExcept(self):
+    # A put that succeeds while the caller handles an exception leaves no
+    # error report
+    data = os.urandom(50000)
+    async def put():
+      try:
+        raise ValueError('handled by the caller')
+      except ValueError:
+        return await self.AsyncClient.PutStream(AsyncReader(data, 3000))
+    self.assertEqual(self.arun(put()), hashlib.sha1(data).hexdigest())
+    self.assertEqual(os.listdir(self.Client.ErrorPath), [])
+    self.assertEqual(os.listdir(self.Client.TempPath), [])
+
+  def test_TempDirFail(self):
+    async def put():
+      async with self.AsyncClient.TempDir() as TD:
+        await TD['upload'].PutData(b'data')
+        raise self.UnhandledTestException('failed upload')
+    with self.assertRaises(self.UnhandledTestException):
+      self.arun(put())
+    errors = os.listdir(self.Client.ErrorPath)
+    self.assertEqual(len(errors), 1)
+    with open(join(self.Client.ErrorPath, errors[0], 'Python-Exception.txt'), 'r') as f:
+      report = f.read()
+    self.assertIn('UnhandledTestException: failed upload', report)
+    self.assertIn('in put', report)
+
+  def test_PutData(self):
+    data = b'async data'
+    file_hash = self.arun(self.AsyncClient.PutData(data))
+    self.assertTrue(self.arun(self.AsyncClient.Contains(file_hash)))
+    self.assertFalse(self.arun(self.AsyncClient.Contains('0' * 40)))
+
+  def test_Get(self):
+    async def get():
+      hf = await self.AsyncClient.Get(self.FileHash)
+      self.assertEqual(hf.Hash, self.FileHash)
+      self.assertEqual(hf.InternalURI, self.Client[self.FileHash].InternalURI)
+      async with await hf.GetStream() as stream:
+        head = await stream.read(2)
+        tail = await stream.read()
+      self.assertTrue(stream.closed)
+      return head + tail, await hf.GetData()
+    self.assertEqual(self.arun(get()), (self.FileContents, self.FileContents))
+
+  def test_GetRange(self):
+    async def get():
+      hf = await self.AsyncClient.Get(self.FileHash)
+      return await hf.GetRange(1, 2), bytes(await hf.GetView())
+    self.assertEqual(self.arun(get()), (self.FileContents[1:3], self.FileContents))
+
+  def test_GetMissing(self):
+    with self.assertRaises(KeyError):
+      self.arun(self.AsyncClient.Get('0' * 40))
+
+  def test_TempDir(self):
+    data = os.urandom(20000)
+    async def put():
+      async with self.AsyncClient.TempDir() as TD:
+        path = TD.Path
+        await TD['upload'].PutStream(AsyncReader(data, 4096))
+        return path, await TD['upload'].Ingest()
+    path, file_hash = self.arun(put())
+    self.assertEqual(file_hash, hashlib.sha1(data).hexdigest())
+    self.assertFalse(exists(path))
+
+  def test_Concurrency(self):
+    contents = [os.urandom(1000 * (i + 5)) for i in range(10)]
+    async def put():
+      return await asyncio.gather(*(self.AsyncClient.PutStream(AsyncReader(data, 1500)) for data in contents))
+    hashes = self.arun(put())
+    self.assertEqual(hashes, [hashlib.sha1(data).hexdigest() for data in contents])
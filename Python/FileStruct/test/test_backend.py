@@ -0,0 +1,140 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import io
+import os
+import threading
+import time
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.backend
+
+
+
+class SlowBackend(FileStruct.backend.MemoryBackend):
+  # Holds every GetStream() long enough for other threads to pile up
+  def GetStream(self, hash):
+    time.sleep(0.1)
+    return super(SlowBackend, self).GetStream(hash)
+
+
+
+class TestClientBackend(TestClientOps):
+
+  def setUp(self):
+    super(TestClientBackend, self).setUp()
+    self.Backend = FileStruct.backend.MemoryBackend({self.FileHashNX: self.FileContentsNX})
+    self.RemoteClient = FileStruct.Client(self.Path, Backend=self.Backend)
+
+  def test_NoBackend(self):
+    self.assertIsNone(self.Client.Backend)
+    self.assertNotIn(self.FileHashNX, self.Client)
+    with self.assertRaises(KeyError):
+      self.Client[self.FileHashNX]
+
+  def test_Fetch(self):
+    client = self.RemoteClient
+    self.assertIn(self.FileHashNX, client)
+    # Checking does not fetch
+    self.assertFalse(exists(self.FilePathNX))
+    self.assertEqual(self.Backend.Gets, 0)
+
+    self.assertEqual(client[self.FileHashNX].GetData(), self.FileContentsNX)
+    self.assertTrue(exists(self.FilePathNX))
+    self.assertEqual(self.Backend.Gets, 1)
+    self.assertEqual(client[self.FileHashNX].GetData(), self.FileContentsNX)
+    self.assertEqual(self.Backend.Gets, 1)
+    self.assertEqual(os.listdir(client.TempPath), [])
+
+  def test_Local(self):
+    client = self.RemoteClient
+    self.assertEqual(client[self.FileHash].GetData(), self.FileContents)
+    self.assertEqual(self.Backend.Gets, 0)
+
+  def test_Missing(self):
+    client = self.RemoteClient
+    self.assertNotIn(self.FileHashEmpty, client)
+    with self.assertRaises(KeyError):
+      client[self.FileHashEmpty]
+    self.assertEqual(self.Backend.Gets, 1)
+    for hash in self.FileHashInvalidList:
+      self.assertNotIn(hash, client)
+      with self.assertRaises(ValueError):
+        client[hash]
+
+  def test_Corrupt(self):
+    self.Backend.Objects[self.FileHashNX] = b'not abcde'
+    with self.assertRaises(FileStruct.Error):
+      self.RemoteClient[self.FileHashNX]
+    self.assertFalse(exists(self.FilePathNX))
+    self.assertEqual(os.listdir(self.RemoteClient.TempPath), [])
+
+  def test_SingleFlight(self):
+    backend = SlowBackend(self.Backend.Objects)
+    client = FileStruct.Client(self.Path, Backend=backend)
+    results = []
+    def get():
+      results.append(client[self.FileHashNX].GetData())
+    threads = [threading.Thread(target=get) for i in range(8)]
+    for t in threads:
+      t.start()
+    for t in threads:
+      t.join()
+    self.assertEqual(results, [self.FileContentsNX] * 8)
+    self.assertEqual(backend.Gets, 1)
+
+  def test_SingleFlightError(self):
+    flights = FileStruct.backend.SingleFlight()
+    started = threading.Event()
+    def fail():
+      started.set()
+      time.sleep(0.1)
+      raise self.UnhandledTestException()
+    errors = []
+    def call():
+      try:
+        flights.Do('key', fail)
+      except self.UnhandledTestException as e:
+        errors.append(e)
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=call)
+    follower.start()
+    leader.join()
+    follower.join()
+    self.assertEqual(len(errors), 2)
+    # Nothing is remembered once the flight is over
+    self.assertEqual(flights.Do('key', lambda: 42), 42)
+
+  def test_DirectoryBackend(self):
+    backend = FileStruct.backend.DirectoryBackend(join(self.Path, 'Remote'))
+    self.assertFalse(backend.Contains(self.FileHashNX))
+    with self.assertRaises(KeyError):
+      backend.GetStream(self.FileHashNX)
+    backend.Put(self.FileHashNX, io.BytesIO(self.FileContentsNX))
+    self.assertTrue(backend.Contains(self.FileHashNX))
+    self.assertEqual(os.listdir(os.path.dirname(backend.HashToPath(self.FileHashNX))), [self.FileHashNX])
+
+    client = FileStruct.Client(self.Path, Backend=backend)
+    self.assertEqual(client[self.FileHashNX].GetData(), self.FileContentsNX)
+
+    backend.Delete(self.FileHashNX)
+    backend.Delete(self.FileHashNX)
+    self.assertFalse(backend.Contains(self.FileHashNX))
@@ -0,0 +1,105 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join
+import io
+import hashlib
+import threading
+
+from .test_core import FileStruct, TestClientOps
+
+
+
+class TestClientPutMany(TestClientOps):
+
+  def setUp(self):
+    super(TestClientPutMany, self).setUp()
+    self.Contents = [str(i).encode('ascii') * (i + 1) for i in range(50)]
+    self.Hashes = [hashlib.sha1(data).hexdigest() for data in self.Contents]
+
+  def write_files(self):
+    paths = []
+    for i, data in enumerate(self.Contents):
+      paths.append(join(self.Path, 'file{0}'.format(i)))
+      with open(paths[-1], 'wb') as f:
+        f.write(data)
+    return paths
+
+  def test_Ordered(self):
+    results = list(self.Client.PutMany(self.Contents, Workers=4))
+    self.assertEqual([r.Index for r in results], list(range(len(self.Contents))))
+    self.assertEqual([r.Hash for r in results], self.Hashes)
+    self.assertEqual([r.Error for r in results], [None] * len(self.Contents))
+    for file_hash, data in zip(self.Hashes, self.Contents):
+      self.assertEqual(self.Client[file_hash].GetData(), data)
+
+  def test_Unordered(self):
+    results = list(self.Client.PutMany(iter(self.Contents), Workers=4, Ordered=False))
+    self.assertEqual(sorted(r.Index for r in results), list(range(len(self.Contents))))
+    for r in results:
+      self.assertEqual(r.Hash, self.Hashes[r.Index])
+      self.assertIs(r.Item, self.Contents[r.Index])
+
+  def test_MixedItems(self):
+    paths = self.write_files()
+    items = [self.Contents[0], paths[1], io.BytesIO(self.Contents[2]), bytearray(self.Contents[3])]
+    self.assertEqual([r.Hash for r in self.Client.PutMany(items)], self.Hashes[:4])
+
+  def test_PutFiles(self):
+    paths = self.write_files()
+    results = list(self.Client.PutFiles(paths, Workers=3, Mode='auto'))
+    self.assertEqual([r.Hash for r in results], self.Hashes)
+    self.assertEqual([r.Item for r in results], paths)
+    # bytes are paths here, not data
+    results = list(self.Client.PutFiles([paths[0].encode('utf-8'), self.Contents[0]]))
+    self.assertEqual(results[0].Hash, self.Hashes[0])
+    self.assertIsInstance(results[1].Error, FileNotFoundError)
+
+  def test_Errors(self):
+    items = [self.Contents[0], object(), join(self.Path, 'nx'), self.Contents[1], 'asdx']
+    results = list(self.Client.PutMany(items))
+    self.assertEqual(results[0].Hash, self.Hashes[0])
+    self.assertIsInstance(results[1].Error, TypeError)
+    self.assertIsInstance(results[2].Error, FileNotFoundError)
+    self.assertEqual(results[3].Hash, self.Hashes[1])
+    self.assertIsInstance(results[4].Error, FileNotFoundError)
+    for r in results:
+      self.assertTrue((r.Hash is None) != (r.Error is None))
+
+  def test_Backpressure(self):
+    consumed = []
+    release = threading.Event()
+    class Slow(io.BytesIO):
+      def read(self, *args):
+        release.wait(5)
+        return super().read(*args)
+    def items():
+      for i in range(20):
+        consumed.append(i)
+        yield Slow(self.Contents[i])
+    results = self.Client.PutMany(items(), Workers=2, MaxPending=3)
+    next_result = threading.Thread(target=lambda: next(results))
+    next_result.start()
+    next_result.join(0.2)
+    self.assertEqual(len(consumed), 3)
+    release.set()
+    next_result.join()
+    self.assertEqual(len(list(results)), 19)
+
+  def test_Empty(self):
+    self.assertEqual(list(self.Client.PutMany([])), [])
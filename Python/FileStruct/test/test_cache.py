@@ -0,0 +1,191 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import unittest
+import os
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.cache
+
+
+
+class TestExistsCache(unittest.TestCase):
+
+  def test_LRU(self):
+    cache = FileStruct.cache.ExistsCache(2)
+    cache.Add('a')
+    cache.Add('b')
+    self.assertTrue('a' in cache) # 'a' is now most recent
+    cache.Add('c')
+    self.assertTrue('a' in cache)
+    self.assertFalse('b' in cache)
+    self.assertEqual(len(cache), 2)
+    self.assertEqual(cache.Hits, 2)
+    self.assertEqual(cache.Misses, 1)
+
+  def test_Invalidate(self):
+    cache = FileStruct.cache.ExistsCache(10)
+    cache.Add('a')
+    cache.Add('b')
+    cache.Discard('a')
+    cache.Discard('nx')
+    self.assertFalse('a' in cache)
+    self.assertTrue('b' in cache)
+    cache.Clear()
+    self.assertEqual(len(cache), 0)
+
+  def test_Stats(self):
+    cache = FileStruct.cache.ExistsCache(10)
+    self.assertEqual(cache.Stats()['HitRate'], 0.0)
+    cache.Add('a')
+    'a' in cache
+    'b' in cache
+    self.assertEqual(cache.Stats(), {'Size': 1, 'MaxSize': 10, 'Hits': 1, 'Misses': 1, 'HitRate': 0.5})
+
+  def test_InvalidSize(self):
+    for size in [0, -1]:
+      with self.assertRaises(ValueError):
+        FileStruct.cache.ExistsCache(size)
+
+
+
+class TestClientExistsCache(TestClientOps):
+
+  def setUp(self):
+    super(TestClientExistsCache, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, ExistsCacheSize=100)
+
+  def test_Disabled(self):
+    self.assertIsNone(FileStruct.Client(self.Path).ExistsCache)
+
+  def test_Hits(self):
+    self.assertTrue(self.FileHash in self.Client)
+    self.assertEqual(self.Client.ExistsCache.Misses, 1)
+    self.assertTrue(self.FileHash in self.Client)
+    self.assertTrue(self.Client[self.FileHash])
+    self.assertEqual(self.Client[self.FileHash].Path, self.Client.HashToPath(self.FileHash))
+    self.assertEqual(self.Client.ExistsCache.Hits, 3)
+
+  def test_Ingest(self):
+    file_hash = self.Client.PutData(self.FileContentsNX)
+    self.assertTrue(file_hash in self.Client)
+    self.assertEqual(self.Client.ExistsCache.Hits, 1)
+
+  def test_NegativeNotCached(self):
+    self.assertFalse(self.FileHashNX in self.Client)
+    FileStruct.Client(self.Path).PutData(self.FileContentsNX)
+    self.assertTrue(self.FileHashNX in self.Client)
+
+  def test_InvalidateCache(self):
+    self.assertTrue(self.FileHash in self.Client)
+    os.unlink(self.Client.HashToPath(self.FileHash))
+    self.assertTrue(self.FileHash in self.Client) # stale until invalidated
+    self.Client.InvalidateCache(self.FileHash)
+    self.assertFalse(self.FileHash in self.Client)
+    with self.assertRaises(KeyError):
+      self.Client[self.FileHash]
+    self.Client.PutData(self.FileContents)
+    self.assertTrue(self.FileHash in self.Client)
+    self.Client.InvalidateCache()
+    self.assertEqual(len(self.Client.ExistsCache), 0)
+
+  def test_InvalidHashes(self):
+    for bad_hash in self.FileHashInvalidList:
+      self.assertFalse(bad_hash in self.Client)
+      with self.assertRaises(ValueError):
+        self.Client[bad_hash]
+    for bad_type in self.FileHashInvalidType:
+      with self.assertRaises(TypeError):
+        bad_type in self.Client
+      with self.assertRaises(TypeError):
+        self.Client[bad_type]
+
+
+
+class TestObjectCache(unittest.TestCase):
+
+  def test_Budget(self):
+    cache = FileStruct.cache.ObjectCache(10, 4)
+    cache.Add('a', b'aaaa')
+    cache.Add('b', b'bbbb')
+    self.assertEqual(cache.Get('a'), b'aaaa') # 'a' is now most recent
+    cache.Add('c', b'cc')
+    self.assertEqual(cache.Bytes, 10)
+    cache.Add('d', b'd')
+    self.assertIsNone(cache.Get('b'))
+    self.assertEqual(cache.Get('a'), b'aaaa')
+    self.assertEqual(cache.Bytes, 7)
+    cache.Add('big', b'12345')
+    self.assertFalse('big' in cache)
+    self.assertEqual(cache.Stats(), {
+      'Size': 3, 'Bytes': 7, 'MaxBytes': 10, 'MaxObjectSize': 4,
+      'Hits': 2, 'Misses': 1, 'HitRate': 2 / 3, 'BytesSaved': 8})
+
+  def test_Invalidate(self):
+    cache = FileStruct.cache.ObjectCache(100, 100)
+    cache.Add('a', bytearray(b'aa'))
+    self.assertIsInstance(cache.Get('a'), bytes)
+    cache.Add('a', b'aaa')
+    self.assertEqual(cache.Bytes, 3)
+    cache.Discard('a')
+    cache.Discard('nx')
+    self.assertEqual((len(cache), cache.Bytes), (0, 0))
+    cache.Add('b', b'b')
+    cache.Clear()
+    self.assertEqual((len(cache), cache.Bytes), (0, 0))
+
+  def test_InvalidSize(self):
+    for size in [0, -1]:
+      with self.assertRaises(ValueError):
+        FileStruct.cache.ObjectCache(size, 10)
+      with self.assertRaises(ValueError):
+        FileStruct.cache.ObjectCache(10, size)
+
+
+
+class TestClientObjectCache(TestClientOps):
+
+  def setUp(self):
+    super(TestClientObjectCache, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, ObjectCacheSize=1000, ObjectCacheMaxObject=100)
+
+  def test_Disabled(self):
+    self.assertIsNone(FileStruct.Client(self.Path).ObjectCache)
+
+  def test_Hits(self):
+    for i in range(3):
+      self.assertEqual(self.Client[self.FileHash].GetData(), self.FileContents)
+    stats = self.Client.ObjectCache.Stats()
+    self.assertEqual((stats['Hits'], stats['Misses'], stats['BytesSaved']), (2, 1, 2 * len(self.FileContents)))
+
+    # Served from memory, without opening the file
+    os.chmod(self.Client[self.FileHash].Path, 0)
+    os.rename(self.Client[self.FileHash].Path, self.Client[self.FileHash].Path + '.moved')
+    self.assertEqual(self.Client[self.FileHash].GetData(), self.FileContents)
+    self.assertTrue(self.FileHash in self.Client)
+
+    self.Client.InvalidateCache(self.FileHash)
+    self.assertFalse(self.FileHash in self.Client)
+
+  def test_Large(self):
+    data = os.urandom(101)
+    file_hash = self.Client.PutData(data)
+    self.assertEqual(self.Client[file_hash].GetData(), data)
+    self.assertEqual(self.Client[file_hash].GetData(), data)
+    self.assertEqual(self.Client.ObjectCache.Hits, 0)
+    self.assertEqual(len(self.Client.ObjectCache), 0)
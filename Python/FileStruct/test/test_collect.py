@@ -0,0 +1,149 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists, isfile
+import os
+import fcntl
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.collect
+
+
+
+class TestClientCollectGarbage(TestClientOps):
+
+  # Negative, so that the objects created by the test itself are old enough
+  GracePeriod = -60
+
+  def setUp(self):
+    super(TestClientCollectGarbage, self).setUp()
+    self.Hashes = [self.Client.PutData(str(i).encode('ascii')) for i in range(100)]
+    self.Keep = self.Hashes[::3] + [self.FileHash]
+    self.Garbage = sorted(set(self.Hashes) - set(self.Keep))
+
+  def check_collected(self, stats):
+    for file_hash in self.Keep:
+      self.assertTrue(file_hash in self.Client)
+    for file_hash in self.Garbage:
+      self.assertFalse(file_hash in self.Client)
+      self.assertTrue(isfile(join(stats['TrashPath'], file_hash)))
+    self.assertEqual(sorted(os.listdir(stats['TrashPath'])), self.Garbage)
+    self.assertEqual(stats['Kept'], len(self.Keep))
+    self.assertEqual(stats['Trashed'], len(self.Garbage))
+    self.assertEqual(stats['TrashedBytes'], sum(os.stat(join(stats['TrashPath'], h)).st_size for h in self.Garbage))
+    self.assertTrue(stats['TrashPath'].startswith(self.Client.TrashPath))
+    self.assertFalse(exists(self.Client.GCLogPath))
+    self.assertEqual(os.listdir(self.Client.TempPath), ['GC.lock'])
+
+  def test_Collect(self):
+    self.check_collected(self.Client.CollectGarbage(iter(self.Keep), self.GracePeriod, Workers=1))
+
+  def test_CollectParallel(self):
+    self.check_collected(self.Client.CollectGarbage(iter(self.Keep), self.GracePeriod, Workers=2))
+
+  def test_GracePeriod(self):
+    stats = self.Client.CollectGarbage([], Workers=1)
+    self.assertEqual(stats['Trashed'], 0)
+    self.assertEqual(stats['Recent'], len(self.Hashes) + 1)
+    self.assertIsNone(stats['TrashPath'])
+    for file_hash in self.Hashes:
+      self.assertTrue(file_hash in self.Client)
+
+  def test_InvalidKeep(self):
+    with self.assertRaises(ValueError):
+      self.Client.CollectGarbage(self.Keep + ['nothash'], self.GracePeriod, Workers=1)
+    with self.assertRaises(TypeError):
+      self.Client.CollectGarbage(self.Keep + [None], self.GracePeriod, Workers=1)
+    for file_hash in self.Hashes:
+      self.assertTrue(file_hash in self.Client)
+    self.assertFalse(exists(self.Client.GCLogPath))
+
+  def test_WritersDuringCollection(self):
+    writer = FileStruct.Client(self.Path)
+    def keep():
+      yield from self.Keep
+      # Content that is already stored, written while the collection runs
+      self.assertTrue(exists(self.Client.GCLogPath))
+      self.assertEqual(writer.PutData(b'1'), self.Hashes[1])
+    stats = self.Client.CollectGarbage(keep(), self.GracePeriod, Workers=1)
+    self.assertEqual(stats['Restored'], 1)
+    self.assertTrue(self.Hashes[1] in self.Client)
+    self.Keep.append(self.Hashes[1])
+    self.Garbage.remove(self.Hashes[1])
+    self.check_collected(stats)
+
+  def collect_storing(self, client, store):
+    # Collects with store() run right after the sweep, as a writer would
+    collector = FileStruct.collect.GarbageCollector(client, self.GracePeriod, Workers=1)
+    sweepall = collector._sweepall
+    def sweep(*args):
+      rval = sweepall(*args)
+      store()
+      return rval
+    collector._sweepall = sweep
+    return collector.Run(self.Keep)
+
+  def test_StoredAgainAndWanted(self):
+    # Stored again by one writer, then found by another writer's dedup
+    writer = FileStruct.Client(self.Path)
+    def store():
+      self.assertEqual(writer.PutData(b'1'), self.Hashes[1])
+      self.assertEqual(writer.PutData(b'1'), self.Hashes[1])
+    self.Garbage = [self.Hashes[1]]
+    self.Keep = sorted(set(self.Hashes) - set(self.Garbage)) + [self.FileHash]
+    stats = self.collect_storing(self.Client, store)
+    self.assertEqual((stats['Restored'], stats['Trashed']), (1, 0))
+    self.assertIsNone(stats['TrashPath'])
+    self.assertEqual(os.listdir(self.Client.TrashPath), [])
+    self.assertTrue(self.Hashes[1] in self.Client)
+
+  def test_StoredAgain(self):
+    client = FileStruct.Client(self.Path, ExistsCacheSize=1000, Index=True)
+    client.RebuildIndex()
+    writer = FileStruct.Client(self.Path, Index=True)
+    stats = self.collect_storing(client, lambda: writer.PutData(b'1'))
+    self.assertEqual(stats['Restored'], 1)
+    self.Keep.append(self.Hashes[1])
+    self.Garbage.remove(self.Hashes[1])
+    self.check_collected(stats)
+    self.assertTrue(self.Hashes[1] in client.Index)
+    self.assertEqual(sorted(client.Index), sorted(self.Keep))
+
+  def test_Concurrent(self):
+    fd = os.open(join(self.Client.TempPath, 'GC.lock'), os.O_RDWR | os.O_CREAT)
+    try:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      with self.assertRaises(FileStruct.Error):
+        self.Client.CollectGarbage(self.Keep, self.GracePeriod, Workers=1)
+    finally:
+      os.close(fd)
+
+  def test_StaleLog(self):
+    open(self.Client.GCLogPath, 'w').close()
+    self.check_collected(self.Client.CollectGarbage(self.Keep, self.GracePeriod, Workers=1))
+
+  def test_Caches(self):
+    client = FileStruct.Client(self.Path, ExistsCacheSize=1000, Index=True)
+    try:
+      client.RebuildIndex()
+      self.assertTrue(self.Garbage[0] in client)
+      stats = client.CollectGarbage(self.Keep, self.GracePeriod, Workers=1)
+      self.assertFalse(self.Garbage[0] in client)
+      self.assertEqual(sorted(client.Index), sorted(self.Keep))
+    finally:
+      client.Index.close()
@@ -0,0 +1,143 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import gzip
+import os
+import stat
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.compress
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+
+
+class TestClientCompress(TestClientOps):
+
+  def setUp(self):
+    super(TestClientCompress, self).setUp()
+    self.Text = b'{"name": "FileStruct", "values": [1, 2, 3]}\n' * 100
+    self.Random = os.urandom(10000)
+
+  def test_Args(self):
+    with self.assertRaises(ValueError):
+      FileStruct.compress.Compressor(self.Client, 'zip')
+    with self.assertRaises(ValueError):
+      FileStruct.compress.Compressor(self.Client, ())
+    with self.assertRaises(ValueError):
+      FileStruct.compress.Compressor(self.Client, MaxRatio=0)
+    with self.assertRaises(ValueError):
+      FileStruct.Client(self.Path, Compress='zip')
+
+  def test_Ingest(self):
+    client = FileStruct.Client(self.Path, Compress='gzip')
+    text = client.PutData(self.Text)
+    small = client.PutData(b'small' * 10)
+    random = client.PutData(self.Random)
+    client.Compressor.Wait()
+
+    path = client.HashToPath(text) + '.gz'
+    with open(path, 'rb') as f:
+      self.assertEqual(gzip.decompress(f.read()), self.Text)
+    self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o444)
+    self.assertFalse(exists(client.HashToPath(small) + '.gz'))
+    self.assertFalse(exists(client.HashToPath(random) + '.gz'))
+    stats = client.Compressor.Stats()
+    self.assertEqual((stats['Compressed'], stats['Skipped'], stats['Pending']), (1, 1, 0))
+    self.assertLess(stats['CompressedBytes'], stats['Bytes'])
+
+    # The same content always gives the same sidecar
+    with open(path, 'rb') as f:
+      first = f.read()
+    os.unlink(path)
+    self.assertEqual(client.Compressor.Compress(text), 'Compressed')
+    with open(path, 'rb') as f:
+      self.assertEqual(f.read(), first)
+    self.assertEqual(client.Compressor.Compress(text), 'Present')
+
+  def test_Run(self):
+    text = self.Client.PutData(self.Text)
+    self.Client.PutData(self.Random)
+    orphan = join(os.path.dirname(self.Client.HashToPath(self.FileHashNX)), self.FileHashNX + '.gz')
+    self.Client._makeshard(self.FileHashNX)
+    with open(orphan, 'wb') as f:
+      f.write(b'orphan')
+
+    stats = FileStruct.compress.Compressor(self.Client).Run()
+    self.assertEqual((stats['Compressed'], stats['Skipped'], stats['Orphans']), (1, 2, 1))
+    self.assertTrue(exists(self.Client.HashToPath(text) + '.gz'))
+    self.assertFalse(exists(orphan))
+    # Objects with their sidecars are not looked at again
+    stats = FileStruct.compress.Compressor(self.Client).Run()
+    self.assertEqual((stats['Compressed'], stats['Skipped']), (0, 2))
+
+  def test_Brotli(self):
+    if brotli is None:
+      with self.assertRaises(FileStruct.ConfigError):
+        FileStruct.Client(self.Path, Compress=('gzip', 'br'))
+      self.skipTest('brotli is not installed')
+    client = FileStruct.Client(self.Path, Compress=('gzip', 'br'))
+    hash = client.PutData(self.Text)
+    client.Compressor.Wait()
+    with open(client.HashToPath(hash) + '.br', 'rb') as f:
+      self.assertEqual(brotli.decompress(f.read()), self.Text)
+    self.assertTrue(FileStruct.compress.VerifySidecar(client, hash, client.HashToPath(hash) + '.br'))
+
+  def test_Collect(self):
+    keep = self.Client.PutData(self.Text)
+    drop = self.Client.PutData(self.Text + b'drop')
+    FileStruct.compress.Compressor(self.Client).Run()
+    stats = self.Client.CollectGarbage([keep, self.FileHash], GracePeriod=0, Workers=1)
+    self.assertEqual(stats['Trashed'], 1)
+    self.assertTrue(exists(self.Client.HashToPath(keep) + '.gz'))
+    self.assertFalse(exists(self.Client.HashToPath(drop) + '.gz'))
+    self.assertEqual(sorted(os.listdir(stats['TrashPath'])), [drop, drop + '.gz'])
+
+  def test_Evict(self):
+    hash = self.Client.PutData(self.Text)
+    FileStruct.compress.Compressor(self.Client).Run()
+    stats = self.Client.Evict(MaxObjects=1, LowWater=0.5, GracePeriod=0, Pinned={self.FileHash})
+    self.assertEqual(sorted(os.listdir(stats['TrashPath'])), [hash, hash + '.gz'])
+
+  def test_Scrub(self):
+    good = self.Client.PutData(self.Text)
+    bad = self.Client.PutData(self.Text + b'bad')
+    rotten = self.Client.PutData(self.Text + b'rotten')
+    FileStruct.compress.Compressor(self.Client).Run()
+
+    # A sidecar of other content, and an object gone bad
+    path = self.Client.HashToPath(bad) + '.gz'
+    os.chmod(path, 0o644)
+    with open(path, 'wb') as f:
+      f.write(gzip.compress(b'something else'))
+    path = self.Client.HashToPath(rotten)
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+      f.write(b'X')
+
+    stats = self.Client.Scrub(Workers=1)
+    self.assertEqual((stats['Corrupt'], stats['CorruptSidecars']), (1, 1))
+    self.assertTrue(exists(self.Client.HashToPath(good) + '.gz'))
+    self.assertFalse(exists(self.Client.HashToPath(bad) + '.gz'))
+    self.assertEqual(sorted(os.listdir(stats['QuarantinePath'])), [rotten, rotten + '.gz'])
+    # The sidecar still has what the object used to be
+    self.assertTrue(FileStruct.compress.VerifySidecar(self.Client, rotten, join(stats['QuarantinePath'], rotten + '.gz')))
@@ -45,6 +45,7 @@ except ImportError:
     import FileStruct
   finally:
     sys.path.pop(0)
+import FileStruct.image
 
 
 
@@ -103,6 +104,58 @@ class TestClientBasic(TestClientBase):
     self.client_from_config({'Version': 1, 'WhateverKey': 2, 3: 'SomeValue'})
     self.client_from_config({'Version': 1, 'User': 'whoever', 'Group': 'whatever'})
 
+  def test_Open(self):
+    self.write_config(self.ValidConfig, False)
+    client = FileStruct.Client.Open(self.Path)
+    self.assertIs(FileStruct.Client.Open(self.Path + '/'), client)
+    self.assertIsNot(FileStruct.Client.Open(self.Path, '/Other'), client)
+    self.assertIsNot(FileStruct.Client.Open(self.Path, SpoolSize=0), client)
+    self.assertIs(FileStruct.Client.Open(self.Path), client)
+    # Sequence options, as Compress may be
+    compressing = FileStruct.Client.Open(self.Path, Compress=['gzip'])
+    self.assertIs(FileStruct.Client.Open(self.Path, Compress=['gzip']), compressing)
+    compressing.PutData(b'{"compress": "me"}' * 100)
+
+    # A changed config file means a new Client; the old one stays usable by
+    # whoever still holds it
+    st = os.stat(self.PathConfig)
+    self.write_config({'Version': 2, 'Hash': 'sha256'})
+    os.utime(self.PathConfig, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    client2 = FileStruct.Client.Open(self.Path)
+    self.assertIsNot(client2, client)
+    self.assertEqual(client2.HashName, 'sha256')
+    self.assertIsNot(FileStruct.Client.Open(self.Path, Compress=['gzip']), compressing)
+    data = b'{"compress": "me", "again": true}' * 100
+    self.assertEqual(compressing[compressing.PutData(data)].GetData(), data)
+    compressing.close()
+
+    self.write_config('{"Version": ', False)
+    with self.assertRaises(FileStruct.ConfigError):
+      FileStruct.Client.Open(self.Path)
+
+  def test_Closed(self):
+    self.write_config(self.ValidConfig, False)
+    client = FileStruct.Client(self.Path, Index=True, PackThreshold=100)
+    packed = client[client.PutData(b'packed')]
+    stored = client.PutData(b'stored' * 100)
+    client.close()
+    client.close()
+    with self.assertRaises(FileStruct.Error):
+      client.PutData(b'more')
+    with self.assertRaises(FileStruct.Error):
+      client[stored]
+    with self.assertRaises(FileStruct.Error):
+      stored in client
+    with self.assertRaises(FileStruct.Error):
+      packed.GetData()
+
+  def test_DataNotDir(self):
+    self.write_config(self.ValidConfig, False)
+    with open(join(self.Path, 'Data'), 'w') as f:
+      f.write('not a directory')
+    with self.assertRaises(FileStruct.ConfigError):
+      FileStruct.Client(self.Path)
+
   def test_UserGroup(self):
     self.client_from_config({'Version': 1, 'User': 123, 'Group': 456})
     self.client_from_config({'Version': 1, 'User': 'one', 'Group': 'two'})
@@ -155,9 +208,18 @@ class TestClientInvalidConfig(TestClientBase):
 
   def test_Version(self):
     # Allow for any positive-int one
-    for ver in [-1,0,'1beta','beta1','-1','a','1a','123b',[]]:
+    for ver in [-1,0,'1beta','beta1','-1','a','1a','123b',[],3]:
       self.client_from_config_err({'Version': ver})
 
+  def test_Hash(self):
+    self.assertEqual(self.client_from_config({'Version': 1}).HashName, 'sha1')
+    for name, length in [('sha1', 40), ('sha256', 64), ('blake2b', 64)]:
+      client = self.client_from_config({'Version': 2, 'Hash': name})
+      self.assertEqual((client.HashName, client.HashLength), (name, length))
+    for name in [None, 'md5', 'SHA1', 1]:
+      self.client_from_config_err({'Version': 2, 'Hash': name})
+    self.client_from_config_err({'Version': 2})
+
   def test_NoConfig(self):
     self.assertFalse(exists(self.PathConfig))
 
@@ -318,6 +380,7 @@ class TestClientOps(TestClientBase):
     random.seed(42)
     self.FileHashInvalidList = [
       self.FileHash[:-1] + '\0',
+      self.FileHash[:-1] + '\n',
       'x' + self.FileHash[1:],
       '123',
       'варвр',
@@ -626,6 +689,48 @@ class TestClientFile(TestClientOps, ClientGetTestsMixin):
       finally:
         os.unlink(self.FilePathNX)
 
+  def test_FileModes(self):
+    for mode in ['link', 'copy_file_range', 'auto']:
+      with tempfile.NamedTemporaryFile(dir=self.Path) as tmp:
+        tmp.write(self.FileContentsNX + mode.encode('ascii'))
+        tmp.flush()
+        file_hash = self.Client.PutFile(tmp.name, Mode=mode)
+        self.assertEqual(file_hash, hashlib.sha1(self.FileContentsNX + mode.encode('ascii')).hexdigest())
+        self.assertEqual(self.Client[file_hash].GetData(), self.FileContentsNX + mode.encode('ascii'))
+        self.assertEqual(os.stat(tmp.name).st_ino == os.stat(self.Client[file_hash].Path).st_ino, mode == 'link')
+        self.assertEqual(os.stat(self.Client[file_hash].Path).st_mode & 0o777, 0o444)
+        self.assertTrue(isfile(tmp.name))
+
+  def test_FileModeReflink(self):
+    with tempfile.NamedTemporaryFile(dir=self.Path) as tmp:
+      tmp.write(self.FileContentsNX)
+      tmp.flush()
+      try:
+        file_hash = self.Client.PutFile(tmp.name, Mode='reflink')
+      except OSError: # filesystem without reflink support
+        self.assertFalse(self.FileHashNX in self.Client)
+      else:
+        self.assertEqual(file_hash, self.FileHashNX)
+        self.assertEqual(self.Client[file_hash].GetData(), self.FileContentsNX)
+
+  def test_FileModeExisting(self):
+    with tempfile.NamedTemporaryFile(dir=self.Path) as tmp:
+      tmp.write(self.FileContents)
+      tmp.flush()
+      inode = os.stat(self.Client[self.FileHash].Path).st_ino
+      self.assertEqual(self.Client.PutFile(tmp.name, Mode='link'), self.FileHash)
+      self.assertEqual(os.stat(self.Client[self.FileHash].Path).st_ino, inode)
+      self.assertNotEqual(os.stat(tmp.name).st_mode & 0o777, 0o444)
+
+  def test_FileModeFail(self):
+    with tempfile.NamedTemporaryFile(dir=self.Path) as tmp:
+      with self.assertRaises(ValueError):
+        self.Client.PutFile(tmp.name, Mode='whatever')
+      with self.assertRaises(TypeError):
+        self.Client.PutFile(tmp.fileno(), Mode='link')
+    with self.assertRaises(FileNotFoundError):
+      self.Client.PutFile(self.FilePathNX, Mode='auto')
+
   def test_Data(self):
     file_hash = self.Client.PutData(self.FileContentsNX)
     self.assertEqual(file_hash, self.FileHashNX)
@@ -646,6 +751,62 @@ class TestClientFile(TestClientOps, ClientGetTestsMixin):
       self.Client.PutData('asdx')
 
 
+  def test_DedupNoWrite(self):
+    def no_tempfile():
+      raise AssertionError('Temp file used for content that is already stored')
+    self.Client._tempfile = no_tempfile
+    self.assertEqual(self.Client.PutData(self.FileContents), self.FileHash)
+    self.assertEqual(self.Client.PutData(bytearray(self.FileContents)), self.FileHash)
+    self.assertEqual(self.Client.PutStream(io.BytesIO(self.FileContents)), self.FileHash)
+    with self.assertRaises(AssertionError):
+      self.Client.PutData(self.FileContentsNX)
+
+  def test_SpoolSize(self):
+    data = os.urandom(100000)
+    for spool_size in [0, 1, 99999, 100000, 100001]:
+      client = FileStruct.Client(self.Path, SpoolSize=spool_size)
+      self.assertEqual(client.SpoolSize, spool_size)
+      file_hash = client.PutStream(io.BytesIO(data))
+      self.assertEqual(file_hash, hashlib.sha1(data).hexdigest())
+      self.assertEqual(client[file_hash].GetData(), data)
+      os.unlink(client[file_hash].Path)
+
+  def test_GetView(self):
+    data = os.urandom(100000)
+    file_obj = self.Client[self.Client.PutData(data)]
+    view = file_obj.GetView()
+    self.assertTrue(view.readonly)
+    self.assertEqual(len(view), len(data))
+    self.assertEqual(view[1000:2000], data[1000:2000])
+    self.assertEqual(bytes(view), data)
+    with self.assertRaises(TypeError):
+      view[0] = 0
+
+    empty = self.Client[self.Client.PutData(b'')].GetView()
+    self.assertEqual(len(empty), 0)
+    self.assertEqual(bytes(empty), b'')
+
+  def test_GetRange(self):
+    data = os.urandom(100000)
+    file_obj = self.Client[self.Client.PutData(data)]
+    self.assertEqual(file_obj.GetRange(0, 10), data[:10])
+    self.assertEqual(file_obj.GetRange(5000, 12345), data[5000:17345])
+    self.assertEqual(file_obj.GetRange(99990, 100), data[99990:])
+    self.assertEqual(file_obj.GetRange(100000, 10), b'')
+    self.assertEqual(file_obj.GetRange(200000, 10), b'')
+    self.assertEqual(file_obj.GetRange(10, 0), b'')
+    with self.assertRaises(ValueError):
+      file_obj.GetRange(-1, 10)
+    with self.assertRaises(ValueError):
+      file_obj.GetRange(0, -10)
+
+  def test_StreamRead(self):
+    data = os.urandom(300000)
+    for limit in [0, 1, 1000, 299999, 300000, 10**6]:
+      stream = io.BytesIO(data)
+      self.assertEqual(bytes(FileStruct.core.StreamRead(stream, limit)), data[:limit])
+      self.assertEqual(stream.read(), data[limit:])
+
   def test_HashConsistency(self):
     file_hash = self.Client.PutData(self.FileContentsNX)
     self.assertEqual(file_hash, self.FileHashNX)
@@ -703,6 +864,142 @@ class TestClientFile(TestClientOps, ClientGetTestsMixin):
 
 
 
+class TestClientShards(TestClientOps):
+
+  @contextlib.contextmanager
+  def count_calls(self, *names):
+    calls, saved = [], {}
+    for name in names:
+      func = saved[name] = getattr(FileStruct.core.os, name)
+      setattr(FileStruct.core.os, name, lambda *a, _n=name, _f=func, **kw: calls.append(_n) or _f(*a, **kw))
+    isdir = FileStruct.core.isdir
+    FileStruct.core.isdir = lambda path: calls.append('isdir') or isdir(path)
+    try:
+      yield calls
+    finally:
+      for name, func in saved.items():
+        setattr(FileStruct.core.os, name, func)
+      FileStruct.core.isdir = isdir
+
+  def test_KnownShard(self):
+    # Only the first object in a shard checks for its directories
+    with self.count_calls() as calls:
+      file_hash = self.Client.PutData(b'first')
+    self.assertEqual(calls.count('isdir'), 2)
+    os.unlink(self.Client[file_hash].Path)
+
+    names = ('chown', 'chmod', 'fchown', 'fchmod', 'mkdir', 'rmdir', 'stat', 'rename', 'unlink')
+    with self.count_calls(*names) as calls:
+      self.assertEqual(self.Client.PutData(b'first'), file_hash)
+    self.assertEqual(sorted(calls), ['fchmod', 'fchown', 'rename', 'stat'])
+    with self.count_calls(*names) as calls:
+      self.assertEqual(self.Client.PutData(b'first'), file_hash)
+    self.assertEqual(calls, ['stat'])
+    self.assertEqual(self.Client[file_hash].GetData(), b'first')
+    self.assertEqual(os.listdir(self.Client.TempPath), [])
+
+  def test_PutStreamFail(self):
+    class FailingStream(io.RawIOBase):
+      def readinto(self, buf):
+        raise TestClientShards.UnhandledTestException()
+    self.Client.SpoolSize = 0
+    with self.assertRaises(self.UnhandledTestException):
+      self.Client.PutStream(FailingStream())
+    self.assertEqual(os.listdir(self.Client.TempPath), [])
+
+  def test_ShardRemoved(self):
+    file_hash = self.Client.PutData(b'shard')
+    os.unlink(self.Client[file_hash].Path)
+    shutil.rmtree(join(self.DataPath, file_hash[0:2]))
+    self.assertEqual(self.Client.PutData(b'shard'), file_hash)
+    self.assertEqual(self.Client[file_hash].GetData(), b'shard')
+
+  def test_PrecreateShards(self):
+    client = FileStruct.Client(self.Path, PrecreateShards=True)
+    self.assertTrue(isdir(join(self.DataPath, '00', '00')))
+    self.assertTrue(isdir(join(self.DataPath, 'ff', 'ff')))
+    self.assertEqual(len(os.listdir(join(self.DataPath, '7a'))), 256)
+    with self.count_calls('mkdir', 'stat') as calls:
+      file_hash = client.PutData(b'precreated')
+    self.assertEqual(calls, ['stat'])
+    self.assertEqual(client[file_hash].GetData(), b'precreated')
+    self.assertEqual(client.HashToPath(self.FileHash), self.Client.HashToPath(self.FileHash))
+    self.assertTrue(self.FileHash in client)
+
+    # The marker makes it nearly free afterwards
+    with self.count_calls('mkdir', 'listdir') as calls:
+      FileStruct.Client(self.Path, PrecreateShards=True)
+    self.assertEqual(calls.count('mkdir'), 0)
+    self.assertEqual(calls.count('isdir'), 1)
+
+
+
+class TestStreamCopy(unittest.TestCase):
+
+  def setUp(self):
+    self.Data = os.urandom(3 * FileStruct.core.CHUNK_SIZE_MAX + 123)
+
+  def check_copy(self, stream, **kwz):
+    output, sha1 = io.BytesIO(), hashlib.sha1()
+    size = FileStruct.core.StreamCopy(stream, output, sha1, **kwz)
+    self.assertEqual(size, len(self.Data))
+    self.assertEqual(output.getvalue(), self.Data)
+    self.assertEqual(sha1.hexdigest(), hashlib.sha1(self.Data).hexdigest())
+
+  def test_Readinto(self):
+    self.check_copy(io.BytesIO(self.Data))
+    with tempfile.TemporaryFile(buffering=0) as tmp:
+      tmp.write(self.Data)
+      tmp.seek(0)
+      self.check_copy(tmp)
+
+  def test_ReadOnly(self):
+    test = self
+    class FileLikeObject: # read() only, returns short chunks
+      def __init__(self, data):
+        self.stream = io.BytesIO(data)
+      def read(self, n):
+        test.assertIsInstance(n, int)
+        test.assertLessEqual(n, FileStruct.core.CHUNK_SIZE_MAX)
+        return self.stream.read(max(1, n // 3))
+    self.check_copy(FileLikeObject(self.Data))
+
+  def test_RawReadOnly(self):
+    class RawReader(io.RawIOBase): # readinto() raises NotImplementedError
+      def __init__(self, data):
+        self.stream = io.BytesIO(data)
+      def read(self, n=-1):
+        return self.stream.read(n)
+    self.check_copy(RawReader(self.Data))
+
+  def test_ChunkSize(self):
+    sizes = []
+    class Reader(io.BytesIO):
+      def readinto(self, b):
+        sizes.append(len(b))
+        return super().readinto(b)
+    self.check_copy(Reader(self.Data), ChunkSize=1000)
+    self.assertEqual(set(sizes), {1000})
+    del sizes[:]
+    self.check_copy(Reader(self.Data))
+    self.assertEqual(sizes[0], FileStruct.core.CHUNK_SIZE_MIN)
+    self.assertEqual(max(sizes), FileStruct.core.CHUNK_SIZE_MAX)
+    with self.assertRaises(ValueError):
+      FileStruct.core.StreamCopy(io.BytesIO(), ChunkSize=0)
+
+  def test_ShortWrites(self):
+    class Writer(io.BytesIO):
+      def write(self, b):
+        return super().write(b[:7])
+    output = Writer()
+    FileStruct.core.StreamCopy(io.BytesIO(self.Data), output)
+    self.assertEqual(output.getvalue(), self.Data)
+
+  def test_Empty(self):
+    self.assertEqual(FileStruct.core.StreamCopy(io.BytesIO()), 0)
+
+
+
 class TestClientTempDir(TestClientOps):
 
   def test_Context(self):
@@ -798,8 +1095,8 @@ class TestClientTempConvert(TestClientTempOps):
   def setUp(self):
     super(TestClientTempConvert, self).setUp()
 
-    skip = not exists(self.Client.bin_convert)
-    self.skip = unittest.skip( 'No ImageMagick'
+    skip = not exists(self.Client.bin_convert) and FileStruct.image._pil() is None
+    self.skip = unittest.skip( 'No Pillow and no ImageMagick'
         ' "convert" binary found at {}'.format(self.Client.bin_convert) )\
       if skip else False
     if self.skip: return self.skip
@@ -846,6 +1143,33 @@ class TestClientTempConvert(TestClientTempOps):
       self.TempDir.convert_resize(
         self.TempFileNameNX, self.TempImageName+'2', self.ValidSizeSpec )
 
+  def test_Multi(self):
+    if self.skip: return self.skip
+    hashes = self.TempDir.convert_multi(self.TempImageName, [
+      {'DestFileName': 'large.jpg', 'Normalize': (64, 64), 'Quality': 80},
+      {'DestFileName': 'small.png', 'Normalize': (16, 16)},
+      {'DestFileName': 'wide', 'Resize': '50x', 'Format': 'jpg'},
+      ])
+    self.assertEqual(len(hashes), 3)
+    self.assertEqual(len(set(hashes)), 3)
+    for hash in hashes:
+      self.assertIn(hash, self.Client)
+    png = self.Client[hashes[1]].GetData()
+    self.assertTrue(png.startswith(b'\x89PNG'))
+    self.assertEqual(png[16:24], b'\x00\x00\x00\x10\x00\x00\x00\x10')
+    self.assertTrue(self.Client[hashes[2]].GetData().startswith(b'\xff\xd8'))
+
+  def test_MultiFail(self):
+    if self.skip: return self.skip
+    with self.assertRaises(ValueError):
+      self.TempDir.convert_multi(self.TempImageName, [])
+    with self.assertRaises(ValueError):
+      self.TempDir.convert_multi(self.TempImageName, [{'DestFileName': 'out.jpg'}])
+    with self.assertRaises(ValueError):
+      self.TempDir.convert_multi(self.TempImageName, [{'DestFileName': 'out', 'Resize': '10x10', 'Format': 'jpg:x'}])
+    with self.assertRaises(FileStruct.Error):
+      self.TempDir.convert_multi(self.TempFileNameNX, [{'DestFileName': 'out.jpg', 'Resize': '10x10'}])
+
 
 
 class TestClientTempFile(TestClientTempOps, ClientGetTestsMixin):
@@ -0,0 +1,159 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists, dirname
+import hashlib
+import os
+import threading
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.derive
+import FileStruct.image
+
+
+
+class TestClientDerive(TestClientOps):
+
+  def setUp(self):
+    super(TestClientDerive, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, DeriveCache=True)
+    self.Made = []
+
+  def upper(self, hash):
+    # A stand-in transform that counts its calls
+    self.Made.append(hash)
+    return self.Client.PutData(self.Client[hash].GetData().upper())
+
+  def test_Derive(self):
+    spec = {'Op': 'upper', 'Size': [1, 2]}
+    derived = self.Client.Derive(self.FileHash, spec, self.upper)
+    self.assertEqual(self.Client[derived].GetData(), self.FileContents.upper())
+    # Equal specs, in any key order, are the same entry
+    self.assertEqual(self.Client.Derive(self.FileHash, {'Size': [1, 2], 'Op': 'upper'}, self.upper), derived)
+    self.assertEqual(self.Made, [self.FileHash])
+    self.assertEqual(self.Client.DeriveCache.Get(self.FileHash, spec), derived)
+    self.assertIsNone(self.Client.DeriveCache.Get(self.FileHash, {'Op': 'lower'}))
+    stats = self.Client.DeriveCache.Stats()
+    self.assertEqual((stats['Hits'], stats['Misses']), (1, 1))
+
+    # Made again once the derived object is gone
+    os.unlink(self.Client.HashToPath(derived))
+    self.assertEqual(self.Client.Derive(self.FileHash, spec, self.upper), derived)
+    self.assertEqual(len(self.Made), 2)
+
+  def test_Persistent(self):
+    derived = self.Client.Derive(self.FileHash, 'upper', self.upper)
+    other = FileStruct.Client(self.Path, DeriveCache=True)
+    self.assertEqual(other.Derive(self.FileHash, 'upper', self.upper), derived)
+    self.assertEqual(len(self.Made), 1)
+
+    # Entries added by others are seen, and survive compaction
+    hash = self.Client.PutData(b'other')
+    other.Derive(hash, 'upper', self.upper)
+    self.assertEqual(self.Client.DeriveCache.Get(hash, 'upper'), self.Client.NewHash(b'OTHER').hexdigest())
+    self.assertTrue(other.DeriveCache.Compact())
+    self.assertFalse(exists(other.DeriveCache.JournalPath))
+    self.assertEqual(self.Client.DeriveCache.Get(hash, 'upper'), self.Client.NewHash(b'OTHER').hexdigest())
+    self.assertEqual(FileStruct.Client(self.Path, DeriveCache=True).DeriveCache.Stats()['Records'], 2)
+
+  def test_AutoCompact(self):
+    self.Client.DeriveCache.CompactSize = 3 * self.Client.DeriveCache.RecordSize
+    hashes = [self.Client.PutData(str(i).encode('ascii')) for i in range(10)]
+    for hash in hashes:
+      self.Client.Derive(hash, 'upper', self.upper)
+    self.assertLess(os.path.getsize(self.Client.DeriveCache.JournalPath), self.Client.DeriveCache.CompactSize)
+    self.assertEqual(len(self.Client.DeriveCache.Entries()), 10)
+
+  def test_Concurrent(self):
+    # Entries added and looked up from many threads while the journal keeps
+    # being compacted under them
+    cache = self.Client.DeriveCache
+    cache.CompactSize = 500
+    hashes = [hashlib.sha1(str(i).encode('ascii') + b'-concurrent').hexdigest() for i in range(2000)]
+    def work(n):
+      for hash in hashes[n::8]:
+        cache.Put(hash, 'spec', hash)
+        cache.Get(self.FileHashNX, 'spec')
+    def compact():
+      for i in range(50):
+        cache.Compact()
+    threads = [threading.Thread(target=work, args=(n,), daemon=True) for n in range(8)]
+    threads.append(threading.Thread(target=compact, daemon=True))
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(60)
+      self.assertFalse(thread.is_alive())
+    for hash in hashes:
+      self.assertEqual(cache.Get(hash, 'spec'), hash)
+
+  def test_Uncached(self):
+    client = FileStruct.Client(self.Path)
+    self.assertIsNone(client.DeriveCache)
+    client.Derive(self.FileHash, 'upper', self.upper)
+    client.Derive(self.FileHash, 'upper', self.upper)
+    self.assertEqual(len(self.Made), 2)
+
+  def test_Collect(self):
+    # FileHash -> derived -> derived2, and an entry of a source not kept
+    derived = self.Client.Derive(self.FileHash, 'upper', self.upper)
+    derived2 = self.Client.Derive(derived, 'twice', lambda hash: self.Client.PutData(self.Client[hash].GetData() * 2))
+    source = self.Client.PutData(b'dropped')
+    dropped = self.Client.Derive(source, 'upper', self.upper)
+
+    # Derived objects are kept only if listed; also from a client that does
+    # not use the cache
+    stats = FileStruct.Client(self.Path).CollectGarbage([self.FileHash, derived], GracePeriod=0, Workers=1)
+    self.assertEqual(sorted(os.listdir(stats['TrashPath'])), sorted([derived2, source, dropped]))
+    for hash in (self.FileHash, derived):
+      self.assertIn(hash, self.Client)
+    entries = self.Client.DeriveCache.Entries()
+    self.assertEqual(entries, [(bytes.fromhex(self.FileHash), bytes.fromhex(derived))])
+    self.assertIsNone(self.Client.DeriveCache.Get(source, 'upper'))
+
+  def test_CollectUnlisted(self):
+    # Keeping the source does not keep what was derived from it
+    derived = self.Client.Derive(self.FileHash, 'upper', self.upper)
+    stats = self.Client.CollectGarbage([self.FileHash], GracePeriod=0, Workers=1)
+    self.assertEqual(os.listdir(stats['TrashPath']), [derived])
+    self.assertNotIn(derived, self.Client)
+    self.assertEqual(self.Client.DeriveCache.Entries(), [])
+    # Made again when asked for
+    self.assertEqual(self.Client.Derive(self.FileHash, 'upper', self.upper), derived)
+    self.assertEqual(self.Made, [self.FileHash] * 2)
+
+  def test_Evict(self):
+    derived = self.Client.Derive(self.FileHash, 'upper', self.upper)
+    stats = self.Client.Evict(MaxObjects=1, LowWater=0.5, GracePeriod=0, Pinned={self.FileHash})
+    self.assertEqual(os.listdir(stats['TrashPath']), [derived])
+    self.assertEqual(self.Client.DeriveCache.Entries(), [])
+    self.assertEqual(self.Client.Derive(self.FileHash, 'upper', self.upper), derived)
+    self.assertEqual(len(self.Made), 2)
+
+  def test_Images(self):
+    if not exists(self.Client.bin_convert) and FileStruct.image._pil() is None:
+      self.skipTest('No Pillow and no ImageMagick "convert" binary found at {0}'.format(self.Client.bin_convert))
+    source = self.Client.PutFile(join(dirname(__file__), 'image.jpg'))
+    outputs = [{'Normalize': (32, 32)}, {'Resize': '16x16', 'Format': 'png'}]
+    hashes = self.Client.DeriveImages(source, outputs)
+    self.assertEqual(self.Client.DeriveCache.Stats()['Misses'], 2)
+    for hash in hashes:
+      self.assertIn(hash, self.Client)
+    self.assertEqual(self.Client.DeriveImages(source, outputs + [{'Normalize': (8, 8)}])[:2], hashes)
+    stats = self.Client.DeriveCache.Stats()
+    self.assertEqual((stats['Hits'], stats['Misses']), (2, 3))
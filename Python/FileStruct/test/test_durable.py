@@ -0,0 +1,91 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join
+import io
+import os
+import threading
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.durable
+
+
+
+class TestClientDurability(TestClientOps):
+
+  def test_Levels(self):
+    self.assertEqual(self.Client.Durability, 'none')
+    self.assertIsNone(self.Client.GroupCommit)
+    with self.assertRaises(ValueError):
+      FileStruct.Client(self.Path, Durability='always')
+    for level in FileStruct.core.DURABILITY_LEVELS:
+      client = FileStruct.Client(self.Path, Durability=level)
+      data = level.encode('ascii') * 1000
+      file_hash = client.PutData(data)
+      self.assertEqual(client.PutStream(io.BytesIO(data)), file_hash)
+      client.SpoolSize = 0
+      self.assertEqual(client.PutStream(io.BytesIO(data + b'!')), client.NewHash(data + b'!').hexdigest())
+      self.assertEqual(client[file_hash].GetData(), data)
+
+  def test_FileFsync(self):
+    client = FileStruct.Client(self.Path, Durability='file')
+    fsync, synced = os.fsync, []
+    os.fsync = lambda fd: synced.append(fd) or fsync(fd)
+    try:
+      client.PutData(b'durable')
+      client.PutData(b'durable')
+    finally:
+      os.fsync = fsync
+    self.assertEqual(len(synced), 1)
+
+  def test_GroupCommit(self):
+    for syncfs in (True, False):
+      client = FileStruct.Client(self.Path, Durability='directory')
+      client.GroupCommit = FileStruct.durable.GroupCommit(self.Path, SyncFS=syncfs)
+      datas = [('{0} {1}'.format(syncfs, i)).encode('ascii') for i in range(64)]
+      results = {}
+      def put(data):
+        results[data] = client.PutData(data)
+      threads = [threading.Thread(target=put, args=(data,)) for data in datas]
+      for t in threads:
+        t.start()
+      for t in threads:
+        t.join()
+      for data in datas:
+        self.assertEqual(client[results[data]].GetData(), data)
+      stats = client.GroupCommit.Stats()
+      self.assertGreaterEqual(stats['Requests'], 2 * len(datas))
+      self.assertGreaterEqual(stats['Commits'], 1)
+
+  def test_GroupCommitError(self):
+    commit = FileStruct.durable.GroupCommit(self.Path, SyncFS=False)
+    with self.assertRaises(OSError):
+      commit.SyncDir(join(self.Path, 'missing'))
+    commit.SyncDir(self.Path)
+
+  def test_GroupCommitClose(self):
+    commit = FileStruct.durable.GroupCommit(self.Path, SyncFS=False)
+    commit.SyncDir(self.Path)
+    thread = commit._thread
+    commit.close()
+    thread.join(10)
+    self.assertFalse(thread.is_alive())
+    # Started again when needed
+    commit.SyncDir(self.Path)
+    self.assertEqual(commit.Stats()['Commits'], 2)
+    commit.close()
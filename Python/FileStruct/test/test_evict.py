@@ -0,0 +1,169 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import os
+import time
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.evict
+import FileStruct.backend
+
+
+
+class TestClientEvict(TestClientOps):
+
+  def setUp(self):
+    super(TestClientEvict, self).setUp()
+    # Ten objects of 100 bytes (plus 'abcd'), the first one the coldest
+    self.Hashes = [self.Client.PutData(bytes([i]) * 100) for i in range(10)]
+    now = int(time.time())
+    FileStruct.evict._writelog(join(self.Client.TempPath, 'Access.state'), {hash: now + 100 * (i + 1) for i, hash in enumerate(self.Hashes)})
+
+  def assertEvicted(self, stats, hashes):
+    self.assertEqual(sorted(os.listdir(stats['TrashPath'])), sorted(hashes))
+    for hash in hashes:
+      self.assertNotIn(hash, self.Client)
+    for hash in set(self.Hashes) - set(hashes):
+      self.assertIn(hash, self.Client)
+
+  def test_Args(self):
+    with self.assertRaises(ValueError):
+      self.Client.Evict()
+    with self.assertRaises(ValueError):
+      self.Client.Evict(1000, LowWater=0)
+
+  def test_UnderCap(self):
+    stats = self.Client.Evict(MaxBytes=1004, GracePeriod=0)
+    self.assertEqual(stats['Objects'], 11)
+    self.assertEqual(stats['Bytes'], 1004)
+    self.assertEqual(stats['Trashed'], 0)
+    self.assertIsNone(stats['TrashPath'])
+
+  def test_MaxBytes(self):
+    # Over 1000, down to 900: 'abcd' (no access recorded) and one more
+    stats = self.Client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEqual(stats['Trashed'], 2)
+    self.assertEqual(stats['TrashedBytes'], 104)
+    self.assertEqual(stats['Kept'], 9)
+    self.assertEvicted(stats, [self.FileHash, self.Hashes[0]])
+    self.assertEqual(self.Client.Evict(MaxBytes=1000, GracePeriod=0)['Trashed'], 0)
+
+  def test_MaxObjects(self):
+    stats = self.Client.Evict(MaxObjects=10, LowWater=0.5, GracePeriod=0)
+    self.assertEqual(stats['Trashed'], 6)
+    self.assertEvicted(stats, [self.FileHash] + self.Hashes[0:5])
+
+  def test_AccessLog(self):
+    client = FileStruct.Client(self.Path, AccessLog=True)
+    client.AccessLog.FlushInterval = 3600
+    client[self.Hashes[0]]
+    client[self.Hashes[0]]
+    self.assertFalse(exists(client.AccessLog.Path))
+    client.AccessLog.Flush()
+    times = FileStruct.evict.ReadAccessLog(client.AccessLog.Path, client.DigestSize)
+    self.assertEqual(list(times), [self.Hashes[0]])
+
+    # A fresh access beats the state file and the ctime of the others
+    FileStruct.evict._writelog(join(client.TempPath, 'Access.log'), {self.Hashes[0]: time.time() + 10000})
+    stats = client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEvicted(stats, [self.FileHash, self.Hashes[1]])
+    self.assertFalse(exists(client.AccessLog.Path))
+    times = FileStruct.evict.ReadAccessLog(join(client.TempPath, 'Access.state'), client.DigestSize)
+    self.assertEqual(sorted(times), sorted([self.Hashes[0]] + self.Hashes[2:]))
+
+  def test_Pinned(self):
+    stats = self.Client.Evict(MaxBytes=1000, GracePeriod=0, Pinned={self.FileHash, self.Hashes[0]})
+    self.assertEqual(stats['Pinned'], 2)
+    self.assertEvicted(stats, self.Hashes[1:3])
+
+  def test_Unreplicated(self):
+    backend = FileStruct.backend.MemoryBackend({hash: b'' for hash in self.Hashes[1:]})
+    client = FileStruct.Client(self.Path, Backend=backend)
+    stats = client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEqual(stats['Unreplicated'], 2)
+    self.assertEvicted(stats, self.Hashes[1:3])
+
+  def test_ReplicationQueue(self):
+    # The queue of the database is honoured by clients that do not append
+    # to it, and by the command line
+    FileStruct.Client(self.Path, ReplicationQueue=True).ReplicationQueue.Append(self.Hashes[0])
+    stats = self.Client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEqual(stats['Unreplicated'], 1)
+    self.assertEvicted(stats, [self.FileHash, self.Hashes[1]])
+    FileStruct.evict.main([self.Path, '--max-bytes', '800', '--grace-period', '0'])
+    self.assertIn(self.Hashes[0], self.Client)
+
+  def test_ReplicationQueueUnreadable(self):
+    FileStruct.Client(self.Path, ReplicationQueue=True)
+    with open(join(self.Client.ReplicatePath, 'Failed.jsonl'), 'w') as f:
+      f.write('{torn\n')
+    with self.assertRaises(FileStruct.Error):
+      self.Client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEqual(os.listdir(self.Client.TrashPath), [])
+    for hash in self.Hashes:
+      self.assertIn(hash, self.Client)
+
+  def test_Chunks(self):
+    # Work files read a few records at a time give the same result
+    read = FileStruct.evict._READ_RECORDS
+    FileStruct.evict._READ_RECORDS = 3
+    try:
+      stats = self.Client.Evict(MaxObjects=10, LowWater=0.5, GracePeriod=0)
+    finally:
+      FileStruct.evict._READ_RECORDS = read
+    self.assertEvicted(stats, [self.FileHash] + self.Hashes[0:5])
+    times = FileStruct.evict.ReadAccessLog(join(self.Client.TempPath, 'Access.state'), self.Client.DigestSize)
+    self.assertEqual(sorted(times), sorted(self.Hashes[5:]))
+
+  def test_StoredAgain(self):
+    # Objects a writer stores again during the sweep stay, in the index too,
+    # whether or not another writer then finds them by dedup
+    client = FileStruct.Client(self.Path, Index=True)
+    client.RebuildIndex()
+    writer = FileStruct.Client(self.Path, Index=True)
+    evictor = FileStruct.evict.Evictor(client, MaxBytes=1000, GracePeriod=0)
+    sweepall = evictor._sweepall
+    def sweep(*args):
+      rval = sweepall(*args)
+      writer.PutData(bytes([0]) * 100)
+      writer.PutData(bytes([0]) * 100)
+      writer.PutData(self.FileContents)
+      return rval
+    evictor._sweepall = sweep
+    stats = evictor.Run()
+    self.assertEqual((stats['Restored'], stats['Trashed']), (2, 0))
+    self.assertIsNone(stats['TrashPath'])
+    self.assertEqual(os.listdir(self.Client.TrashPath), [])
+    self.assertTrue(self.Hashes[0] in client.Index)
+    self.assertTrue(self.FileHash in client.Index)
+
+  def test_GracePeriod(self):
+    stats = self.Client.Evict(MaxBytes=1000)
+    self.assertEqual(stats['Trashed'], 0)
+    self.assertEqual(stats['Recent'], 11)
+
+  def test_Index(self):
+    client = FileStruct.Client(self.Path, ExistsCacheSize=100, Index=True)
+    client.RebuildIndex()
+    self.assertIn(self.Hashes[0], client)
+    stats = client.Evict(MaxBytes=1000, GracePeriod=0)
+    self.assertEqual(stats['Trashed'], 2)
+    self.assertNotIn(self.Hashes[0], client)
+    self.assertNotIn(self.Hashes[0], client.Index)
+    self.assertIn(self.Hashes[1], client.Index)
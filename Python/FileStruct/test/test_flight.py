@@ -0,0 +1,188 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import os
+import threading
+import time
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.flight
+
+
+
+class TestClientFlight(TestClientOps):
+
+  def setUp(self):
+    super(TestClientFlight, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, DeriveCache=True)
+    self.MadePath = join(self.Path, 'made.log')
+
+  def slowupper(self, hash):
+    # A stand-in transform that logs every call, from any process
+    with open(self.MadePath, 'a') as f:
+      f.write(hash + '\n')
+    time.sleep(0.3)
+    return self.Client.PutData(self.Client[hash].GetData().upper())
+
+  def made(self):
+    with open(self.MadePath, 'r') as f:
+      return f.read().split()
+
+  def test_Threads(self):
+    with ThreadPoolExecutor(max_workers=8) as pool:
+      results = list(pool.map(lambda i: self.Client.Derive(self.FileHash, 'upper', self.slowupper), range(8)))
+    self.assertEqual(set(results), {self.Client.NewHash(self.FileContents.upper()).hexdigest()})
+    self.assertEqual(self.made(), [self.FileHash])
+    self.assertGreater(self.Client.DeriveCache.Stats()['FlightsWaited'], 0)
+    self.assertEqual(os.listdir(self.Client.DeriveCache.Flights.Path), [])
+
+  def test_Processes(self):
+    pids = []
+    for i in range(4):
+      pid = os.fork()
+      if pid == 0:
+        # A client of its own, as in another worker process
+        code = 1
+        try:
+          self.Client = FileStruct.Client(self.Path, DeriveCache=True)
+          self.Client.Derive(self.FileHash, 'upper', self.slowupper)
+          code = 0
+        finally:
+          os._exit(code)
+      pids.append(pid)
+    for pid in pids:
+      self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    self.assertEqual(self.made(), [self.FileHash])
+    self.assertEqual(self.Client.Derive(self.FileHash, 'upper', self.slowupper), self.Client.NewHash(self.FileContents.upper()).hexdigest())
+    self.assertEqual(len(self.made()), 1)
+
+  def test_Uncached(self):
+    # Without a DeriveCache the waiters get the owner's result from it
+    client = FileStruct.Client(self.Path)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+      results = list(pool.map(lambda i: client.Derive(self.FileHash, 'upper', self.slowupper), range(8)))
+    self.assertEqual(set(results), {self.Client.NewHash(self.FileContents.upper()).hexdigest()})
+    self.assertEqual(self.made(), [self.FileHash])
+    self.assertGreater(client._deriveflights().Stats()['Waited'], 0)
+    self.assertEqual(os.listdir(client._deriveflights().Path), [])
+
+  def test_Publish(self):
+    flights = FileStruct.flight.Flights(self.Client)
+    resultpath = join(self.Path, 'result')
+    with flights.Hold(['k1', 'k2']) as flight:
+      self.assertEqual(flight.Results, {})
+      pid = os.fork()
+      if pid == 0:
+        code = 1
+        try:
+          # The inherited descriptors would hold the locks for us
+          for fd in flight.Fds.values():
+            os.close(fd)
+          with FileStruct.flight.Flights(FileStruct.Client(self.Path)).Hold(['k1', 'k2']) as waited:
+            with open(resultpath, 'w') as f:
+              f.write(repr((waited.Results, sorted(waited.Fds))))
+          code = 0
+        finally:
+          os._exit(code)
+      time.sleep(0.3)
+      flight.Publish('k1', 'made')
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    with open(resultpath, 'r') as f:
+      # k2 had no result, so the waiter owns a new flight of it
+      self.assertEqual(f.read(), repr(({'k1': 'made'}, ['k2'])))
+    self.assertEqual(os.listdir(flights.Path), [])
+
+  def test_DeadOwner(self):
+    flights = self.Client.DeriveCache.Flights
+    key = self.Client.DeriveCache.Key(self.FileHash, 'upper').hex()
+    with flights.Hold([key]):
+      pass
+    # An owner that dies holding the lock leaves the file behind, locked
+    # until the kernel closes its descriptors
+    pid = os.fork()
+    if pid == 0:
+      fd = os.open(join(flights.Path, key + '.lock'), os.O_RDWR | os.O_CREAT)
+      fcntl.flock(fd, fcntl.LOCK_EX)
+      os._exit(0)
+    os.waitpid(pid, 0)
+    start = time.monotonic()
+    self.Client.Derive(self.FileHash, 'upper', self.slowupper)
+    self.assertLess(time.monotonic() - start, 5)
+    self.assertEqual(flights.Stats()['TakenOver'], 0)
+
+  def test_Timeout(self):
+    flights = self.Client.DeriveCache.Flights
+    flights.Timeout = 0.2
+    key = self.Client.DeriveCache.Key(self.FileHash, 'upper').hex()
+    hung = threading.Event()
+    done = threading.Event()
+    def owner():
+      with FileStruct.flight.Flights(self.Client).Hold([key]):
+        hung.set()
+        done.wait(10)
+    thread = threading.Thread(target=owner)
+    thread.start()
+    try:
+      hung.wait(10)
+      self.Client.Derive(self.FileHash, 'upper', self.slowupper)
+      self.assertEqual(flights.Stats()['TakenOver'], 1)
+    finally:
+      done.set()
+      thread.join()
+    self.assertEqual(self.made(), [self.FileHash])
+
+  def test_JobSlots(self):
+    slots = FileStruct.flight.JobSlots(self.Client, 2, Timeout=0.2)
+    with slots.Hold():
+      with slots.Hold():
+        with self.assertRaises(FileStruct.Error):
+          with slots.Hold():
+            pass
+        # Another process gets none either
+        other = FileStruct.flight.JobSlots(FileStruct.Client(self.Path), 2, Timeout=0.2)
+        with self.assertRaises(FileStruct.Error):
+          with other.Hold():
+            pass
+      with slots.Hold():
+        pass
+    self.assertEqual(slots.Stats()['Jobs'], 3)
+    with self.assertRaises(ValueError):
+      FileStruct.flight.JobSlots(self.Client, 0)
+
+  def test_JobSlotsWait(self):
+    slots = FileStruct.flight.JobSlots(self.Client, 1)
+    running = []
+    peak = []
+    def job(i):
+      with slots.Hold():
+        running.append(i)
+        peak.append(len(running))
+        time.sleep(0.05)
+        running.remove(i)
+    with ThreadPoolExecutor(max_workers=4) as pool:
+      list(pool.map(job, range(4)))
+    self.assertEqual(max(peak), 1)
+    self.assertGreater(slots.Stats()['Waited'], 0)
+
+  def test_ImageJobs(self):
+    client = FileStruct.Client(self.Path, ImageJobs=2)
+    self.assertEqual(client.ImageJobs.Slots, 2)
+    self.assertIsNone(FileStruct.Client(self.Path).ImageJobs)
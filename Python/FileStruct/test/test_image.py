@@ -0,0 +1,258 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists, dirname
+import os
+import struct
+import sys
+import time
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.image
+
+ResizeSize = FileStruct.image.ResizeSize
+
+
+def pngheader(width, height):
+  return b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR' + struct.pack('>II', width, height) + b'\x08\x02\x00\x00\x00'
+
+
+
+class TestClientImage(TestClientOps):
+
+  def setUp(self):
+    super(TestClientImage, self).setUp()
+    self.ImagePath = join(dirname(__file__), 'image.jpg')
+    self.TempFilePath = join(self.Path, 'image.tmp')
+
+  def engines(self):
+    engines = []
+    if FileStruct.image._pil() is not None:
+      engines.append('pillow')
+    if exists(self.Client.bin_convert):
+      engines.append('convert')
+    if not engines:
+      self.skipTest('Neither Pillow nor an ImageMagick "convert" binary at {0} is available'.format(self.Client.bin_convert))
+    return engines
+
+  def test_ImageSize(self):
+    self.assertEqual(FileStruct.image.ImageSize(self.ImagePath), (4000, 3000))
+    for data, size in [
+      (pngheader(300, 200), (300, 200)),
+      (b'GIF89a' + struct.pack('<HH', 30, 20) + b'\x00' * 10, (30, 20)),
+      (b'not an image', None),
+      ]:
+      with open(self.TempFilePath, 'wb') as f:
+        f.write(data)
+      self.assertEqual(FileStruct.image.ImageSize(self.TempFilePath), size)
+
+  def test_ResizeSize(self):
+    size = (4000, 3000)
+    self.assertEqual(ResizeSize('100x100', size), (100, 75))
+    self.assertEqual(ResizeSize('100x100^', size), (133, 100))
+    self.assertEqual(ResizeSize('100x100!', size), (100, 100))
+    self.assertEqual(ResizeSize('50x', size), (50, 38))
+    self.assertEqual(ResizeSize('x30', size), (40, 30))
+    self.assertEqual(ResizeSize('50%', size), (2000, 1500))
+    self.assertEqual(ResizeSize('8000x8000>', size), size)
+    self.assertEqual(ResizeSize('100x100<', size), size)
+    self.assertEqual(ResizeSize('8000x8000<', size), (8000, 6000))
+    with self.assertRaises(ValueError):
+      ResizeSize('@10000', size)
+
+  def test_Args(self):
+    with self.assertRaises(ValueError):
+      FileStruct.Client(self.Path, ImageEngine='gimp')
+    with self.assertRaises(ValueError):
+      FileStruct.image.ImageService(self.Client, Workers=-1)
+    if FileStruct.image._pil() is None:
+      with self.assertRaises(FileStruct.ConfigError):
+        FileStruct.Client(self.Path, ImageEngine='pillow')
+    with self.assertRaises(ValueError):
+      self.Client.Images.Submit(self.ImagePath, [])
+    with self.assertRaises(ValueError):
+      self.Client.Images.Submit(self.ImagePath, [{'Path': self.TempFilePath}])
+    with self.assertRaises(ValueError):
+      self.Client.Images.Submit(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10', 'Format': 'jpg:x'}])
+
+  def test_Lazy(self):
+    # No service until it is used, and closed with its client
+    client = FileStruct.Client(self.Path)
+    self.assertIsNone(client._images)
+    self.assertIs(client.Images, client.Images)
+    client.Images.Submit(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10'}]).exception()
+    pool = client.Images._pool
+    client.close()
+    self.assertIsNone(client.Images._pool)
+    self.assertTrue(pool._shutdown)
+
+  def test_PilMissing(self):
+    # A failed import is not tried again for every job
+    image, pil = FileStruct.image._Image, sys.modules.get('PIL')
+    FileStruct.image._Image = None
+    sys.modules['PIL'] = None
+    try:
+      self.assertIsNone(FileStruct.image._pil())
+      self.assertIs(FileStruct.image._Image, False)
+      del sys.modules['PIL']
+      self.assertIsNone(FileStruct.image._pil())
+    finally:
+      FileStruct.image._Image = image
+      if pil is not None:
+        sys.modules['PIL'] = pil
+      else:
+        sys.modules.pop('PIL', None)
+
+  def test_ConvertArgs(self):
+    args = FileStruct.image.ConvertArgs('in.jpg', [{'Path': 'out.jpg', 'Resize': '10x10'}], MaxMemory=1000, MaxPixels=2000, MaxSide=300)
+    self.assertEqual(args[:10], ['-limit', 'memory', '1000', '-limit', 'map', '1000', '-limit', 'area', '2000', '-limit'])
+    self.assertEqual(args[10:14], ['width', '300', '-limit', 'height'])
+    self.assertEqual(args[-4:], ['in.jpg', '-resize', '10x10', 'out.jpg'])
+
+  def test_ConvertArgsSizeHint(self):
+    # A reduced JPEG decode only when every output is sized by a box
+    def hint(*resizes):
+      args = FileStruct.image.ConvertArgs('in.jpg', [{'Path': 'out.jpg', 'Resize': resize} for resize in resizes])
+      return args[args.index('-define') + 1] if '-define' in args else None
+    self.assertEqual(hint('10x10'), 'jpeg:size=20x20')
+    self.assertEqual(hint('10x10!', '30x20>', '5x5^'), 'jpeg:size=60x40')
+    for resizes in [('10x10<',), ('50%',), ('10x',), ('10x10', '10x10<'), ('10x10', '@100')]:
+      self.assertIsNone(hint(*resizes), resizes)
+    args = FileStruct.image.ConvertArgs('in.jpg', [{'Path': 'out.jpg', 'Normalize': (8, 6)}])
+    self.assertIn('jpeg:size=16x12', args)
+
+  def test_Refused(self):
+    # Refused from the header, before any engine decodes it
+    with open(self.TempFilePath, 'wb') as f:
+      f.write(pngheader(100000, 100000))
+    with self.assertRaises(FileStruct.Error):
+      self.Client.Images.Run(self.TempFilePath, [{'Path': self.TempFilePath + '2', 'Resize': '10x10'}])
+    self.assertEqual(self.Client.Images.Stats()['Refused'], 1)
+    # Or from its sides
+    with open(self.TempFilePath, 'wb') as f:
+      f.write(pngheader(100000, 2))
+    with self.assertRaises(FileStruct.Error):
+      self.Client.Images.Run(self.TempFilePath, [{'Path': self.TempFilePath + '2', 'Resize': '10x10'}])
+    self.assertEqual(self.Client.Images.Stats()['Refused'], 2)
+
+  def test_Timeout(self):
+    # A convert that hangs is killed
+    script = join(self.Path, 'convert')
+    with open(script, 'w') as f:
+      f.write('#!/bin/sh\nexec sleep 10\n')
+    os.chmod(script, 0o755)
+    self.Client.bin_convert = script
+    service = FileStruct.image.ImageService(self.Client, 'convert', Timeout=0.3)
+    start = time.monotonic()
+    with self.assertRaises(FileStruct.Error):
+      service.Run(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10'}])
+    self.assertLess(time.monotonic() - start, 5)
+    service.Submit(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10'}]).exception()
+    self.assertGreaterEqual(service.Stats()['Killed'], 1)
+
+  def test_Cancelled(self):
+    # A job its caller gave up on writes nothing and frees its job slot.
+    # It never gets to the engine, so convert need not be installed.
+    client = FileStruct.Client(self.Path, ImageJobs=1)
+    service = FileStruct.image.ImageService(client, 'convert', Timeout=0.3)
+    with client.ImageJobs.Hold():
+      with self.assertRaises(FileStruct.Error):
+        service.Run(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10'}])
+    service.close()
+    self.assertFalse(exists(self.TempFilePath))
+    stats = service.Stats()
+    self.assertEqual((stats['TimedOut'], stats['Errors'], stats['Pending']), (1, 0, 0))
+    with client.ImageJobs.Hold():
+      pass
+
+  def test_MaxImagePixels(self):
+    Image = FileStruct.image._pil()
+    if Image is None:
+      self.skipTest('No Pillow')
+    pixels = Image.MAX_IMAGE_PIXELS
+    try:
+      service = FileStruct.image.ImageService(self.Client, 'pillow', MaxPixels=20 * 1000 * 1000)
+      service.Run(self.ImagePath, [{'Path': self.TempFilePath, 'Resize': '10x10', 'Format': 'png'}])
+      self.assertEqual(Image.MAX_IMAGE_PIXELS, 20 * 1000 * 1000)
+    finally:
+      Image.MAX_IMAGE_PIXELS = pixels
+
+  def test_ClientLimits(self):
+    client = FileStruct.Client(self.Path, ImageTimeout=5, ImageMaxPixels=1000, ImageMaxSide=40)
+    self.assertEqual((client.Images.Timeout, client.Images.MaxPixels, client.Images.MaxSide), (5, 1000, 40))
+    self.assertEqual(self.Client.Images.Timeout, FileStruct.image.TIMEOUT)
+    with open(self.TempFilePath, 'wb') as f:
+      f.write(pngheader(50, 10))
+    with self.assertRaises(FileStruct.Error):
+      client.Images.Run(self.TempFilePath, [{'Path': self.TempFilePath + '2', 'Resize': '10x10'}])
+    self.assertEqual(client.Images.Stats()['Refused'], 1)
+
+  def test_PillowOutput(self):
+    # What convert would write: the source's JPEG tables and ICC profile
+    Image = FileStruct.image._pil()
+    if Image is None:
+      self.skipTest('No Pillow')
+    source = join(self.Path, 'profile.jpg')
+    with Image.open(self.ImagePath) as im:
+      im.resize((400, 300)).save(source, quality=60, icc_profile=b'not a real profile')
+    service = FileStruct.image.ImageService(self.Client, 'pillow')
+    from PIL.JpegImagePlugin import JpegImageFile
+    drafts = []
+    draft = JpegImageFile.draft
+    JpegImageFile.draft = lambda im, *args: drafts.append(args) or draft(im, *args)
+    try:
+      service.Run(source, [{'Path': self.TempFilePath, 'Resize': '100x100'}])
+      # Only enlarging needs the full size decode
+      service.Run(source, [{'Path': self.TempFilePath + '2', 'Resize': '800x800<'}])
+    finally:
+      JpegImageFile.draft = draft
+    self.assertEqual(drafts, [('RGB', (200, 200))])
+    with Image.open(source) as im, Image.open(self.TempFilePath) as out:
+      self.assertEqual(out.quantization, im.quantization)
+      self.assertEqual(out.info.get('icc_profile'), b'not a real profile')
+    with Image.open(self.TempFilePath + '2') as out:
+      self.assertEqual(out.size, (800, 600))
+
+  def test_Engines(self):
+    for engine in self.engines():
+      service = FileStruct.image.ImageService(self.Client, engine)
+      large = join(self.Path, engine + '-large.jpg')
+      small = join(self.Path, engine + '-small.png')
+      wide = join(self.Path, engine + '-wide')
+      service.Run(self.ImagePath, [
+        {'Path': large, 'Normalize': (64, 64), 'Quality': 80},
+        {'Path': small, 'Resize': '16x16'},
+        {'Path': wide, 'Resize': '50x', 'Format': 'jpg'},
+        ])
+      self.assertEqual(FileStruct.image.ImageSize(large), (64, 64))
+      self.assertEqual(FileStruct.image.ImageSize(small), (16, 12))
+      with open(small, 'rb') as f:
+        self.assertTrue(f.read().startswith(b'\x89PNG'))
+      with open(wide, 'rb') as f:
+        self.assertTrue(f.read().startswith(b'\xff\xd8'))
+      self.assertEqual(FileStruct.image.ImageSize(wide), (50, 38))
+      self.assertEqual(service.Stats()['Pillow' if engine == 'pillow' else 'Convert'], 1)
+
+  def test_TempDir(self):
+    engine = self.engines()[0]
+    client = FileStruct.Client(self.Path, ImageEngine=engine, ImageJobs=1)
+    with client.TempDir() as TD:
+      TD['source.jpg'].PutFile(self.ImagePath)
+      TD.convert_normalize('source.jpg', 'thumb.jpg', 32, 32)
+      self.assertEqual(FileStruct.image.ImageSize(TD['thumb.jpg'].Path), (32, 32))
+    self.assertEqual(client.ImageJobs.Stats()['Jobs'], 1)
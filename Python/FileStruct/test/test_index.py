@@ -0,0 +1,137 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import os
+import hashlib
+import threading
+
+from .test_core import FileStruct, TestClientOps
+
+
+
+class TestClientIndex(TestClientOps):
+
+  def setUp(self):
+    super(TestClientIndex, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, Index=True)
+    self.Index = self.Client.Index
+    self.Client.RebuildIndex()
+    self.Data = [str(i).encode('ascii') for i in range(200)]
+    self.Hashes = sorted(self.Client.PutData(data) for data in self.Data)
+
+  def tearDown(self):
+    self.Index.close()
+    super(TestClientIndex, self).tearDown()
+
+  def all_hashes(self):
+    return sorted(self.Hashes + [self.FileHash])
+
+  def test_Disabled(self):
+    self.assertIsNone(FileStruct.Client(self.Path).Index)
+    with self.assertRaises(FileStruct.Error):
+      FileStruct.Client(self.Path).RebuildIndex()
+
+  def test_Rebuild(self):
+    self.assertTrue(self.FileHash in self.Index)
+    self.assertEqual(self.Index.Get(self.FileHash), len(self.FileContents))
+    self.assertFalse(self.FileHashNX in self.Index)
+    self.assertIsNone(self.Index.Get(self.FileHashNX))
+    self.Client.RebuildIndex()
+    self.assertFalse(exists(self.Index.JournalPath))
+    self.assertEqual(list(self.Index), self.all_hashes())
+
+  def test_Journal(self):
+    for file_hash in self.Hashes:
+      self.assertTrue(file_hash in self.Index)
+    self.assertEqual(len(self.Index), len(self.Hashes) + 1)
+    self.assertEqual(list(self.Index), self.all_hashes())
+
+  def test_Compact(self):
+    self.Index.Remove(self.Hashes[0])
+    self.assertTrue(self.Index.Compact())
+    self.assertFalse(exists(self.Index.JournalPath))
+    self.assertFalse(self.Hashes[0] in self.Index)
+    self.assertEqual(list(self.Index), [h for h in self.all_hashes() if h != self.Hashes[0]])
+    self.assertEqual(self.Index.Stats()['Records'], len(self.Hashes))
+
+  def test_AutoCompact(self):
+    self.Index.CompactSize = 1
+    self.Client.PutData(self.FileContentsNX)
+    self.assertFalse(exists(self.Index.JournalPath))
+    self.assertTrue(self.FileHashNX in self.Index)
+
+  def test_Concurrent(self):
+    # Appends and lookups from many threads while the journal keeps being
+    # compacted under them
+    self.Index.CompactSize = 500
+    hashes = [hashlib.sha1(str(i).encode('ascii') + b'-concurrent').hexdigest() for i in range(4000)]
+    def work(n):
+      for hash in hashes[n::8]:
+        self.Index.Append(hash, 1)
+        self.Index.Get(self.FileHashNX)
+    threads = [threading.Thread(target=work, args=(n,), daemon=True) for n in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join(60)
+      self.assertFalse(thread.is_alive())
+    for hash in hashes:
+      self.assertTrue(hash in self.Index)
+
+  def test_Remove(self):
+    self.Index.Compact()
+    self.Index.Remove(self.FileHash)
+    self.assertFalse(self.FileHash in self.Index)
+    self.assertEqual(len(self.Index), len(self.Hashes))
+    self.Index.Append(self.FileHash, 4)
+    self.assertTrue(self.FileHash in self.Index)
+
+  def test_Range(self):
+    self.Index.Compact()
+    extra = self.Client.PutData(self.FileContentsNX) # journal only
+    hashes = sorted(self.all_hashes() + [extra])
+    self.assertEqual([h for h, s in self.Index.Range()], hashes)
+    start, stop = hashes[10], hashes[100]
+    self.assertEqual([h for h, s in self.Index.Range(start, stop)], hashes[10:100])
+    self.assertEqual([h for h, s in self.Index.Range('8')], [h for h in hashes if h >= '8'])
+    self.assertEqual([h for h, s in self.Index.Range(None, '8')], [h for h in hashes if h < '8'])
+
+  def test_Prefix(self):
+    self.Index.Compact()
+    hashes = self.all_hashes()
+    for prefix in ['', '0', 'f', 'a1', hashes[5][:3], hashes[7]]:
+      self.assertEqual([h for h, s in self.Index.Prefix(prefix)], [h for h in hashes if h.startswith(prefix)])
+    for file_hash, size in self.Index.Prefix(''):
+      self.assertEqual(size, os.stat(self.Client.HashToPath(file_hash)).st_size)
+
+  def test_OtherClient(self):
+    other = FileStruct.Client(self.Path, Index=True)
+    try:
+      file_hash = other.PutData(self.FileContentsNX)
+      self.assertTrue(file_hash in self.Index) # re-reads journal on miss
+      other.Index.Compact()
+      self.assertTrue(file_hash in self.Index)
+      self.Index.Refresh()
+      self.assertEqual(self.Index.Stats()['JournalAdded'], 0)
+    finally:
+      other.Index.close()
+
+  def test_InvalidHash(self):
+    for bad_hash in self.FileHashInvalidList + self.FileHashInvalidType:
+      self.assertFalse(bad_hash in self.Index)
@@ -0,0 +1,126 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import io
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.migrate
+
+
+
+def blake2b(data):
+  return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+
+class TestClientHash(TestClientOps):
+
+  def setUp(self):
+    super(TestClientHash, self).setUp()
+    self.write_config({'Version': 2, 'Hash': 'blake2b'})
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, Index=True)
+
+  def tearDown(self):
+    self.Client.Index.close()
+    super(TestClientHash, self).tearDown()
+
+  def test_Put(self):
+    data = os.urandom(5000)
+    expected = blake2b(data)
+    self.assertEqual(self.Client.PutData(data), expected)
+    self.assertEqual(self.Client.PutStream(io.BytesIO(data)), expected)
+    self.Client.SpoolSize = 0
+    self.assertEqual(self.Client.PutStream(io.BytesIO(data)), expected)
+    path = join(self.Path, 'upload')
+    with open(path, 'wb') as f:
+      f.write(data)
+    self.assertEqual(self.Client.PutFile(path, Mode='auto'), expected)
+    with self.Client.TempDir() as TD:
+      TD['file'].PutData(data)
+      self.assertEqual(TD['file'].Ingest(), expected)
+    self.assertTrue(expected in self.Client)
+    self.assertEqual(self.Client[expected].GetData(), data)
+    self.assertEqual(self.Client.Index.Get(expected), len(data))
+
+  def test_HashLength(self):
+    sha1 = hashlib.sha1(b'abc').hexdigest()
+    self.assertFalse(sha1 in self.Client)
+    with self.assertRaises(ValueError):
+      self.Client[sha1]
+    with self.assertRaises(ValueError):
+      self.Client.HashToPath(sha1)
+
+  def test_ScanCollect(self):
+    hashes = sorted(self.Client.PutData(str(i).encode('ascii')) for i in range(20))
+    self.assertEqual(list(self.Client.IterHashes()), hashes)
+    self.Client.RebuildIndex()
+    self.assertEqual(list(self.Client.Index), hashes)
+    stats = self.Client.CollectGarbage(hashes[:5], GracePeriod=-60, Workers=1)
+    self.assertEqual((stats['Kept'], stats['Trashed']), (5, 15))
+    self.assertEqual(list(self.Client.IterHashes()), hashes[:5])
+
+
+class TestMigrate(TestClientOps):
+
+  def setUp(self):
+    super(TestMigrate, self).setUp()
+    self.Data = [str(i).encode('ascii') * 100 for i in range(30)] + [self.FileContents]
+    for data in self.Data:
+      self.Client.PutData(data)
+    self.TargetPath = tempfile.mkdtemp(suffix='_FileStruct_Test')
+    with open(join(self.TargetPath, 'FileStruct.json'), 'w') as f:
+      json.dump({'Version': 2, 'Hash': 'blake2b'}, f)
+    self.Target = FileStruct.Client(self.TargetPath, self.InternalLocation)
+    self.MapPath = join(self.TargetPath, 'map.txt')
+
+  def tearDown(self):
+    shutil.rmtree(self.TargetPath)
+    super(TestMigrate, self).tearDown()
+
+  def test_Migrate(self):
+    stats = FileStruct.migrate.Migrate(self.Client, self.Target, self.MapPath, Workers=4)
+    self.assertEqual((stats['Objects'], stats['Migrated'], stats['Errors']), (len(self.Data), len(self.Data), []))
+    mapping = list(FileStruct.migrate.ReadMap(self.MapPath))
+    self.assertEqual([old for old, new in mapping], sorted(self.Client.IterHashes()))
+    for old, new in mapping:
+      data = self.Client[old].GetData()
+      self.assertEqual(new, blake2b(data))
+      self.assertEqual(self.Target[new].GetData(), data)
+    with self.assertRaises(FileStruct.Error):
+      FileStruct.migrate.Migrate(self.Client, self.Target, self.MapPath)
+
+  def test_Corrupt(self):
+    path = self.Client[self.FileHash].Path
+    os.chmod(path, 0o644)
+    with open(path, 'wb') as f:
+      f.write(b'changed')
+    stats = FileStruct.migrate.Migrate(self.Client, self.Target, self.MapPath, Workers=2)
+    self.assertEqual(stats['Migrated'], len(self.Data) - 1)
+    self.assertEqual([hash for hash, e in stats['Errors']], [self.FileHash])
+    self.assertFalse(blake2b(b'changed') in self.Target)
+    self.assertEqual(len(list(FileStruct.migrate.ReadMap(self.MapPath))), len(self.Data) - 1)
+    self.assertEqual(os.listdir(self.Target.TempPath), [])
+
+  def test_Main(self):
+    self.assertEqual(FileStruct.migrate.main([self.Path, self.TargetPath, '--map', self.MapPath]), 0)
+    self.assertTrue(exists(self.MapPath))
@@ -0,0 +1,228 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import io
+import os
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.pack
+import FileStruct.backend
+import FileStruct.replicate
+import FileStruct.scrub
+
+
+
+class TestClientPack(TestClientOps):
+
+  def setUp(self):
+    super(TestClientPack, self).setUp()
+    self.Client = FileStruct.Client(self.Path, self.InternalLocation, PackThreshold=100)
+    self.Small = [str(i).encode('ascii') * 10 for i in range(20)]
+    self.Large = b'L' * 1000
+
+  def test_Put(self):
+    hashes = [self.Client.PutData(data) for data in self.Small]
+    large = self.Client.PutData(self.Large)
+    self.assertFalse(any(exists(self.Client.HashToPath(hash)) for hash in hashes))
+    self.assertTrue(exists(self.Client.HashToPath(large)))
+    self.assertEqual(sorted(os.listdir(self.Client.PackPath)), ['00000001.log', '00000001.pack'])
+    self.assertEqual(self.Client.Pack.Stats(), {'Objects': 20, 'Packs': 1, 'Bytes': sum(len(data) for data in self.Small)})
+
+    # Other puts too, and duplicates are not stored twice
+    self.assertEqual(self.Client.PutStream(io.BytesIO(self.Small[0])), hashes[0])
+    self.Client.SpoolSize = 0
+    self.assertEqual(self.Client.PutStream(io.BytesIO(b'streamed')), self.Client.NewHash(b'streamed').hexdigest())
+    with self.Client.TempDir() as TD:
+      TD['file'].PutData(b'ingested')
+      self.assertEqual(TD['file'].Ingest(), self.Client.NewHash(b'ingested').hexdigest())
+    self.assertEqual(self.Client.Pack.Stats()['Objects'], 22)
+
+  def test_Get(self):
+    hash = self.Client.PutData(b'0123456789')
+    self.assertIn(hash, self.Client)
+    file = self.Client[hash]
+    self.assertIsInstance(file, FileStruct.core.PackedFile)
+    self.assertEqual(file.Hash, hash)
+    self.assertIsNone(file.Path)
+    self.assertIsNone(file.InternalURI)
+    self.assertEqual(file.GetData(), b'0123456789')
+    self.assertEqual(file.GetStream().read(), b'0123456789')
+    self.assertEqual(bytes(file.GetView()), b'0123456789')
+    self.assertEqual(file.GetRange(3, 4), b'3456')
+    self.assertEqual(file.GetRange(8, 100), b'89')
+    self.assertEqual(file.GetRange(100, 1), b'')
+    with self.assertRaises(ValueError):
+      file.GetRange(-1, 1)
+
+    # Large objects are still ordinary files
+    large = self.Client[self.Client.PutData(self.Large)]
+    self.assertEqual(large.InternalURI, self.Client.HashToInternalURI(large.Hash))
+    self.assertNotIn(self.FileHashNX, self.Client)
+    with self.assertRaises(KeyError):
+      self.Client[self.FileHashNX]
+
+  def test_OtherClient(self):
+    other = FileStruct.Client(self.Path, PackThreshold=100)
+    hashes = [self.Client.PutData(data) for data in self.Small[:10]]
+    self.assertEqual(other[hashes[0]].GetData(), self.Small[0])
+    hashes += [other.PutData(data) for data in self.Small]
+    for data in self.Small:
+      self.assertEqual(self.Client[self.Client.NewHash(data).hexdigest()].GetData(), data)
+    self.assertEqual(self.Client.Pack.Stats()['Objects'], 20)
+    # A client without packs does not see packed objects
+    self.assertNotIn(hashes[0], FileStruct.Client(self.Path))
+
+  def test_Seal(self):
+    packsize = FileStruct.pack.PACK_SIZE
+    FileStruct.pack.PACK_SIZE = 50
+    try:
+      # 5 + 5 objects of 10 bytes, then 3 + 3 + 3 + 1 of 20
+      hashes = [self.Client.PutData(data) for data in self.Small]
+    finally:
+      FileStruct.pack.PACK_SIZE = packsize
+    names = os.listdir(self.Client.PackPath)
+    self.assertEqual(len([name for name in names if name.endswith('.idx')]), 5)
+    self.assertEqual([name for name in names if name.endswith('.log')], ['00000006.log'])
+    for client in (self.Client, FileStruct.Client(self.Path, PackThreshold=100)):
+      for hash, data in zip(hashes, self.Small):
+        self.assertEqual(client[hash].GetData(), data)
+      self.assertEqual(client.Pack.Stats()['Packs'], 6)
+    hash = self.Client.PutData(b'next')
+    self.assertEqual(self.Client.Pack.Get(hash)[0], 6)
+    self.assertEqual(self.Client[hash].GetData(), b'next')
+
+  def test_TornRecord(self):
+    hash = self.Client.PutData(self.Small[0])
+    with open(join(self.Client.PackPath, '00000001.log'), 'ab') as f:
+      f.write(b'torn')
+    other = FileStruct.Client(self.Path, PackThreshold=100)
+    self.assertIn(hash, other)
+    hash2 = other.PutData(self.Small[1])
+    client = FileStruct.Client(self.Path, PackThreshold=100)
+    self.assertEqual(client[hash].GetData(), self.Small[0])
+    self.assertEqual(client[hash2].GetData(), self.Small[1])
+
+  def test_IterHashes(self):
+    hashes = [self.Client.PutData(data) for data in self.Small]
+    hashes.append(self.Client.PutData(self.Large))
+    hashes.append(self.FileHash)
+    self.assertEqual(list(self.Client.IterHashes()), sorted(hashes))
+    prefix = hashes[0][0]
+    self.assertEqual(list(self.Client.IterHashes(Prefix=prefix)), sorted(hash for hash in hashes if hash.startswith(prefix)))
+
+  def test_Link(self):
+    hash = self.Client.PutData(b'linked')
+    with self.Client.TempDir() as TD:
+      TD['file'].Link(hash)
+      self.assertEqual(TD['file'].GetData(), b'linked')
+
+  def test_Replicate(self):
+    client = FileStruct.Client(self.Path, PackThreshold=100, ReplicationQueue=True)
+    hashes = [client.PutData(data) for data in self.Small]
+    client.PutData(self.Small[0])
+    backend = FileStruct.backend.MemoryBackend()
+    stats = FileStruct.replicate.Replicator(client, backend).Run(Once=True)
+    self.assertEqual(stats['Replicated'], 20)
+    for hash, data in zip(hashes, self.Small):
+      self.assertEqual(backend.Objects[hash], data)
+
+  def test_Backend(self):
+    # Small objects fetched from the backend end up in a pack
+    hash = self.Client.NewHash(b'remote').hexdigest()
+    backend = FileStruct.backend.MemoryBackend({hash: b'remote', self.FileHashNX: b'remote'})
+    client = FileStruct.Client(self.Path, PackThreshold=100, Backend=backend, ExistsCacheSize=10)
+    file = client[hash]
+    self.assertIsInstance(file, FileStruct.core.PackedFile)
+    self.assertEqual(file.GetData(), b'remote')
+    self.assertNotIn(hash, client.ExistsCache)
+    self.assertIsInstance(client[hash], FileStruct.core.PackedFile)
+    self.assertEqual(backend.Gets, 1)
+    # Corrupt content is still refused
+    with self.assertRaises(FileStruct.Error):
+      client[self.FileHashNX]
+
+  def test_Refresh(self):
+    # Misses list Pack/ again only when it has changed
+    hash = self.Client.PutData(self.Small[0])
+    past = os.stat(self.Client.PackPath).st_mtime - 100
+    os.utime(self.Client.PackPath, (past, past))
+    self.assertIsNone(self.Client.Pack.Get(self.FileHashNX))
+    listdir, listed = os.listdir, []
+    os.listdir = lambda path: listed.append(path) or listdir(path)
+    try:
+      self.assertIsNone(self.Client.Pack.Get(self.FileHashNX))
+      self.assertEqual(listed, [])
+      # Appended by another client: found by the growth of the .log
+      hash2 = FileStruct.Client(self.Path, PackThreshold=100).PutData(self.Small[1])
+      del listed[:]
+      self.assertEqual(self.Client[hash2].GetData(), self.Small[1])
+      self.assertEqual(listed, [])
+    finally:
+      os.listdir = listdir
+    # Sealed by another client: Pack/ has changed
+    packsize = FileStruct.pack.PACK_SIZE
+    FileStruct.pack.PACK_SIZE = 10
+    try:
+      hash3 = FileStruct.Client(self.Path, PackThreshold=100).PutData(self.Small[2])
+    finally:
+      FileStruct.pack.PACK_SIZE = packsize
+    self.assertTrue(exists(join(self.Client.PackPath, '00000001.idx')))
+    for h, data in zip((hash, hash2, hash3), self.Small):
+      self.assertEqual(self.Client[h].GetData(), data)
+
+  def test_Refused(self):
+    # Collection and eviction only know Data/
+    plain = FileStruct.Client(self.Path)
+    for client in (self.Client, plain):
+      client.CollectGarbage([])
+    self.Client.PutData(self.Small[0])
+    for client in (self.Client, plain):
+      with self.assertRaises(FileStruct.Error):
+        client.CollectGarbage([])
+      with self.assertRaises(FileStruct.Error):
+        client.Evict(MaxObjects=1)
+    self.assertIn(self.FileHash, plain)
+
+  def test_Scrub(self):
+    # Packed objects are rehashed, by clients with or without packs of their own
+    hashes = [self.Client.PutData(data) for data in self.Small]
+    plain = FileStruct.Client(self.Path)
+    for client in (self.Client, plain):
+      stats = client.Scrub(Resume=False)
+      self.assertEqual((stats['Packed'], stats['CorruptPacked'], stats['Corrupt']), (len(hashes), 0, 0))
+
+    location = self.Client.Pack.Get(hashes[1])
+    path = join(self.Client.PackPath, '{0:08d}.pack'.format(location[0]))
+    os.chmod(path, 0o644)
+    with open(path, 'r+b') as f:
+      f.seek(location[1])
+      f.write(b'X')
+    for client in (self.Client, plain):
+      stats = client.Scrub(Resume=False)
+      self.assertEqual((stats['Packed'], stats['CorruptPacked']), (len(hashes), 1))
+    records = list(FileStruct.scrub.ReadReport(join(self.Client.CorruptPath, 'Report.jsonl')))
+    self.assertEqual([r['Hash'] for r in records], [hashes[1]] * 2)
+    self.assertEqual((records[0]['Pack'], records[0]['Offset']), (path, location[1]))
+    # Reported, not moved
+    self.assertIn(hashes[1], self.Client)
+
+  def test_Durability(self):
+    client = FileStruct.Client(self.Path, PackThreshold=100, Durability='directory')
+    hash = client.PutData(b'durable')
+    self.assertEqual(client[hash].GetData(), b'durable')
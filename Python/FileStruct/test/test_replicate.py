@@ -0,0 +1,158 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import os
+import json
+import fcntl
+import shutil
+import tempfile
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.backend
+import FileStruct.replicate
+
+
+
+class FlakyBackend(FileStruct.backend.MemoryBackend):
+  # The first Failures calls to Put() fail
+  def __init__(self, Failures):
+    super(FlakyBackend, self).__init__()
+    self.Failures = Failures
+
+  def Put(self, hash, stream):
+    with self._lock:
+      self.Failures -= 1
+      fail = self.Failures >= 0
+    if fail:
+      raise OSError('Connection reset')
+    super(FlakyBackend, self).Put(hash, stream)
+
+
+
+class TestClientReplicate(TestClientOps):
+
+  def setUp(self):
+    super(TestClientReplicate, self).setUp()
+    self.Client = FileStruct.Client(self.Path, ReplicationQueue=True)
+    self.Data = [str(i).encode('ascii') * 100 for i in range(20)]
+    self.Hashes = [self.Client.PutData(data) for data in self.Data]
+
+  def replicator(self, Target, **Options):
+    return FileStruct.replicate.Replicator(self.Client, Target, Workers=4, Backoff=0, **Options)
+
+  def test_Queue(self):
+    queue = self.Client.ReplicationQueue
+    # Dedup hits are not queued again
+    self.Client.PutData(self.Data[0])
+    stats = queue.Stats()
+    self.assertEqual(stats['Depth'], 20)
+    self.assertGreaterEqual(stats['Lag'], 0)
+    self.assertEqual(queue.Pending(), set(self.Hashes))
+    self.assertFalse(FileStruct.Client(self.Path).ReplicationQueue)
+
+  def test_Replicate(self):
+    backend = FileStruct.backend.MemoryBackend()
+    stats = self.replicator(backend).Run(Once=True)
+    self.assertEqual((stats['Replicated'], stats['Depth'], stats['Lag']), (20, 0, 0))
+    for hash, data in zip(self.Hashes, self.Data):
+      self.assertEqual(backend.Objects[hash], data)
+    self.assertEqual(self.Client.ReplicationQueue.Pending(), set())
+
+    # Only what was queued since is copied
+    hash = self.Client.PutData(b'more')
+    stats = self.replicator(backend).Run(Once=True)
+    self.assertEqual((stats['Replicated'], stats['Skipped']), (1, 0))
+    self.assertEqual(backend.Objects[hash], b'more')
+
+  def test_Database(self):
+    targetpath = tempfile.mkdtemp(suffix='_FileStruct_Test')
+    try:
+      with open(join(targetpath, 'FileStruct.json'), 'w') as f:
+        json.dump({'Version': 1}, f)
+      stats = self.replicator(targetpath).Run(Once=True)
+      self.assertEqual(stats['Replicated'], 20)
+      target = FileStruct.Client(targetpath)
+      for hash, data in zip(self.Hashes, self.Data):
+        self.assertEqual(target[hash].GetData(), data)
+    finally:
+      shutil.rmtree(targetpath)
+
+  def test_Skipped(self):
+    backend = FileStruct.backend.MemoryBackend({self.Hashes[0]: self.Data[0]})
+    os.unlink(self.Client.HashToPath(self.Hashes[1]))
+    stats = self.replicator(backend).Run(Once=True)
+    self.assertEqual((stats['Replicated'], stats['Skipped'], stats['Missing']), (18, 1, 1))
+
+  def test_Retries(self):
+    backend = FlakyBackend(5)
+    stats = self.replicator(backend).Run(Once=True)
+    self.assertEqual((stats['Replicated'], stats['Retries'], stats['Failed']), (20, 5, 0))
+    self.assertEqual(len(backend.Objects), 20)
+
+  def test_Failed(self):
+    backend = FlakyBackend(1000)
+    stats = self.replicator(backend, Retries=2).Run(Once=True)
+    self.assertEqual((stats['Failed'], stats['Retries'], stats['Depth']), (20, 40, 0))
+    queue = self.Client.ReplicationQueue
+    with open(queue.FailedPath, 'r') as f:
+      self.assertEqual(sorted(json.loads(line)['Hash'] for line in f), sorted(self.Hashes))
+    # Never evicted until replicated
+    self.assertEqual(queue.Pending(), set(self.Hashes))
+    stats = self.Client.Evict(MaxObjects=1, GracePeriod=0)
+    self.assertEqual(stats['Unreplicated'], 20)
+
+  def test_Crash(self):
+    # A batch that was copied but not committed is checked again
+    backend = FileStruct.backend.MemoryBackend()
+    replicator = self.replicator(backend)
+    def crash(Journal, Offset):
+      raise self.UnhandledTestException()
+    replicator.Queue.Commit = crash
+    with self.assertRaises(self.UnhandledTestException):
+      replicator.Run(Once=True)
+    del(replicator.Queue.Commit)
+    self.assertEqual(len(backend.Objects), 20)
+    self.assertEqual(self.Client.ReplicationQueue.Stats()['Depth'], 20)
+    stats = self.replicator(backend).Run(Once=True)
+    self.assertEqual((stats['Replicated'], stats['Skipped'], stats['Depth']), (0, 20, 0))
+
+  def test_Rotate(self):
+    queue = self.Client.ReplicationQueue
+    backend = FileStruct.backend.MemoryBackend()
+    rotatesize = FileStruct.replicate.ROTATE_SIZE
+    FileStruct.replicate.ROTATE_SIZE = 0
+    try:
+      self.replicator(backend).Run(Once=True)
+      self.assertFalse(exists(queue.JournalPath))
+      self.assertEqual(queue.Stats()['Depth'], 0)
+      hash = self.Client.PutData(b'more')
+      # The offset of the old journal does not apply to the new one
+      self.assertEqual(queue.Stats()['Depth'], 1)
+      stats = self.replicator(backend).Run(Once=True)
+      self.assertEqual(stats['Replicated'], 1)
+      self.assertEqual(backend.Objects[hash], b'more')
+    finally:
+      FileStruct.replicate.ROTATE_SIZE = rotatesize
+
+  def test_Lock(self):
+    replicator = self.replicator(FileStruct.backend.MemoryBackend())
+    with open(replicator.LockPath, 'w') as f:
+      fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+      with self.assertRaises(FileStruct.Error):
+        replicator.Run(Once=True)
@@ -0,0 +1,83 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join
+import os
+import unittest
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.scan
+
+
+
+class TestPrefixRange(unittest.TestCase):
+
+  def test_Ranges(self):
+    PrefixRange = FileStruct.scan.PrefixRange
+    self.assertEqual(PrefixRange(''), (None, None))
+    self.assertEqual(PrefixRange('a'), ('a', 'b'))
+    self.assertEqual(PrefixRange('A9'), ('a9', 'aa'))
+    self.assertEqual(PrefixRange('0ff'), ('0ff', '100'))
+    self.assertEqual(PrefixRange('ff'), ('ff', None))
+    with self.assertRaises(ValueError):
+      PrefixRange('xyz')
+
+
+
+class TestClientScan(TestClientOps):
+
+  def setUp(self):
+    super(TestClientScan, self).setUp()
+    self.Data = dict((self.Client.PutData(str(i).encode('ascii')), str(i).encode('ascii')) for i in range(300))
+    self.Data[self.FileHash] = self.FileContents
+    self.Hashes = sorted(self.Data)
+
+  def test_Scan(self):
+    for workers in [1, 3, 16]:
+      result = list(self.Client.Scan(Workers=workers))
+      self.assertEqual([h for h, size, mtime in result], self.Hashes)
+      for file_hash, size, mtime in result:
+        self.assertEqual(size, len(self.Data[file_hash]))
+        self.assertEqual(mtime, os.stat(self.Client.HashToPath(file_hash)).st_mtime)
+
+  def test_IterHashes(self):
+    self.assertEqual(list(self.Client.IterHashes()), self.Hashes)
+
+  def test_Range(self):
+    for start, stop in [('2', '3'), ('0', '8'), (self.Hashes[17], self.Hashes[250]), ('f', None), (None, '1'), ('abc', 'abd'), ('9', '1')]:
+      expected = [h for h in self.Hashes if (start is None or h >= start) and (stop is None or h < stop)]
+      self.assertEqual(list(self.Client.IterHashes(start, stop)), expected)
+
+  def test_Prefix(self):
+    for prefix in ['0', 'f', 'a1', self.Hashes[3][:4], self.Hashes[4]]:
+      self.assertEqual(list(self.Client.IterHashes(Prefix=prefix)), [h for h in self.Hashes if h.startswith(prefix)])
+    with self.assertRaises(ValueError):
+      list(self.Client.IterHashes('0', Prefix='a'))
+
+  def test_Clutter(self):
+    shard = join(self.Client.DataPath, self.FileHash[0:2])
+    open(join(shard, 'README'), 'w').close()
+    open(join(shard, self.FileHash[2:4], 'notahash'), 'w').close()
+    open(join(shard, self.FileHash[2:4], self.FileHash.upper()), 'w').close()
+    os.mkdir(join(self.Client.DataPath, 'zz'))
+    self.assertEqual(list(self.Client.IterHashes()), self.Hashes)
+
+  def test_EarlyClose(self):
+    it = self.Client.IterHashes(Workers=2)
+    self.assertEqual(next(it), self.Hashes[0])
+    it.close()
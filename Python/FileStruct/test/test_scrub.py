@@ -0,0 +1,111 @@
+# vim:fileencoding=utf-8:ts=2:sw=2:expandtab
+#
+# Copyright 2013 AppCove, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from os.path import join, exists
+import os
+import json
+import time
+
+from .test_core import FileStruct, TestClientOps
+import FileStruct.scrub
+
+
+
+class TestClientScrub(TestClientOps):
+
+  def setUp(self):
+    super(TestClientScrub, self).setUp()
+    self.Data = [str(i).encode('ascii') * 1000 for i in range(40)]
+    self.Hashes = sorted(self.Client.PutData(data) for data in self.Data)
+
+  def corrupt(self, file_hash, data=b'bit rot'):
+    path = self.Client[file_hash].Path
+    os.chmod(path, 0o644)
+    with open(path, 'wb') as f:
+      f.write(data)
+
+  def test_Clean(self):
+    stats = self.Client.Scrub(Workers=4)
+    self.assertEqual(stats['Objects'], len(self.Hashes) + 1)
+    self.assertEqual(stats['Corrupt'], 0)
+    self.assertIsNone(stats['QuarantinePath'])
+    self.assertFalse(exists(self.Client.CorruptPath))
+    self.assertFalse(exists(join(self.Client.TempPath, 'Scrub.checkpoint')))
+
+  def test_Corrupt(self):
+    bad = self.Client.NewHash(self.Data[3]).hexdigest()
+    self.corrupt(bad)
+    stats = self.Client.Scrub(Workers=2)
+    self.assertEqual(stats['Corrupt'], 1)
+    self.assertFalse(bad in self.Client)
+    self.assertTrue(exists(join(stats['QuarantinePath'], bad)))
+    report = list(FileStruct.scrub.ReadReport(join(self.Client.CorruptPath, 'Report.jsonl')))
+    self.assertEqual(len(report), 1)
+    self.assertEqual(report[0]['Hash'], bad)
+    self.assertEqual(report[0]['Actual'], self.Client.NewHash(b'bit rot').hexdigest())
+    self.assertEqual(report[0]['Size'], len(b'bit rot'))
+
+    # Storing the content again repairs the database
+    self.assertEqual(self.Client.PutData(self.Data[3]), bad)
+    self.assertTrue(bad in self.Client)
+
+  def test_Resume(self):
+    scrubber = FileStruct.scrub.Scrubber(self.Client, Workers=1)
+    resume = self.Hashes[20][0:4]
+    with open(scrubber.CheckpointPath, 'w') as f:
+      json.dump({'Next': resume, 'Objects': 100, 'Bytes': 0, 'Corrupt': 0, 'Started': 0}, f)
+    self.corrupt(self.Hashes[0])
+    stats = scrubber.Run()
+    self.assertEqual(stats['Resumed'], resume)
+    self.assertEqual(stats['Corrupt'], 0)
+    expected = len([h for h in self.Hashes + [self.FileHash] if h >= resume])
+    self.assertEqual(stats['Objects'], 100 + expected)
+    self.assertIsNone(scrubber.Checkpoint())
+
+    stats = self.Client.Scrub(Resume=False)
+    self.assertEqual(stats['Corrupt'], 1)
+
+  def test_Checkpoint(self):
+    class Interrupt(Exception): pass
+    scrubber = FileStruct.scrub.Scrubber(self.Client, Workers=1)
+    verify, calls = scrubber.Verify, []
+    def failing(file_hash, path=None):
+      calls.append(file_hash)
+      if len(calls) > 10:
+        raise Interrupt()
+      return verify(file_hash, path)
+    scrubber.Verify = failing
+    with self.assertRaises(Interrupt):
+      scrubber.Run()
+    checkpoint = scrubber.Checkpoint()
+    self.assertTrue(checkpoint['Next'] <= calls[-1][0:4])
+    self.assertTrue(checkpoint['Next'] > calls[0][0:4])
+
+  def test_Rate(self):
+    bucket = FileStruct.scrub.TokenBucket(100000, 1000)
+    start = time.monotonic()
+    for i in range(10):
+      bucket.Consume(2000)
+    self.assertGreater(time.monotonic() - start, 0.15)
+    with self.assertRaises(ValueError):
+      FileStruct.scrub.TokenBucket(0)
+
+  def test_RateLimited(self):
+    stats = self.Client.Scrub(Rate=200000, Workers=4)
+    self.assertEqual(stats['Corrupt'], 0)
+    self.assertEqual(stats['Bytes'], sum(map(len, self.Data)) + len(self.FileContents))